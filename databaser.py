@@ -1,19 +1,347 @@
-import sqlite3, os
+import sqlite3, os, re, threading, logging, calendar
+from time import monotonic, perf_counter
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import click
+from flask import g, has_app_context, request
 from werkzeug.security import generate_password_hash
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, timedelta
+
+log = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, 'databaser.db')
 
-def conectar():
-    conn = sqlite3.connect(DB_PATH)
+# ---------- conexões: uma por requisição, reaproveitadas via pool ----------
+POOL_MAX_CONEXOES = 8
+BUSY_TIMEOUT_MS = 5000
+CACHE_STATEMENTS = 256
+
+_pool = []
+_pool_lock = threading.Lock()
+
+
+# modo de depuração: CLINICA_RASTREAR_SQL=1 registra cada comando de cada requisição
+RASTREAR_SQL = os.environ.get("CLINICA_RASTREAR_SQL") == "1"
+LIMITE_N_MAIS_1 = 5  # mesmo SQL com parâmetros diferentes, N vezes na requisição
+CABECALHO_RASTREIO = "X-Rastreio-SQL"
+
+
+class MedicaoSQL:
+    """Nº de comandos e tempo gasto no SQLite durante uma requisição."""
+    __slots__ = ("comandos", "tempo_s")
+
+    def __init__(self):
+        self.comandos = 0
+        self.tempo_s = 0.0
+
+    def registrar(self, _sql, _parametros, duracao_s):
+        self.comandos += 1
+        self.tempo_s += duracao_s
+
+    def somar_leitura(self, _registro, duracao_s):
+        self.tempo_s += duracao_s
+
+
+def _chave_parametros(parametros):
+    if isinstance(parametros, dict):
+        return tuple(sorted(parametros.items()))
+    return tuple(parametros) if parametros is not None else None
+
+
+class RastreioSQL(MedicaoSQL):
+    """MedicaoSQL que guarda [sql, parâmetros, duração] de cada comando."""
+    __slots__ = ("executados",)
+
+    def __init__(self):
+        super().__init__()
+        self.executados = []
+
+    def registrar(self, sql, parametros, duracao_s):
+        super().registrar(sql, parametros, duracao_s)
+        registro = [" ".join(sql.split()), parametros, duracao_s]
+        self.executados.append(registro)
+        return registro
+
+    def somar_leitura(self, registro, duracao_s):
+        super().somar_leitura(registro, duracao_s)
+        if registro is not None:
+            registro[2] += duracao_s
+
+    def repetidos(self):
+        """Comandos idênticos (SQL e parâmetros) executados mais de uma vez."""
+        contagem = {}
+        for sql, parametros, _duracao in self.executados:
+            chave = (sql, _chave_parametros(parametros))
+            contagem[chave] = contagem.get(chave, 0) + 1
+        return {chave: vezes for chave, vezes in contagem.items() if vezes > 1}
+
+    def n_mais_1(self):
+        """Mesmo SQL com parâmetros variados executado LIMITE_N_MAIS_1+ vezes."""
+        contagem = {}
+        for sql, _parametros, _duracao in self.executados:
+            contagem[sql] = contagem.get(sql, 0) + 1
+        return {sql: vezes for sql, vezes in contagem.items() if vezes >= LIMITE_N_MAIS_1}
+
+    def resumo(self):
+        return (
+            f"comandos={self.comandos}; tempo_ms={self.tempo_s * 1000:.2f}; "
+            f"repetidos={len(self.repetidos())}; n_mais_1={len(self.n_mais_1())}"
+        )
+
+    def relatorio(self, titulo):
+        linhas = [f"SQL {titulo}: {self.resumo()}"]
+        for sql, parametros, duracao_s in self.executados:
+            linhas.append(f"  {duracao_s * 1000:8.2f} ms  {sql}  {parametros!r}")
+        for (sql, parametros), vezes in self.repetidos().items():
+            linhas.append(f"  REPETIDO {vezes}x: {sql}  {parametros!r}")
+        for sql, vezes in self.n_mais_1().items():
+            linhas.append(f"  N+1? {vezes}x: {sql}")
+        return "\n".join(linhas)
+
+
+class CursorClinica(sqlite3.Cursor):
+    """Cursor que soma na medição da conexão o tempo de execute e de fetch."""
+    _registro = None  # entrada do RastreioSQL do último execute
+
+    def execute(self, sql, parametros=()):
+        medicao = self.connection.medicao
+        if medicao is None:
+            return super().execute(sql, parametros)
+        inicio = perf_counter()
+        try:
+            return super().execute(sql, parametros)
+        finally:
+            self._registro = medicao.registrar(sql, parametros, perf_counter() - inicio)
+
+    def executemany(self, sql, sequencia):
+        medicao = self.connection.medicao
+        if medicao is None:
+            return super().executemany(sql, sequencia)
+        inicio = perf_counter()
+        try:
+            return super().executemany(sql, sequencia)
+        finally:
+            self._registro = medicao.registrar(sql, None, perf_counter() - inicio)
+
+    # o SQLite avança o statement conforme as linhas são lidas
+    def fetchone(self):
+        medicao = self.connection.medicao
+        if medicao is None:
+            return super().fetchone()
+        inicio = perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            medicao.somar_leitura(self._registro, perf_counter() - inicio)
+
+    def fetchmany(self, size=None):
+        medicao = self.connection.medicao
+        if medicao is None:
+            return super().fetchmany(size or self.arraysize)
+        inicio = perf_counter()
+        try:
+            return super().fetchmany(size or self.arraysize)
+        finally:
+            medicao.somar_leitura(self._registro, perf_counter() - inicio)
+
+    def fetchall(self):
+        medicao = self.connection.medicao
+        if medicao is None:
+            return super().fetchall()
+        inicio = perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            medicao.somar_leitura(self._registro, perf_counter() - inicio)
+
+
+class ConexaoClinica(sqlite3.Connection):
+    """Conexão que ignora close() enquanto pertence a uma requisição."""
+    gerenciada = False
+    caminho = None
+    medicao = None  # MedicaoSQL da requisição atual, se houver
+
+    def cursor(self, factory=CursorClinica):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute não passa por cursor(): sem isto escaparia da medição
+    def execute(self, sql, parametros=()):
+        return self.cursor().execute(sql, parametros)
+
+    def executemany(self, sql, sequencia):
+        return self.cursor().executemany(sql, sequencia)
+
+    def close(self):
+        if self.gerenciada:
+            return  # devolvida ao pool no teardown da requisição
+        super().close()
+
+    def fechar_de_fato(self):
+        self.gerenciada = False
+        super().close()
+
+
+def _abrir_conexao():
+    conn = sqlite3.connect(
+        DB_PATH,
+        factory=ConexaoClinica,
+        cached_statements=CACHE_STATEMENTS,
+        check_same_thread=False,  # o pool entrega a conexão a threads diferentes
+    )
+    conn.caminho = DB_PATH
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
     return conn
 
-def criar_tabelas():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
 
+def _retirar_do_pool():
+    with _pool_lock:
+        while _pool:
+            conn = _pool.pop()
+            if conn.caminho == DB_PATH:
+                return conn
+            conn.fechar_de_fato()
+    return _abrir_conexao()
+
+
+def _devolver_ao_pool(conn):
+    if conn.in_transaction:
+        conn.rollback()  # nada pendente atravessa requisições
+    with _pool_lock:
+        if conn.caminho == DB_PATH and len(_pool) < POOL_MAX_CONEXOES:
+            _pool.append(conn)
+            return
+    conn.fechar_de_fato()
+
+
+def conectar():
+    """
+    Dentro de uma requisição devolve sempre a mesma conexão (guardada em
+    flask.g); fora dela abre uma conexão avulsa que o chamador fecha.
+    """
+    if not has_app_context():
+        return _abrir_conexao()
+    conn = g.get("_conexao_db")
+    if conn is None:
+        conn = _retirar_do_pool()
+        conn.gerenciada = True
+        conn.medicao = g.get("_medicao_sql")
+        g._conexao_db = conn
+    return conn
+
+
+class HorarioIndisponivel(Exception):
+    """Médico ou sala já ocupados no horário (índices únicos uq_agendamentos_horario_*)."""
+
+
+@contextmanager
+def transacao_agenda(conn):
+    """
+    Escritas em agendamentos numa transação BEGIN IMMEDIATE: a trava de
+    escrita é tomada antes do primeiro comando e o COMMIT sai no fim do bloco.
+    Quem garante que não há choque de horário são os índices únicos e os
+    triggers de sobreposição; a violação deles vira HorarioIndisponivel (e a
+    transação é desfeita).
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn.cursor()
+    except sqlite3.IntegrityError as erro:
+        conn.rollback()
+        if "agendamentos.data, agendamentos.hora" in str(erro) or ERRO_SOBREPOSICAO in str(erro):
+            raise HorarioIndisponivel(str(erro)) from erro
+        raise
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+def iniciar_medicao_sql():
+    """
+    Passa a medir o SQL da requisição atual; com RASTREAR_SQL a medição guarda
+    cada comando (RastreioSQL). Devolve a medição.
+    """
+    medicao = g._medicao_sql = RastreioSQL() if RASTREAR_SQL else MedicaoSQL()
+    conn = g.get("_conexao_db")
+    if conn is not None:
+        conn.medicao = medicao
+    return medicao
+
+
+def _relatar_rastreio_streaming(corpo, rastreio, titulo):
+    try:
+        yield from corpo
+    finally:
+        _registrar_rastreio(rastreio, titulo)
+
+
+def _registrar_rastreio(rastreio, titulo):
+    nivel = logging.WARNING if rastreio.repetidos() or rastreio.n_mais_1() else logging.INFO
+    log.log(nivel, rastreio.relatorio(titulo))
+
+
+def _relatar_rastreio(response):
+    rastreio = g.get("_medicao_sql")
+    if not isinstance(rastreio, RastreioSQL):
+        return response
+    titulo = f"{request.method} {request.full_path.rstrip('?')}"
+    if response.is_streamed:
+        # o SQL do streaming roda depois desta função: relata no fim do corpo
+        response.response = _relatar_rastreio_streaming(response.response, rastreio, titulo)
+    else:
+        response.headers[CABECALHO_RASTREIO] = rastreio.resumo()
+        _registrar_rastreio(rastreio, titulo)
+    return response
+
+
+def liberar_conexao(_exc=None):
+    conn = g.pop("_conexao_db", None)
+    if conn is None:
+        return
+    conn.gerenciada = False
+    conn.medicao = None
+    try:
+        _devolver_ao_pool(conn)
+    except sqlite3.Error:
+        conn.fechar_de_fato()
+
+
+def _medir_requisicao():
+    iniciar_medicao_sql()  # before_request não pode devolver valor (viraria a resposta)
+
+
+def init_app(app):
+    app.before_request(_medir_requisicao)
+    app.after_request(_relatar_rastreio)
+    app.teardown_appcontext(liberar_conexao)
+
+    @app.cli.command("normalizar-agendamentos")
+    @click.option("--recomecar", is_flag=True, help="Ignora o progresso salvo e revisa a tabela inteira.")
+    def _cmd_normalizar_agendamentos(recomecar):
+        """Corrige em lotes status/data/hora de agendamentos legados."""
+        corrigidas = normalizar_agendamentos_legados(recomecar=recomecar)
+        print(f"{corrigidas} agendamento(s) corrigido(s).")
+
+    @app.cli.command("reconstruir-contagens")
+    def _cmd_reconstruir_contagens():
+        """Recalcula os contadores materializados dos painéis."""
+        reconstruir_contagens()
+        print("Contagens reconstruídas.")
+
+
+# ---------- migrações versionadas (PRAGMA user_version) ----------
+def _colunas(cur, tabela):
+    cur.execute(f"PRAGMA table_info({tabela})")
+    return {row[1] for row in cur.fetchall()}
+
+
+def _migracao_001_estrutura_inicial(cur):
+    # idempotente: bases anteriores às migrações já têm parte da estrutura
     # --- tabelas base ---
     cur.execute('''
         CREATE TABLE IF NOT EXISTS usuarios (
@@ -64,8 +392,7 @@ def criar_tabelas():
     ''')
 
     # garante que a coluna status exista mesmo em bases antigas
-    cur.execute("PRAGMA table_info(agendamentos)")
-    cols = [row[1] for row in cur.fetchall()]
+    cols = _colunas(cur, "agendamentos")
     if 'status' not in cols:
         cur.execute("ALTER TABLE agendamentos ADD COLUMN status TEXT NOT NULL DEFAULT 'agendado'")
     if 'convenio' not in cols:
@@ -117,8 +444,7 @@ def criar_tabelas():
         )
     ''')
 
-    cur.execute("PRAGMA table_info(agendamento_ajustes)")
-    cols_ajuste = [row[1] for row in cur.fetchall()]
+    cols_ajuste = _colunas(cur, "agendamento_ajustes")
     if 'motivo_negativa' not in cols_ajuste:
         cur.execute("ALTER TABLE agendamento_ajustes ADD COLUMN motivo_negativa TEXT")
     if 'data_sugerida' not in cols_ajuste:
@@ -153,31 +479,859 @@ def criar_tabelas():
             ("Recepcionista Master", "recepcionistamaster@gmail.com", generate_password_hash("12345"), "recepcionista master")
         )
 
-    conn.commit()
+
+def _migracao_002_estado_tarefas(cur):
+    # marcas de progresso das tarefas de manutenção (ex.: último fechamento automático)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS estado_tarefas (
+            chave TEXT PRIMARY KEY,
+            valor TEXT NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+
+
+def _reconstruir_contagens(cur):
+    cur.execute("DELETE FROM contagem_diaria")
+    cur.execute("DELETE FROM contagem_medico")
+    cur.execute('''
+        INSERT INTO contagem_diaria (data, medico_id, status, total)
+        SELECT data, medico_id, LOWER(status), COUNT(*)
+        FROM agendamentos
+        GROUP BY data, medico_id, LOWER(status)
+    ''')
+    cur.execute('''
+        INSERT INTO contagem_medico (medico_id, status, total)
+        SELECT medico_id, status, SUM(total)
+        FROM contagem_diaria
+        GROUP BY medico_id, status
+    ''')
+
+
+def _migracao_003_contagens(cur):
+    # contadores materializados dos painéis, mantidos por triggers em agendamentos
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS contagem_diaria (
+            data TEXT NOT NULL,
+            medico_id INTEGER NOT NULL,
+            status TEXT NOT NULL, -- LOWER(agendamentos.status)
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (data, medico_id, status)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS contagem_medico (
+            medico_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (medico_id, status)
+        ) WITHOUT ROWID
+    ''')
+
+    incrementar = '''
+        INSERT INTO contagem_diaria (data, medico_id, status, total)
+        VALUES (NEW.data, NEW.medico_id, LOWER(NEW.status), 1)
+        ON CONFLICT(data, medico_id, status) DO UPDATE SET total = total + 1;
+        INSERT INTO contagem_medico (medico_id, status, total)
+        VALUES (NEW.medico_id, LOWER(NEW.status), 1)
+        ON CONFLICT(medico_id, status) DO UPDATE SET total = total + 1;
+    '''
+    decrementar = '''
+        UPDATE contagem_diaria SET total = total - 1
+         WHERE data = OLD.data AND medico_id = OLD.medico_id AND status = LOWER(OLD.status);
+        UPDATE contagem_medico SET total = total - 1
+         WHERE medico_id = OLD.medico_id AND status = LOWER(OLD.status);
+    '''
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_contagem_insert AFTER INSERT ON agendamentos
+        BEGIN {incrementar} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_contagem_delete AFTER DELETE ON agendamentos
+        BEGIN {decrementar} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_contagem_update AFTER UPDATE OF data, medico_id, status ON agendamentos
+        WHEN OLD.data IS NOT NEW.data
+          OR OLD.medico_id IS NOT NEW.medico_id
+          OR LOWER(OLD.status) IS NOT LOWER(NEW.status)
+        BEGIN {decrementar} {incrementar} END
+    """)
+    _reconstruir_contagens(cur)
+
+
+_COLUNAS_AGENDAMENTOS = (
+    "id", "paciente_id", "medico_id", "procedimento_id", "sala_id", "data", "hora",
+    "status", "convenio", "notas", "motivo_negacao", "data_sugerida", "hora_sugerida", "updated_at",
+)
+
+
+def _migracao_004_status_canonico(cur):
+    # SQLite não adiciona CHECK a coluna existente: recria a tabela e copia os
+    # dados já convertidos para o código canônico de status
+    cur.connection.create_function("status_canonico", 1, status_canonico, deterministic=True)
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name='agendamentos'")
+    row_seq = cur.fetchone()
+
+    for trigger in ("trg_contagem_insert", "trg_contagem_delete", "trg_contagem_update"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cur.execute(f'''
+        CREATE TABLE agendamentos_novo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            paciente_id INTEGER NOT NULL,
+            medico_id INTEGER NOT NULL,
+            procedimento_id INTEGER NOT NULL,
+            sala_id INTEGER NOT NULL,
+            data TEXT NOT NULL, -- YYYY-MM-DD
+            hora TEXT NOT NULL, -- HH:MM
+            status TEXT NOT NULL DEFAULT 'agendado'
+                CHECK (status IN ({', '.join(f"'{st}'" for st in STATUS_CANONICOS)})),
+            convenio TEXT,
+            notas TEXT,
+            motivo_negacao TEXT,
+            data_sugerida TEXT,
+            hora_sugerida TEXT,
+            updated_at TEXT,
+            FOREIGN KEY (paciente_id) REFERENCES usuarios (id),
+            FOREIGN KEY (medico_id) REFERENCES usuarios (id),
+            FOREIGN KEY (procedimento_id) REFERENCES procedimentos (id),
+            FOREIGN KEY (sala_id) REFERENCES salas (id)
+        )
+    ''')
+    colunas = ", ".join(_COLUNAS_AGENDAMENTOS)
+    origem = colunas.replace("status,", "status_canonico(status),")
+    cur.execute(f"INSERT INTO agendamentos_novo ({colunas}) SELECT {origem} FROM agendamentos")
+    cur.execute("DROP TABLE agendamentos")
+    cur.execute("ALTER TABLE agendamentos_novo RENAME TO agendamentos")
+    if row_seq:
+        # preserva o contador do AUTOINCREMENT (ids de linhas apagadas não voltam)
+        cur.execute("UPDATE sqlite_sequence SET seq=MAX(seq, ?) WHERE name='agendamentos'", (row_seq[0],))
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_data ON agendamentos(data)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_data_hora ON agendamentos(data, hora)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_medico ON agendamentos(medico_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_data_status ON agendamentos(data, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_medico_data_status ON agendamentos(medico_id, data, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_sala_data_status ON agendamentos(sala_id, data, status)")
+
+    # status já é canônico: os triggers comparam a coluna crua
+    incrementar = '''
+        INSERT INTO contagem_diaria (data, medico_id, status, total)
+        VALUES (NEW.data, NEW.medico_id, NEW.status, 1)
+        ON CONFLICT(data, medico_id, status) DO UPDATE SET total = total + 1;
+        INSERT INTO contagem_medico (medico_id, status, total)
+        VALUES (NEW.medico_id, NEW.status, 1)
+        ON CONFLICT(medico_id, status) DO UPDATE SET total = total + 1;
+    '''
+    decrementar = '''
+        UPDATE contagem_diaria SET total = total - 1
+         WHERE data = OLD.data AND medico_id = OLD.medico_id AND status = OLD.status;
+        UPDATE contagem_medico SET total = total - 1
+         WHERE medico_id = OLD.medico_id AND status = OLD.status;
+    '''
+    cur.execute(f"""
+        CREATE TRIGGER trg_contagem_insert AFTER INSERT ON agendamentos
+        BEGIN {incrementar} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER trg_contagem_delete AFTER DELETE ON agendamentos
+        BEGIN {decrementar} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER trg_contagem_update AFTER UPDATE OF data, medico_id, status ON agendamentos
+        WHEN OLD.data IS NOT NEW.data
+          OR OLD.medico_id IS NOT NEW.medico_id
+          OR OLD.status IS NOT NEW.status
+        BEGIN {decrementar} {incrementar} END
+    """)
+    _reconstruir_contagens(cur)
+
+
+def _migracao_005_indices_paciente_ajustes(cur):
+    # índices apontados pela regressão de planos (tests/test_planos_consulta.py)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_paciente_data ON agendamentos(paciente_id, data, hora)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ajustes_agendamento ON agendamento_ajustes(agendamento_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ajustes_status ON agendamento_ajustes(status)")
+
+
+_MOTIVO_CONFLITO_MIGRACAO = "Conflito de horário com agendamento anterior"
+
+
+def _criar_conflitos_horario(cur):
+    # agendamentos tirados da agenda por conflito na migração 6, para a recepção revisar
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conflitos_horario (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            agendamento_id INTEGER NOT NULL REFERENCES agendamentos(id),
+            conflita_com INTEGER REFERENCES agendamentos(id),
+            status_anterior TEXT,
+            registrado_em TEXT NOT NULL,
+            revisado_em TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_conflitos_horario_revisado ON conflitos_horario(revisado_em)")
+
+
+def _migracao_006_horario_unico(cur):
+    # médico e sala não podem ter dois agendamentos ativos no mesmo horário;
+    # disputas antigas ficam com o agendamento mais antigo, os demais viram
+    # 'negado' e entram em conflitos_horario, listados na tela de ajustes
+    ativos = "('agendado', 'em atendimento', 'concluido')"
+    _criar_conflitos_horario(cur)
+    agora = datetime.now().isoformat(timespec="seconds")
+    for coluna in ("medico_id", "sala_id"):
+        anterior = f"""
+            FROM agendamentos b
+            WHERE b.data = agendamentos.data AND b.hora = agendamentos.hora
+              AND b.{coluna} = agendamentos.{coluna}
+              AND b.status IN {ativos} AND b.id < agendamentos.id
+        """
+        cur.execute(f"""
+            INSERT INTO conflitos_horario (agendamento_id, conflita_com, status_anterior, registrado_em)
+            SELECT id, (SELECT MIN(b.id) {anterior}), status, ?
+              FROM agendamentos
+             WHERE status IN {ativos} AND EXISTS (SELECT 1 {anterior})
+        """, (agora,))
+        cur.execute(f"""
+            UPDATE agendamentos
+               SET status = 'negado',
+                   motivo_negacao = COALESCE(motivo_negacao, ?)
+             WHERE status IN {ativos} AND EXISTS (SELECT 1 {anterior})
+        """, (_MOTIVO_CONFLITO_MIGRACAO,))
+        if cur.rowcount:
+            log.warning("migração 6: %d agendamento(s) em conflito de %s marcados como negado; "
+                        "revise-os na tela de ajustes", cur.rowcount, coluna)
+    cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_agendamentos_horario_medico
+            ON agendamentos(data, hora, medico_id) WHERE status IN {ativos}
+    """)
+    cur.execute(f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_agendamentos_horario_sala
+            ON agendamentos(data, hora, sala_id) WHERE status IN {ativos}
+    """)
+
+
+def _migracao_007_indice_chamadas_medico(cur):
+    # painel do médico: chamadas dos agendamentos do dia, sem varrer o histórico
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_chamadas_medico_agendamento ON chamadas_pacientes(medico_id, agendamento_id)"
+    )
+
+
+def _migracao_008_busca_usuarios(cur):
+    # índice FTS5 de nome/e-mail (sem acentos) para a busca da recepção;
+    # conteúdo externo: o texto fica só em usuarios, os triggers mantêm o índice
+    cur.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS usuarios_busca USING fts5(
+            nome, email,
+            content='usuarios', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_usuarios_busca_ins AFTER INSERT ON usuarios BEGIN
+            INSERT INTO usuarios_busca (rowid, nome, email) VALUES (NEW.id, NEW.nome, NEW.email);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_usuarios_busca_del AFTER DELETE ON usuarios BEGIN
+            INSERT INTO usuarios_busca (usuarios_busca, rowid, nome, email)
+            VALUES ('delete', OLD.id, OLD.nome, OLD.email);
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_usuarios_busca_upd AFTER UPDATE OF nome, email ON usuarios BEGIN
+            INSERT INTO usuarios_busca (usuarios_busca, rowid, nome, email)
+            VALUES ('delete', OLD.id, OLD.nome, OLD.email);
+            INSERT INTO usuarios_busca (rowid, nome, email) VALUES (NEW.id, NEW.nome, NEW.email);
+        END
+    """)
+    cur.execute("INSERT INTO usuarios_busca (usuarios_busca) VALUES ('rebuild')")
+
+
+def _migracao_009_inicio_em_minutos(cur):
+    # início do horário em minutos desde 1970-01-01 00:00 (hora local, sem fuso);
+    # coluna gerada: o SQLite calcula em toda escrita e o índice preenche as linhas
+    # existentes. Data ou hora fora do formato canônico dão NULL.
+    cur.execute(f"""
+        ALTER TABLE agendamentos ADD COLUMN inicio_min INTEGER
+            GENERATED ALWAYS AS ({SQL_INICIO_MIN}) VIRTUAL
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_inicio ON agendamentos(inicio_min)")
+
+
+def _migracao_010_series(cur):
+    # séries de agendamentos recorrentes: as ocorrências apontam para a série
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS agendamento_series (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            frequencia TEXT NOT NULL, -- diaria|semanal|quinzenal|mensal
+            intervalo INTEGER NOT NULL DEFAULT 1,
+            criado_em TEXT NOT NULL
+        )
+    """)
+    cur.execute("ALTER TABLE agendamentos ADD COLUMN serie_id INTEGER REFERENCES agendamento_series (id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_agendamentos_serie ON agendamentos(serie_id)")
+
+
+DURACAO_PADRAO_MIN = 30
+MAX_DURACAO_MIN = 480
+ERRO_SOBREPOSICAO = "sobreposicao de horario em agendamentos"
+
+
+def _migracao_011_duracao_procedimentos(cur):
+    # cada procedimento tem uma duração; o agendamento guarda a do momento em que
+    # foi marcado, e os triggers barram intervalos sobrepostos de médico ou sala
+    # (como os índices únicos fazem com o início exato)
+    cur.execute(f"""
+        ALTER TABLE procedimentos ADD COLUMN duracao_min INTEGER NOT NULL DEFAULT {DURACAO_PADRAO_MIN}
+            CHECK (duracao_min BETWEEN 1 AND {MAX_DURACAO_MIN})
+    """)
+    cur.execute(f"ALTER TABLE agendamentos ADD COLUMN duracao_min INTEGER NOT NULL DEFAULT {DURACAO_PADRAO_MIN}")
+
+    ativos = "('agendado', 'em atendimento', 'concluido')"
+    duracao_nova = f"COALESCE((SELECT duracao_min FROM procedimentos WHERE id = NEW.procedimento_id), {DURACAO_PADRAO_MIN})"
+    # só o mesmo dia (o expediente não atravessa a meia-noite): a busca usa os
+    # índices (medico_id, data, status) e (sala_id, data, status)
+    barrar_sobreposicao = f"""
+        SELECT RAISE(ABORT, '{ERRO_SOBREPOSICAO}')
+        WHERE EXISTS (
+            SELECT 1 FROM agendamentos a
+            WHERE (a.medico_id = NEW.medico_id OR a.sala_id = NEW.sala_id)
+              AND a.data = NEW.data
+              AND a.status IN {ativos}
+              AND a.inicio_min < NEW.inicio_min + {duracao_nova}
+              AND a.inicio_min + a.duracao_min > NEW.inicio_min
+              AND a.id IS NOT NEW.id
+        );
+    """
+    cur.execute(f"""
+        CREATE TRIGGER trg_agendamentos_sobreposicao_ins BEFORE INSERT ON agendamentos
+        WHEN NEW.status IN {ativos} AND NEW.inicio_min IS NOT NULL
+        BEGIN {barrar_sobreposicao} END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER trg_agendamentos_sobreposicao_upd
+        BEFORE UPDATE OF data, hora, status, medico_id, sala_id, procedimento_id ON agendamentos
+        WHEN NEW.status IN {ativos} AND NEW.inicio_min IS NOT NULL
+         AND (OLD.status NOT IN {ativos} OR OLD.data IS NOT NEW.data OR OLD.hora IS NOT NEW.hora
+              OR OLD.medico_id IS NOT NEW.medico_id OR OLD.sala_id IS NOT NEW.sala_id
+              OR OLD.procedimento_id IS NOT NEW.procedimento_id)
+        BEGIN {barrar_sobreposicao} END
+    """)
+    # a duração do agendamento acompanha o procedimento escolhido
+    cur.execute(f"""
+        CREATE TRIGGER trg_agendamentos_duracao_ins AFTER INSERT ON agendamentos
+        BEGIN
+            UPDATE agendamentos SET duracao_min = {duracao_nova} WHERE id = NEW.id;
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER trg_agendamentos_duracao_upd AFTER UPDATE OF procedimento_id ON agendamentos
+        WHEN OLD.procedimento_id IS NOT NEW.procedimento_id
+        BEGIN
+            UPDATE agendamentos SET duracao_min = {duracao_nova} WHERE id = NEW.id;
+        END
+    """)
+
+
+def _migracao_012_conflitos_horario(cur):
+    # bases que passaram pela migração 6 antes de conflitos_horario existir:
+    # recupera os negados por ela pelo motivo gravado (o status anterior se perdeu)
+    _criar_conflitos_horario(cur)
+    cur.execute("""
+        INSERT INTO conflitos_horario (agendamento_id, conflita_com, registrado_em)
+        SELECT a.id,
+               (SELECT MIN(b.id) FROM agendamentos b
+                 WHERE b.data = a.data AND b.hora = a.hora AND b.id < a.id
+                   AND (b.medico_id = a.medico_id OR b.sala_id = a.sala_id)),
+               ?
+          FROM agendamentos a
+         WHERE a.status = 'negado' AND a.motivo_negacao = ?
+           AND NOT EXISTS (SELECT 1 FROM conflitos_horario c WHERE c.agendamento_id = a.id)
+    """, (datetime.now().isoformat(timespec="seconds"), _MOTIVO_CONFLITO_MIGRACAO))
+
+
+def _migracao_013_marca_fechamento_em_minutos(cur):
+    # a marca do fechamento automático era a data 'AAAA-MM-DD'; passa a minutos da época
+    marca = ler_estado_tarefa(cur, _CHAVE_FECHAMENTO)
+    if marca and "-" in marca:
+        gravar_estado_tarefa(cur, _CHAVE_FECHAMENTO, str(minutos_do_horario(marca, "00:00")))
+
+
+# cada posição corresponde a uma versão: MIGRACOES[0] leva a base à versão 1
+MIGRACOES = [
+    _migracao_001_estrutura_inicial,
+    _migracao_002_estado_tarefas,
+    _migracao_003_contagens,
+    _migracao_004_status_canonico,
+    _migracao_005_indices_paciente_ajustes,
+    _migracao_006_horario_unico,
+    _migracao_007_indice_chamadas_medico,
+    _migracao_008_busca_usuarios,
+    _migracao_009_inicio_em_minutos,
+    _migracao_010_series,
+    _migracao_011_duracao_procedimentos,
+    _migracao_012_conflitos_horario,
+    _migracao_013_marca_fechamento_em_minutos,
+]
+VERSAO_SCHEMA = len(MIGRACOES)
+
+
+def versao_schema(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def aplicar_migracoes():
+    """
+    Aplica, uma única vez e em ordem, as migrações ainda não registradas em
+    PRAGMA user_version. Cada migração roda em sua própria transação.
+    """
+    conn = _abrir_conexao()
+    try:
+        if versao_schema(conn) >= VERSAO_SCHEMA:
+            return []
+        aplicadas = []
+        for numero, migracao in enumerate(MIGRACOES, start=1):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # relê dentro da trava: outro processo pode ter migrado antes
+                if versao_schema(conn) >= numero:
+                    conn.rollback()
+                    continue
+                migracao(conn.cursor())
+                conn.execute(f"PRAGMA user_version={numero}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            aplicadas.append(numero)
+        return aplicadas
+    finally:
+        conn.fechar_de_fato()
+
+
+def reconstruir_contagens():
+    """Recalcula do zero contagem_diaria/contagem_medico a partir de agendamentos."""
+    conn = _abrir_conexao()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        _reconstruir_contagens(conn.cursor())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.fechar_de_fato()
+
+
+def criar_tabelas():
+    """Ponto de entrada do startup: leva o schema à versão mais recente."""
+    return aplicar_migracoes()
+
+
+# ---------- normalização de dados legados ----------
+CONFLICT_TOKENS = ("<<<<<<<", "=======", ">>>>>>>")
+# códigos aceitos pelo CHECK de agendamentos.status
+STATUS_CANONICOS = ("agendado", "em atendimento", "concluido", "cancelado", "negado")
+STATUS_OCUPAM_HORARIO = ("agendado", "em atendimento", "concluido")
+_SINONIMOS_STATUS = {
+    "negada": "negado",
+    "cancelada": "cancelado",
+    "concluído": "concluido",
+    "confirmado": "agendado",
+    "pendente": "agendado",
+}
+TAMANHO_LOTE_NORMALIZACAO = 500
+_CHAVE_NORMALIZACAO = "normalizacao_agendamentos"
+
+
+def remover_marcadores_conflito(valor):
+    if not isinstance(valor, str):
+        return valor
+    texto = valor.strip()
+    if not texto:
+        return texto
+    if not any(token in texto for token in CONFLICT_TOKENS):
+        return texto
+
+    blocos = []
+    trecho_atual = []
+    for linha in texto.splitlines():
+        if linha.startswith("<<<<<<<"):
+            trecho_atual = []
+            continue
+        if linha.startswith("======="):
+            blocos.append("\n".join(trecho_atual).strip())
+            trecho_atual = []
+            continue
+        if linha.startswith(">>>>>>>"):
+            blocos.append("\n".join(trecho_atual).strip())
+            trecho_atual = []
+            continue
+        trecho_atual.append(linha)
+
+    if trecho_atual:
+        blocos.append("\n".join(trecho_atual).strip())
+
+    for bloco in blocos:
+        if bloco:
+            return bloco
+
+    return texto.replace("<<<<<<<", "").replace("=======", "").replace(">>>>>>>", "").strip()
+
+
+def normalizar_status(valor, validos):
+    texto = (remover_marcadores_conflito(valor) or "").strip().lower()
+    if not texto:
+        return "agendado" if "agendado" in validos else (next(iter(validos)) if validos else texto)
+
+    if texto in validos:
+        return texto
+
+    for candidato in validos:
+        if candidato in texto:
+            return candidato
+
+    return texto
+
+
+def normalizar_data(valor):
+    texto = (remover_marcadores_conflito(valor) or "").strip()
+    if not texto:
+        return texto
+
+    match_iso = re.search(r"\b\d{4}-\d{2}-\d{2}\b", texto)
+    if match_iso:
+        return match_iso.group(0)
+
+    match_br = re.search(r"\b\d{2}/\d{2}/\d{4}\b", texto)
+    if match_br:
+        dia, mes, ano = match_br.group(0).split("/")
+        return f"{ano}-{mes}-{dia}"
+
+    return texto
+
+
+def normalizar_hora(valor):
+    texto = (remover_marcadores_conflito(valor) or "").strip()
+    if not texto:
+        return texto
+
+    match_hora = re.search(r"\b(\d{1,2}):(\d{2})\b", texto)
+    if match_hora:
+        return f"{int(match_hora.group(1)):02d}:{match_hora.group(2)}"
+
+    return texto
+
+
+# ---------- horários como inteiros: minutos desde 1970-01-01 00:00 ----------
+MINUTOS_POR_DIA = 24 * 60
+_ORDINAL_EPOCA = date(1970, 1, 1).toordinal()
+SQL_INICIO_MIN = "CAST(strftime('%s', data || ' ' || hora) AS INTEGER) / 60"
+_DATA_ISO = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def dia_da_data(data_str):
+    """'AAAA-MM-DD' -> dias desde a época; ValueError para qualquer outro formato."""
+    if not isinstance(data_str, str) or not _DATA_ISO.fullmatch(data_str):
+        raise ValueError(f"data inválida: {data_str!r}")
+    return date.fromisoformat(data_str).toordinal() - _ORDINAL_EPOCA
+
+
+def minutos_do_horario(data_str, hora_str):
+    """'AAAA-MM-DD', 'HH:MM' -> minutos desde a época; ValueError se inválidos."""
+    hh, sep, mm = (hora_str or "").partition(":")
+    if not (sep and hh.isdigit() and mm.isdigit() and len(mm) == 2):
+        raise ValueError(f"hora inválida: {hora_str!r}")
+    hora, minuto = int(hh), int(mm)
+    if hora > 23 or minuto > 59:
+        raise ValueError(f"hora inválida: {hora_str!r}")
+    return dia_da_data(data_str) * MINUTOS_POR_DIA + hora * 60 + minuto
+
+
+def minutos_de(dt):
+    """datetime (ingênuo) -> minutos desde a época, truncando segundos."""
+    return (dt.date().toordinal() - _ORDINAL_EPOCA) * MINUTOS_POR_DIA + dt.hour * 60 + dt.minute
+
+
+def data_do_dia(dia):
+    """Dias desde a época -> 'AAAA-MM-DD'."""
+    return date.fromordinal(dia + _ORDINAL_EPOCA).isoformat()
+
+
+def hora_do_minuto(minuto_do_dia):
+    return f"{minuto_do_dia // 60:02d}:{minuto_do_dia % 60:02d}"
+
+
+def ja_passou(minutos, agora=None):
+    """O horário (minutos da época) é anterior a `agora`, contando os segundos."""
+    ref = agora or datetime.now()
+    # granularidade de minuto: inicio < ref  <=>  inicio <= piso(ref - 1µs)
+    return minutos <= minutos_de(ref - timedelta(microseconds=1))
+
+
+def status_canonico(valor):
+    """Converte grafias legadas no código canônico; desconhecidos viram 'agendado'."""
+    texto = normalizar_status(valor, STATUS_CANONICOS)
+    texto = _SINONIMOS_STATUS.get(texto, texto)
+    return texto if texto in STATUS_CANONICOS else "agendado"
+
+
+def normalizar_agendamentos_legados(tamanho_lote=TAMANHO_LOTE_NORMALIZACAO, max_lotes=None, recomecar=False):
+    """
+    Corrige status/data/hora de agendamentos legados (marcadores de conflito,
+    datas dd/mm/aaaa, status fora do padrão) em lotes ordenados por id. O
+    último id processado fica em estado_tarefas, então cada execução retoma
+    de onde a anterior parou. Linhas que, corrigidas, colidiriam com outro
+    agendamento (índices únicos, trigger de sobreposição) ficam como estão e
+    vão para o log; a marca passa por elas. Devolve quantas linhas foram
+    corrigidas.
+    """
+    conn = conectar()
+    try:
+        cur = conn.cursor()
+        marca = 0 if recomecar else int(ler_estado_tarefa(cur, _CHAVE_NORMALIZACAO) or 0)
+        corrigidas = 0
+        lotes = 0
+        while max_lotes is None or lotes < max_lotes:
+            cur.execute(
+                "SELECT id, status, data, hora FROM agendamentos WHERE id > ? ORDER BY id LIMIT ?",
+                (marca, tamanho_lote),
+            )
+            linhas = cur.fetchall()
+            if not linhas:
+                break
+            atualizacoes = []
+            for row in linhas:
+                status = status_canonico(row["status"])
+                data = normalizar_data(row["data"])
+                hora = normalizar_hora(row["hora"])
+                if (status, data, hora) != (row["status"], row["data"], row["hora"]):
+                    atualizacoes.append((status, data, hora, row["id"]))
+            corrigidas += _gravar_normalizacao(cur, atualizacoes)
+            marca = linhas[-1]["id"]
+            gravar_estado_tarefa(cur, _CHAVE_NORMALIZACAO, str(marca))
+            conn.commit()
+            lotes += 1
+    finally:
+        conn.close()
+    if corrigidas:
+        limpar_cache_disponibilidade()
+    return corrigidas
+
+
+def _gravar_normalizacao(cur, atualizacoes):
+    """Grava o lote de uma vez; se alguma linha colidir, refaz uma a uma pulando as que colidem."""
+    sql = "UPDATE agendamentos SET status=?, data=?, hora=? WHERE id=?"
+    try:
+        cur.executemany(sql, atualizacoes)
+        return len(atualizacoes)
+    except sqlite3.IntegrityError:
+        pass
+    # as linhas anteriores à falha já foram gravadas; regravá-las não muda nada
+    gravadas = 0
+    for linha in atualizacoes:
+        try:
+            cur.execute(sql, linha)
+        except sqlite3.IntegrityError as erro:
+            log.warning("normalização: agendamento %s mantido como está (%s)", linha[-1], erro)
+            continue
+        gravadas += 1
+    return gravadas
+
+
+# ---------- dados de referência (listas dos formulários) em cache ----------
+TTL_REFERENCIAS_S = 120
+
+# nome -> (tabela de origem, consulta); invalidar_referencias() recebe tabelas
+_REFERENCIAS = {
+    "pacientes": (
+        "usuarios",
+        "SELECT id, nome, email FROM usuarios WHERE LOWER(tipo_usuario)='paciente' ORDER BY nome",
+    ),
+    "medicos": (
+        "usuarios",
+        "SELECT id, nome, email FROM usuarios WHERE LOWER(REPLACE(tipo_usuario, 'é', 'e'))='medico' ORDER BY nome",
+    ),
+    "procedimentos": ("procedimentos", "SELECT id, nome, descricao, duracao_min FROM procedimentos ORDER BY nome"),
+    "salas": ("salas", "SELECT id, nome FROM salas ORDER BY nome"),
+    "convenios": (
+        "agendamentos",
+        "SELECT DISTINCT convenio FROM agendamentos WHERE convenio IS NOT NULL AND TRIM(convenio)<>'' ORDER BY convenio",
+    ),
+}
+
+_referencias = {}  # nome -> (linhas, carregado_em)
+_referencias_lock = threading.Lock()
+
+
+def referencias(nome):
+    """Lista de referência `nome` (ver _REFERENCIAS), servida do cache enquanto válida."""
+    agora = monotonic()
+    with _referencias_lock:
+        item = _referencias.get(nome)
+        if item and agora - item[1] < TTL_REFERENCIAS_S:
+            return item[0]
+
+    _tabela, consulta = _REFERENCIAS[nome]
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute(consulta)
+    if nome == "convenios":
+        linhas = tuple(row["convenio"] for row in cur.fetchall())
+    else:
+        linhas = tuple(dict(row) for row in cur.fetchall())
     conn.close()
 
-# ---------- util: calcular horários disponíveis ----------
-def _status_ocupado(status: str) -> bool:
-    texto = (status or "").strip().lower()
-    return texto not in {"negado", "cancelado", "negada", "cancelada"}
+    with _referencias_lock:
+        _referencias[nome] = (linhas, agora)
+    return linhas
 
 
-def get_busy_slots(dia_str: str, medico_id: int = None, sala_id: int = None, ignorar_agendamento_id=None):
-    params = [dia_str]
-    condicoes = ["data=?"]
-    condicao_alocacao = None
-    if medico_id and sala_id:
-        condicao_alocacao = "(medico_id=? OR sala_id=?)"
-        params.extend([medico_id, sala_id])
-    elif medico_id:
-        condicao_alocacao = "medico_id=?"
-        params.append(medico_id)
-    elif sala_id:
-        condicao_alocacao = "sala_id=?"
-        params.append(sala_id)
-
-    if condicao_alocacao:
-        condicoes.append(condicao_alocacao)
+LIMITE_BUSCA_USUARIOS = 10
+_TERMO_BUSCA = re.compile(r"\w+")
+_FILTRO_TIPO_USUARIO = {
+    "paciente": "LOWER(u.tipo_usuario)='paciente'",
+    "medico": "LOWER(REPLACE(u.tipo_usuario, 'é', 'e'))='medico'",
+}
+
+
+def buscar_usuarios(termo, tipo=None, limite=LIMITE_BUSCA_USUARIOS):
+    """
+    Usuários cujo nome ou e-mail têm palavras começando por cada palavra de
+    `termo`, sem diferenciar acentos (índice usuarios_busca). `tipo` restringe
+    a 'paciente' ou 'medico'. Devolve até `limite` dicts, os mais relevantes
+    primeiro.
+    """
+    palavras = _TERMO_BUSCA.findall(termo or "")
+    if not palavras:
+        return []
+    # cada palavra entre aspas (nada vira operador do FTS5) e como prefixo
+    consulta = " ".join('"' + palavra.replace('"', '""') + '"*' for palavra in palavras)
+    condicoes = ["usuarios_busca MATCH ?"]
+    if tipo in _FILTRO_TIPO_USUARIO:
+        condicoes.append(_FILTRO_TIPO_USUARIO[tipo])
+
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute(
+        f"""SELECT u.id, u.nome, u.email, u.tipo_usuario
+            FROM usuarios_busca
+            JOIN usuarios u ON u.id = usuarios_busca.rowid
+            WHERE {' AND '.join(condicoes)}
+            ORDER BY usuarios_busca.rank, u.nome
+            LIMIT ?""",
+        (consulta, limite),
+    )
+    encontrados = [dict(row) for row in cur.fetchall()]
+    conn.close()
+    return encontrados
+
+
+def invalidar_referencias(*tabelas):
+    """Descarta as listas que dependem das tabelas dadas (todas, se nenhuma for dada)."""
+    with _referencias_lock:
+        for nome, (tabela, _consulta) in _REFERENCIAS.items():
+            if not tabelas or tabela in tabelas:
+                _referencias.pop(nome, None)
+
+
+def registrar_convenio(convenio):
+    """Após gravar um agendamento: só invalida a lista se o convênio for novo."""
+    valor = (convenio or "").strip()
+    if not valor:
+        return
+    with _referencias_lock:
+        item = _referencias.get("convenios")
+        if item is None or valor in item[0]:
+            return
+        _referencias.pop("convenios", None)
+
+
+# ---------- disponibilidade: intervalos ocupados por (dia, médico) e (dia, sala) ----------
+# cada chave guarda um IntervalosDia; um horário está livre se [início, início + duração)
+# não cruza os intervalos do médico nem os da sala
+INICIO_EXPEDIENTE_MIN = 8 * 60
+FIM_EXPEDIENTE_MIN = 17 * 60  # último início da grade
+PASSO_GRADE_MIN = 30
+FIM_ATENDIMENTO_MIN = FIM_EXPEDIENTE_MIN + PASSO_GRADE_MIN  # nada termina depois disso
+_MINUTOS_GRADE = tuple(range(INICIO_EXPEDIENTE_MIN, FIM_EXPEDIENTE_MIN + 1, PASSO_GRADE_MIN))
+GRADE_HORARIOS = tuple(f"{m // 60:02d}:{m % 60:02d}" for m in _MINUTOS_GRADE)
+# rede de segurança para escritas feitas por outros processos
+TTL_DISPONIBILIDADE_S = 30
+
+_mapas = {}  # dia -> {(tipo, id): (IntervalosDia, carregado_em)}
+_mapas_lock = threading.Lock()
+_mapas_geracao = 0
+
+
+class IntervalosDia:
+    """
+    Intervalos ocupados de um dia, [inicio, fim) em minutos desde 00:00,
+    disjuntos e ordenados pelo início, em duas listas paralelas. A consulta
+    é O(log n) por bisect; a inserção acha a posição em O(log n), mas a
+    atribuição por fatia desloca os itens seguintes, O(n). Não vale uma
+    árvore balanceada: n é o número de agendamentos de um médico ou sala
+    num dia (dezenas), e o deslocamento é um memmove em C. Intervalos que
+    se sobrepõem (dados legados) são fundidos ao inserir.
+    """
+    __slots__ = ("inicios", "fins")
+
+    def __init__(self):
+        self.inicios = []
+        self.fins = []
+
+    def inserir(self, inicio, fim):
+        """Acrescenta [inicio, fim), fundindo-o aos intervalos que cruza. O(n) pela fatia."""
+        i = bisect_right(self.fins, inicio)    # primeiro que termina depois de `inicio`
+        j = bisect_left(self.inicios, fim)     # os anteriores a j começam antes de `fim`
+        if i < j:
+            inicio, fim = min(inicio, self.inicios[i]), max(fim, self.fins[j - 1])
+        self.inicios[i:j] = [inicio]
+        self.fins[i:j] = [fim]
+
+    def ocupado(self, inicio, fim):
+        """Algum intervalo cruza [inicio, fim)?"""
+        i = bisect_left(self.inicios, fim)
+        return i > 0 and self.fins[i - 1] > inicio
+
+
+def _minuto_do_dia(hora_str):
+    """'HH:MM' -> minutos desde 00:00; ValueError se inválida."""
+    return minutos_do_horario(data_do_dia(0), hora_str)
+
+
+def _id_ou_none(valor):
+    try:
+        return int(valor) or None
+    except (TypeError, ValueError):
+        return None
+
+
+def _chaves_alocacao(medico_id, sala_id):
+    medico_id, sala_id = _id_ou_none(medico_id), _id_ou_none(sala_id)
+    chaves = []
+    if medico_id:
+        chaves.append(("medico", medico_id))
+    if sala_id:
+        chaves.append(("sala", sala_id))
+    return chaves or [("todos", None)]
+
+
+def _consultar_mapas(dia_str, chaves, ignorar_agendamento_id=None):
+    params = [dia_str, *STATUS_OCUPAM_HORARIO]
+    condicoes = ["data=?", f"status IN ({','.join('?' for _ in STATUS_OCUPAM_HORARIO)})"]
+    alocacao = []
+    for tipo, ident in chaves:
+        if tipo == "medico":
+            alocacao.append("medico_id=?")
+            params.append(ident)
+        elif tipo == "sala":
+            alocacao.append("sala_id=?")
+            params.append(ident)
+    if alocacao:
+        condicoes.append(f"({' OR '.join(alocacao)})")
     if ignorar_agendamento_id is not None:
         condicoes.append("id<>?")
         params.append(ignorar_agendamento_id)
@@ -185,76 +1339,499 @@ def get_busy_slots(dia_str: str, medico_id: int = None, sala_id: int = None, ign
     conn = conectar()
     cur = conn.cursor()
     cur.execute(
-        f"SELECT hora, status FROM agendamentos WHERE {' AND '.join(condicoes)}",
+        f"SELECT medico_id, sala_id, inicio_min, duracao_min FROM agendamentos WHERE {' AND '.join(condicoes)}",
         params,
     )
-    ocupados = {row["hora"] for row in cur.fetchall() if _status_ocupado(row["status"])}
+    linhas = cur.fetchall()
     conn.close()
-    return sorted(ocupados)
+
+    base = dia_da_data(dia_str) * MINUTOS_POR_DIA
+    mapas = {chave: IntervalosDia() for chave in chaves}
+    for row in linhas:
+        if row["inicio_min"] is None:  # data/hora fora do formato (dados legados)
+            continue
+        inicio = row["inicio_min"] - base
+        for chave in chaves:
+            tipo, ident = chave
+            if (tipo == "medico" and row["medico_id"] != ident) or (tipo == "sala" and row["sala_id"] != ident):
+                continue
+            mapas[chave].inserir(inicio, inicio + row["duracao_min"])
+    return mapas
+
+
+def _intervalos_ocupacao(dia_str, medico_id=None, sala_id=None, ignorar_agendamento_id=None):
+    """Intervalos ocupados do médico e da sala no dia (um IntervalosDia por chave), com cache."""
+    chaves = _chaves_alocacao(medico_id, sala_id)
+    if ignorar_agendamento_id is not None:
+        return list(_consultar_mapas(dia_str, chaves, ignorar_agendamento_id).values())
+
+    agora = monotonic()
+    mapas = {}
+    with _mapas_lock:
+        do_dia = _mapas.get(dia_str, {})
+        for chave in chaves:
+            item = do_dia.get(chave)
+            if item and agora - item[1] < TTL_DISPONIBILIDADE_S:
+                mapas[chave] = item[0]
+        geracao = _mapas_geracao
+    faltantes = [chave for chave in chaves if chave not in mapas]
+    if faltantes:
+        novos = _consultar_mapas(dia_str, faltantes)
+        mapas.update(novos)
+        with _mapas_lock:
+            # uma invalidação durante a consulta torna o resultado suspeito
+            if geracao == _mapas_geracao:
+                do_dia = _mapas.setdefault(dia_str, {})
+                for chave, intervalos in novos.items():
+                    do_dia[chave] = (intervalos, agora)
+    return list(mapas.values())
 
 
-def is_slot_available(dia_str: str, hora_str: str, medico_id: int = None, sala_id: int = None, ignorar_agendamento_id=None) -> bool:
-    ocupados = set(get_busy_slots(dia_str, medico_id, sala_id, ignorar_agendamento_id))
-    return hora_str not in ocupados
+def _livre(intervalos, inicio, fim):
+    return not any(item.ocupado(inicio, fim) for item in intervalos)
 
 
-def horarios_disponiveis(medico_id:int, sala_id:int, dia_str:str, passo_min=30, ignorar_agendamento_id=None):
+def invalidar_disponibilidade(dia_str, medico_id=None, sala_id=None):
     """
-    Gera timeslots entre 08:00-17:00 para a data dada,
-    removendo horários já ocupados (sala OU médico ocupados)
-    considerando status que não sejam cancelados/negados.
+    Descarta os mapas afetados por uma escrita em agendamentos. Sem médico e
+    sala, descarta o dia inteiro.
     """
-    inicio = time(8, 0); fim = time(17, 0)
-    t = datetime.strptime(f"{dia_str} {inicio.hour:02d}:{inicio.minute:02d}", "%Y-%m-%d %H:%M")
-    end = datetime.strptime(f"{dia_str} {fim.hour:02d}:{fim.minute:02d}", "%Y-%m-%d %H:%M")
+    global _mapas_geracao
+    medico_id, sala_id = _id_ou_none(medico_id), _id_ou_none(sala_id)
+    with _mapas_lock:
+        _mapas_geracao += 1
+        do_dia = _mapas.get(dia_str)
+        if not do_dia:
+            return
+        if not (medico_id or sala_id):
+            del _mapas[dia_str]
+            return
+        do_dia.pop(("todos", None), None)
+        if medico_id:
+            do_dia.pop(("medico", medico_id), None)
+        if sala_id:
+            do_dia.pop(("sala", sala_id), None)
 
-    ocupados = set(get_busy_slots(dia_str, medico_id, sala_id, ignorar_agendamento_id))
-    livres = []
-    while t <= end:
-        hhmm = t.strftime("%H:%M")
-        if hhmm not in ocupados:
-            livres.append(hhmm)
-        t += timedelta(minutes=passo_min)
+
+def limpar_cache_disponibilidade():
+    global _mapas_geracao
+    with _mapas_lock:
+        _mapas_geracao += 1
+        _mapas.clear()
+
+
+def get_busy_slots(dia_str: str, medico_id: int = None, sala_id: int = None, ignorar_agendamento_id=None):
+    """Horários da grade em que o médico ou a sala estão ocupados, por algum trecho do bloco."""
+    intervalos = _intervalos_ocupacao(dia_str, medico_id, sala_id, ignorar_agendamento_id)
+    return [hhmm for hhmm, minuto in zip(GRADE_HORARIOS, _MINUTOS_GRADE)
+            if not _livre(intervalos, minuto, minuto + PASSO_GRADE_MIN)]
+
+
+def is_slot_available(dia_str: str, hora_str: str, medico_id: int = None, sala_id: int = None, ignorar_agendamento_id=None,
+                      duracao_min=DURACAO_PADRAO_MIN) -> bool:
+    try:
+        inicio = _minuto_do_dia(hora_str)
+    except ValueError:
+        return False
+    intervalos = _intervalos_ocupacao(dia_str, medico_id, sala_id, ignorar_agendamento_id)
+    return _livre(intervalos, inicio, inicio + duracao_min)
+
+
+def horarios_disponiveis(medico_id:int, sala_id:int, dia_str:str, passo_min=30, ignorar_agendamento_id=None,
+                         duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Gera timeslots entre 08:00-17:00 para a data dada em que o procedimento
+    inteiro (`duracao_min`) cabe antes de 17:30 sem cruzar nenhum intervalo
+    ocupado (sala OU médico), considerando status que não sejam
+    cancelados/negados.
+    """
+    dia_da_data(dia_str)  # data inválida continua gerando ValueError
+    intervalos = _intervalos_ocupacao(dia_str, medico_id, sala_id, ignorar_agendamento_id)
+    return [
+        hora_do_minuto(minuto)
+        for minuto in range(INICIO_EXPEDIENTE_MIN, FIM_EXPEDIENTE_MIN + 1, passo_min)
+        if minuto + duracao_min <= FIM_ATENDIMENTO_MIN and _livre(intervalos, minuto, minuto + duracao_min)
+    ]
+
+
+SALA_QUALQUER = "qualquer"  # sala_id dos formulários: o sistema escolhe a sala
+
+
+def salas_livres_no_dia(cur, dia_str, medico_id, horas=GRADE_HORARIOS, duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Salas livres em cada uma das `horas` em que o médico está livre no dia
+    por `duracao_min`, lidas numa única consulta sobre salas e os
+    agendamentos do dia: {hora: [sala_id, ...]}, só com as horas que têm ao
+    menos uma sala. As salas vêm da menos ocupada no dia para a mais ocupada;
+    a primeira é a que se escolhe. Recebe o cursor para ler dentro da
+    transação de quem grava.
+    """
+    medico_id = _id_ou_none(medico_id)
+    cur.execute(
+        f"""SELECT id AS sala_id, NULL AS medico_id, NULL AS inicio_min, NULL AS duracao_min FROM salas
+            UNION ALL
+            SELECT sala_id, medico_id, inicio_min, duracao_min FROM agendamentos
+            WHERE data=? AND status IN ({','.join('?' for _ in STATUS_OCUPAM_HORARIO)})""",
+        (dia_str, *STATUS_OCUPAM_HORARIO),
+    )
+    linhas = cur.fetchall()
+    base = dia_da_data(dia_str) * MINUTOS_POR_DIA
+    salas = {row["sala_id"]: IntervalosDia() for row in linhas if row["duracao_min"] is None}
+    carga = dict.fromkeys(salas, 0)
+    do_medico = IntervalosDia()
+    for row in linhas:
+        if row["duracao_min"] is None or row["inicio_min"] is None:
+            continue
+        inicio = row["inicio_min"] - base
+        fim = inicio + row["duracao_min"]
+        if row["medico_id"] == medico_id:
+            do_medico.inserir(inicio, fim)
+        if row["sala_id"] in salas:
+            salas[row["sala_id"]].inserir(inicio, fim)
+            carga[row["sala_id"]] += row["duracao_min"]
+
+    ordem = sorted(salas, key=lambda sala_id: (carga[sala_id], sala_id))
+    livres = {}
+    for hhmm in horas:
+        inicio = _minuto_do_dia(hhmm)
+        fim = inicio + duracao_min
+        if do_medico.ocupado(inicio, fim):
+            continue
+        disponiveis = [sala_id for sala_id in ordem if not salas[sala_id].ocupado(inicio, fim)]
+        if disponiveis:
+            livres[hhmm] = disponiveis
     return livres
 
 
-def sugerir_proximo_horario(data_str: str, hora_str: str, medico_id: int, sala_id: int, passo_min=30):
+HORIZONTE_SUGESTAO_DIAS = 14
+
+
+def intervalos_no_periodo(inicio_str: str, fim_str: str, medico_id: int = None, sala_id: int = None,
+                          ignorar_agendamento_id=None):
+    """
+    Intervalos ocupados (médico OU sala) entre duas datas inclusive, em uma
+    única consulta por faixa de data: {dia: IntervalosDia}, em minutos desde
+    00:00 do dia. Os objetos são novos: quem chama pode inserir neles.
+    """
+    params = [inicio_str, fim_str, *STATUS_OCUPAM_HORARIO]
+    condicoes = ["data BETWEEN ? AND ?", f"status IN ({','.join('?' for _ in STATUS_OCUPAM_HORARIO)})"]
+    alocacao = []
+    for tipo, ident in _chaves_alocacao(medico_id, sala_id):
+        if tipo == "medico":
+            alocacao.append("medico_id=?")
+            params.append(ident)
+        elif tipo == "sala":
+            alocacao.append("sala_id=?")
+            params.append(ident)
+    if alocacao:
+        condicoes.append(f"({' OR '.join(alocacao)})")
+    if ignorar_agendamento_id is not None:
+        condicoes.append("id<>?")
+        params.append(ignorar_agendamento_id)
+
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT data, inicio_min, duracao_min FROM agendamentos WHERE {' AND '.join(condicoes)}",
+        params,
+    )
+    intervalos = {}
+    for row in cur.fetchall():
+        if row["inicio_min"] is None:  # data/hora fora do formato (dados legados)
+            continue
+        inicio = row["inicio_min"] % MINUTOS_POR_DIA
+        intervalos.setdefault(row["data"], IntervalosDia()).inserir(inicio, inicio + row["duracao_min"])
+    conn.close()
+    return intervalos
+
+
+def cabe_no_expediente(inicio, duracao_min):
+    """O procedimento começando em `inicio` (minutos desde 00:00) termina até FIM_ATENDIMENTO_MIN?"""
+    return inicio + duracao_min <= FIM_ATENDIMENTO_MIN
+
+
+def _cabe_no_dia(intervalos, inicio, duracao_min):
+    """O procedimento começando em `inicio` termina até FIM_ATENDIMENTO_MIN sem cruzar `intervalos`?"""
+    return cabe_no_expediente(inicio, duracao_min) and not (intervalos and intervalos.ocupado(inicio, inicio + duracao_min))
+
+
+def ocupacao_em_lote(cur, dias, medicos, salas):
+    """
+    Intervalos ocupados nos `dias` por qualquer dos `medicos` ou das `salas`,
+    em uma única consulta: {("medico", id, data): IntervalosDia,
+    ("sala", id, data): IntervalosDia}, em minutos desde 00:00 do dia.
+    Recebe o cursor para ler dentro da transação de quem vai gravar.
+    """
+    dias, medicos, salas = sorted(dias), sorted(medicos), sorted(salas)
+    if not dias or not (medicos or salas):
+        return {}
+    cur.execute(
+        f"""SELECT data, medico_id, sala_id, inicio_min, duracao_min FROM agendamentos
+            WHERE data IN ({','.join('?' for _ in dias)})
+              AND status IN ({','.join('?' for _ in STATUS_OCUPAM_HORARIO)})
+              AND (medico_id IN ({','.join('?' for _ in medicos)}) OR sala_id IN ({','.join('?' for _ in salas)}))""",
+        [*dias, *STATUS_OCUPAM_HORARIO, *medicos, *salas],
+    )
+    ocupados = {}
+    for row in cur.fetchall():
+        if row["inicio_min"] is None:  # data/hora fora do formato (dados legados)
+            continue
+        inicio = row["inicio_min"] % MINUTOS_POR_DIA
+        for chave in (("medico", row["medico_id"], row["data"]), ("sala", row["sala_id"], row["data"])):
+            ocupados.setdefault(chave, IntervalosDia()).inserir(inicio, inicio + row["duracao_min"])
+    return ocupados
+
+
+def grade_disponibilidade(inicio_str: str, fim_str: str, medico_id: int = None, sala_id: int = None,
+                          duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Ocupação e horários livres dia a dia entre duas datas (inclusive), a
+    partir de uma única consulta por faixa (intervalos_no_periodo): ocupados
+    são os horários da grade com algum trecho tomado, como em get_busy_slots,
+    e livres os inícios da grade em que cabem `duracao_min` minutos, como em
+    horarios_disponiveis. Lança ValueError para datas inválidas ou fim antes
+    do início.
+    """
+    inicio = datetime.strptime(inicio_str, "%Y-%m-%d").date()
+    fim = datetime.strptime(fim_str, "%Y-%m-%d").date()
+    if fim < inicio:
+        raise ValueError("fim anterior ao início")
+
+    intervalos = intervalos_no_periodo(inicio.isoformat(), fim.isoformat(), medico_id, sala_id)
+    dias = []
+    dia = inicio
+    while dia <= fim:
+        dia_str = dia.isoformat()
+        do_dia = intervalos.get(dia_str)
+        dias.append({
+            "data": dia_str,
+            "ocupados": [hhmm for hhmm, minuto in zip(GRADE_HORARIOS, _MINUTOS_GRADE)
+                         if do_dia and do_dia.ocupado(minuto, minuto + PASSO_GRADE_MIN)],
+            "disponiveis": [hhmm for hhmm, minuto in zip(GRADE_HORARIOS, _MINUTOS_GRADE)
+                            if _cabe_no_dia(do_dia, minuto, duracao_min)],
+        })
+        dia += timedelta(days=1)
+    return dias
+
+
+def sugerir_horarios(data_str: str, hora_str: str, medico_id: int, sala_id: int, passo_min=30,
+                     horizonte_dias=HORIZONTE_SUGESTAO_DIAS, limite=1, duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Lista até `limite` horários a partir de data/hora em que cabem
+    `duracao_min` minutos livres, avançando de `passo_min` em `passo_min`
+    dentro do expediente por `horizonte_dias` dias. A ocupação do horizonte
+    inteiro vem de uma única consulta.
+    """
     try:
-        base_dt = datetime.strptime(f"{data_str} {hora_str}", "%Y-%m-%d %H:%M")
+        minuto = minutos_do_horario(data_str, hora_str)
     except ValueError:
-        return None, None
+        return []
+    if limite < 1 or horizonte_dias < 1:
+        return []
+
+    primeiro_dia = minuto // MINUTOS_POR_DIA
+    ultimo_dia = primeiro_dia + horizonte_dias - 1
+    datas = {dia: data_do_dia(dia) for dia in range(primeiro_dia, ultimo_dia + 1)}
+    intervalos = intervalos_no_periodo(datas[primeiro_dia], datas[ultimo_dia], medico_id, sala_id)
+
+    # aritmética de minutos: nada de strptime/strftime a cada passo
+    sugestoes = []
+    while minuto // MINUTOS_POR_DIA <= ultimo_dia:
+        dia, minuto_do_dia = divmod(minuto, MINUTOS_POR_DIA)
+        if _cabe_no_dia(intervalos.get(datas[dia]), minuto_do_dia, duracao_min):
+            sugestoes.append((datas[dia], hora_do_minuto(minuto_do_dia)))
+            if len(sugestoes) >= limite:
+                break
+        minuto += passo_min
+        if minuto % MINUTOS_POR_DIA > FIM_EXPEDIENTE_MIN:
+            minuto = (minuto // MINUTOS_POR_DIA + 1) * MINUTOS_POR_DIA + INICIO_EXPEDIENTE_MIN
+    return sugestoes
+
 
-    for _ in range(0, 14 * 24 * 60 // passo_min):
-        dia = base_dt.strftime("%Y-%m-%d")
-        hora = base_dt.strftime("%H:%M")
-        if is_slot_available(dia, hora, medico_id, sala_id):
-            return dia, hora
-        base_dt += timedelta(minutes=passo_min)
-        if base_dt.time() > time(17, 0):
-            base_dt = datetime.combine(base_dt.date() + timedelta(days=1), time(8, 0))
-    return None, None
+def sugerir_proximo_horario(data_str: str, hora_str: str, medico_id: int, sala_id: int, passo_min=30,
+                            horizonte_dias=HORIZONTE_SUGESTAO_DIAS, duracao_min=DURACAO_PADRAO_MIN):
+    sugestoes = sugerir_horarios(data_str, hora_str, medico_id, sala_id, passo_min, horizonte_dias, limite=1,
+                                 duracao_min=duracao_min)
+    return sugestoes[0] if sugestoes else (None, None)
+
+
+# ---------- séries recorrentes ----------
+FREQUENCIAS_SERIE = {"diaria": 1, "semanal": 7, "quinzenal": 14, "mensal": None}  # passo em dias
+MAX_OCORRENCIAS_SERIE = 52
+MARGEM_ALTERNATIVA_DIAS = 3
+
+
+def datas_da_serie(data_inicial, frequencia, intervalo=1, ocorrencias=None, ate=None):
+    """
+    Datas 'AAAA-MM-DD' de uma série a partir de `data_inicial`, a cada
+    `intervalo` períodos da `frequencia`, até `ocorrencias` datas ou até a data
+    `ate` (inclusive), no máximo MAX_OCORRENCIAS_SERIE. Na mensal, meses sem o
+    dia (31, 30, 29) usam o último dia do mês. ValueError para regra inválida.
+    """
+    if frequencia not in FREQUENCIAS_SERIE or intervalo < 1 or not (ocorrencias or ate):
+        raise ValueError("regra de recorrência inválida")
+    primeiro = dia_da_data(data_inicial)
+    ultimo = dia_da_data(ate) if ate else None
+    total = min(ocorrencias or MAX_OCORRENCIAS_SERIE, MAX_OCORRENCIAS_SERIE)
+    base = date.fromisoformat(data_inicial)
+
+    datas = []
+    for n in range(total):
+        if FREQUENCIAS_SERIE[frequencia]:
+            dia = primeiro + n * intervalo * FREQUENCIAS_SERIE[frequencia]
+        else:
+            meses = base.month - 1 + n * intervalo
+            ano, mes = base.year + meses // 12, meses % 12 + 1
+            dia = dia_da_data(date(ano, mes, min(base.day, calendar.monthrange(ano, mes)[1])).isoformat())
+        if ultimo is not None and dia > ultimo:
+            break
+        datas.append(data_do_dia(dia))
+    return datas
+
+
+def _alternativa_mais_proxima(data_str, hora_str, intervalos, agora=None, duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Horário da grade mais próximo de data/hora, no mesmo dia ou nos
+    seguintes, em que cabem `duracao_min` minutos livres.
+    """
+    alvo = minutos_do_horario(data_str, hora_str) % MINUTOS_POR_DIA
+    dia = dia_da_data(data_str)
+    for deslocamento in range(MARGEM_ALTERNATIVA_DIAS + 1):
+        data_alt = data_do_dia(dia + deslocamento)
+        do_dia = intervalos.get(data_alt)
+        base = (dia + deslocamento) * MINUTOS_POR_DIA
+        livres = [
+            minuto for minuto in _MINUTOS_GRADE
+            if _cabe_no_dia(do_dia, minuto, duracao_min) and not ja_passou(base + minuto, agora)
+        ]
+        if livres:
+            return data_alt, hora_do_minuto(min(livres, key=lambda minuto: abs(minuto - alvo)))
+    return None
+
+
+def planejar_serie(datas, hora_str, medico_id, sala_id, agora=None, duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Confere cada data da série contra a ocupação do médico e da sala, lida
+    numa única consulta por faixa (a série inteira mais a margem das
+    alternativas), pelo intervalo [hora, hora + duracao_min), como
+    is_slot_available. Devolve [{data, hora, livre, alternativa}], em que
+    `alternativa` é o horário livre mais próximo, (data, hora), ou None.
+    """
+    if not datas:
+        return []
+    fim = data_do_dia(dia_da_data(datas[-1]) + MARGEM_ALTERNATIVA_DIAS)
+    intervalos = intervalos_no_periodo(datas[0], fim, medico_id, sala_id)
+    plano = []
+    for data_str in datas:
+        minuto = minutos_do_horario(data_str, hora_str)
+        inicio = minuto % MINUTOS_POR_DIA
+        do_dia = intervalos.setdefault(data_str, IntervalosDia())
+        if not do_dia.ocupado(inicio, inicio + duracao_min) and not ja_passou(minuto, agora):
+            do_dia.inserir(inicio, inicio + duracao_min)  # as próximas ocorrências e alternativas não o reutilizam
+            plano.append({"data": data_str, "hora": hora_str, "livre": True, "alternativa": None})
+            continue
+        alternativa = _alternativa_mais_proxima(data_str, hora_str, intervalos, agora, duracao_min)
+        if alternativa:
+            inicio_alt = _minuto_do_dia(alternativa[1])
+            intervalos.setdefault(alternativa[0], IntervalosDia()).inserir(inicio_alt, inicio_alt + duracao_min)
+        plano.append({"data": data_str, "hora": hora_str, "livre": False, "alternativa": alternativa})
+    return plano
+
+
+# ---------- fechamento automático de consultas passadas ----------
+STATUS_ABERTOS = ("agendado", "em atendimento")
+INTERVALO_FECHAMENTO_S = 60
+_CHAVE_FECHAMENTO = "fechamento_automatico"
+
+_tarefas_thread = None
+
+
+def ler_estado_tarefa(cur, chave):
+    cur.execute("SELECT valor FROM estado_tarefas WHERE chave=?", (chave,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def gravar_estado_tarefa(cur, chave, valor):
+    cur.execute(
+        """INSERT INTO estado_tarefas (chave, valor, updated_at) VALUES (?, ?, ?)
+           ON CONFLICT(chave) DO UPDATE SET valor=excluded.valor, updated_at=excluded.updated_at""",
+        (chave, valor, datetime.now().isoformat()),
+    )
+
+
+def _marca_fechamento(cur):
+    """Marca do fechamento automático em minutos da época (None antes da primeira execução)."""
+    marca = ler_estado_tarefa(cur, _CHAVE_FECHAMENTO)
+    return int(marca) if marca else None
+
+
+def recuar_marca_fechamento(cur, inicio_min):
+    """
+    Uma escrita deixou em aberto um horário anterior à marca do fechamento
+    automático: a marca recua até ele, para que a próxima execução o conclua.
+    Chamada dentro da transação de quem gravou.
+    """
+    marca = _marca_fechamento(cur)
+    if inicio_min is not None and marca is not None and inicio_min < marca:
+        gravar_estado_tarefa(cur, _CHAVE_FECHAMENTO, str(inicio_min))
 
 
 def auto_close_past_appointments(now: datetime = None):
+    """
+    Conclui consultas em aberto cujo horário já passou. Percorre apenas a
+    faixa de inicio_min desde a última execução (marca em estado_tarefas),
+    usando idx_agendamentos_inicio; devolve quantas linhas foram fechadas.
+    """
     ref = now or datetime.now()
+    # hora tem granularidade de minuto: dt < ref  <=>  dt <= piso(ref - 1µs)
+    limite = minutos_de(ref - timedelta(microseconds=1))
+    inicio_dia_limite = limite - limite % MINUTOS_POR_DIA
+
     conn = conectar()
     cur = conn.cursor()
-    cur.execute("SELECT id, data, hora, status FROM agendamentos")
-    rows = cur.fetchall()
-    to_close = []
-    for row in rows:
-        try:
-            dt_row = datetime.strptime(f"{row['data']} {row['hora']}", "%Y-%m-%d %H:%M")
-        except Exception:
-            continue
-        status_raw = (row["status"] or "").lower()
-        if dt_row < ref and status_raw in {"agendado", "em atendimento", "confirmado", "pendente"}:
-            to_close.append(row["id"])
-    if to_close:
-        now_iso = ref.isoformat()
-        cur.execute(
-            f"UPDATE agendamentos SET status='concluido', updated_at=? WHERE id IN ({','.join('?' for _ in to_close)})",
-            [now_iso, *to_close],
-        )
-        conn.commit()
+    marca = _marca_fechamento(cur)
+    cur.execute(
+        f"""UPDATE agendamentos SET status='concluido', updated_at=?
+             WHERE inicio_min BETWEEN ? AND ?
+               AND status IN ({','.join('?' for _ in STATUS_ABERTOS)})""",
+        [ref.isoformat(), marca or 0, limite, *STATUS_ABERTOS],
+    )
+    fechadas = cur.rowcount
+    # o dia corrente continua na janela: consultas de hoje ainda podem vencer
+    if marca is None or inicio_dia_limite > marca:
+        gravar_estado_tarefa(cur, _CHAVE_FECHAMENTO, str(inicio_dia_limite))
+    conn.commit()
     conn.close()
+    return fechadas
+
+
+# executadas em ordem a cada tick: a normalização vem antes para que datas
+# corrigidas já entrem no fechamento automático
+TAREFAS_PERIODICAS = (
+    ("normalização de agendamentos legados", normalizar_agendamentos_legados),
+    ("fechamento automático de consultas", auto_close_past_appointments),
+)
+
+
+def iniciar_tarefas_periodicas(intervalo_s: int = INTERVALO_FECHAMENTO_S):
+    """Executa TAREFAS_PERIODICAS em uma thread daemon a cada intervalo."""
+    global _tarefas_thread
+    if _tarefas_thread is not None and _tarefas_thread.is_alive():
+        return _tarefas_thread
+
+    parar = threading.Event()
+
+    def _executar():
+        while not parar.is_set():
+            for descricao, tarefa in TAREFAS_PERIODICAS:
+                try:
+                    tarefa()
+                except sqlite3.Error:
+                    log.exception("falha na tarefa periódica: %s", descricao)
+            parar.wait(intervalo_s)
+
+    _tarefas_thread = threading.Thread(target=_executar, name="tarefas-periodicas", daemon=True)
+    _tarefas_thread.parar = parar
+    _tarefas_thread.start()
+    return _tarefas_thread
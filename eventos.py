@@ -0,0 +1,66 @@
+"""
+Pub/sub em memória para empurrar avisos às telas abertas (Server-Sent Events).
+
+Quem grava publica depois do COMMIT; cada conexão SSE espera numa Condition,
+sem consultar o banco, e só acorda quando há evento novo ou para mandar o
+ping que mantém a conexão viva. Os últimos eventos ficam num buffer circular
+para quem ficou um instante para trás.
+
+Vale dentro de um processo: com vários workers, cada um só vê o que ele mesmo
+publicou, e o cliente recupera o resto pela reconexão (Last-Event-ID).
+"""
+import json
+import threading
+from collections import deque
+
+INTERVALO_PING_S = 15
+TAMANHO_BUFFER = 256
+
+
+class CanalEventos:
+    """Eventos numerados em sequência; assinantes pedem os posteriores a `seq`."""
+
+    def __init__(self, tamanho=TAMANHO_BUFFER):
+        self._condicao = threading.Condition()
+        self._eventos = deque(maxlen=tamanho)  # (seq, tipo, dados)
+        self._seq = 0
+
+    def publicar(self, tipo, dados):
+        with self._condicao:
+            self._seq += 1
+            self._eventos.append((self._seq, tipo, dados))
+            self._condicao.notify_all()
+
+    def posicao(self):
+        """Seq atual: o ponto de partida de um novo assinante."""
+        with self._condicao:
+            return self._seq
+
+    def esperar(self, seq, timeout=None):
+        """
+        Eventos posteriores a `seq`, esperando por eles até `timeout` segundos
+        (padrão: INTERVALO_PING_S). Devolve (eventos, nova_seq, perdeu);
+        `perdeu` indica que o buffer já descartou parte do que não foi lido.
+        """
+        with self._condicao:
+            if self._seq == seq:
+                self._condicao.wait(INTERVALO_PING_S if timeout is None else timeout)
+            if self._seq == seq:
+                return [], seq, False
+            perdeu = not self._eventos or self._eventos[0][0] > seq + 1
+            novos = [evento for evento in self._eventos if evento[0] > seq]
+            return novos, self._seq, perdeu
+
+
+def formatar_sse(tipo, dados, ident=None):
+    """Um evento no formato text/event-stream."""
+    linhas = []
+    if ident is not None:
+        linhas.append(f"id: {ident}")
+    linhas.append(f"event: {tipo}")
+    linhas.append(f"data: {json.dumps(dados, ensure_ascii=False)}")
+    return "\n".join(linhas) + "\n\n"
+
+
+# chamadas_pacientes: "chamada" (nova pendente) e "encaminhada" (recepção liberou)
+chamadas = CanalEventos()
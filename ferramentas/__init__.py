@@ -0,0 +1 @@
+# Utilitários de desenvolvimento (dados sintéticos, medições); não são importados pela aplicação.
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark das rotas principais sobre uma base sintética.
+
+Gera a base com ferramentas.dados_sinteticos, chama cada rota pelo test client
+do Flask com a sessão do perfil adequado e mede latência (p50/p95/p99/máx) e
+número de comandos SQL por requisição. Os resultados podem ser gravados como
+linha de base e comparados em execuções futuras:
+
+    python -m ferramentas.benchmark --agendamentos 100000 --medicos 500 --pacientes 20000 --salvar base.json
+    python -m ferramentas.benchmark --agendamentos 100000 --medicos 500 --pacientes 20000 --comparar base.json
+
+Por padrão os caches em memória (disponibilidade e listas de referência) são
+limpos antes de cada chamada, para medir o trabalho no banco; use --cache-quente
+para medir o caminho com cache.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import databaser
+from ferramentas.dados_sinteticos import gerar_clinica
+
+PERCENTIS = (50, 95, 99)
+
+
+def percentil(valores, p):
+    """Percentil por interpolação linear (valores já ordenados)."""
+    if not valores:
+        return 0.0
+    posicao = (len(valores) - 1) * p / 100
+    base = int(posicao)
+    proximo = min(base + 1, len(valores) - 1)
+    return valores[base] + (valores[proximo] - valores[base]) * (posicao - base)
+
+
+class ContadorSQL:
+    """Conta os comandos SQL emitidos pelas conexões abertas enquanto ativo."""
+
+    def __init__(self):
+        self.total = 0
+        self._abrir_original = None
+
+    def _registrar(self, sql):
+        if not sql.startswith("--"):  # corpo de trigger vem como comentário
+            self.total += 1
+
+    def __enter__(self):
+        self._abrir_original = databaser._abrir_conexao
+
+        def abrir_com_contagem():
+            conn = self._abrir_original()
+            conn.set_trace_callback(self._registrar)
+            return conn
+
+        databaser._abrir_conexao = abrir_com_contagem
+        with databaser._pool_lock:
+            databaser._pool.clear()
+        return self
+
+    def __exit__(self, *exc):
+        databaser._abrir_conexao = self._abrir_original
+        with databaser._pool_lock:
+            databaser._pool.clear()
+
+
+def _cliente(app, usuario_id, tipo):
+    cliente = app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao["usuario_id"] = usuario_id
+        sessao["usuario_nome"] = "Benchmark"
+        sessao["usuario_tipo"] = tipo
+    return cliente
+
+
+def cenarios(app, amostra):
+    """(nome, cliente, url) de cada rota medida; só leituras, a base não muda."""
+    amanha = (date.today() + timedelta(days=1)).isoformat()
+    mes = date.today().strftime("%Y-%m")
+    m, s, ag = amostra["medico_id"], amostra["sala_id"], amostra["agendamento_id"]
+    rec = _cliente(app, amostra["recepcionista_id"], "recepcionista master")
+    med = _cliente(app, amostra["medico_hoje_id"] or m, "medico")
+    pac = _cliente(app, amostra["paciente_id"], "paciente")
+    return [
+        ("visao_recepcionista", rec, "/user/recepcionista"),
+        ("visao_recepcionista_filtros", rec, f"/user/recepcionista?mes={mes}&medico=0001&convenio=Uni"),
+        ("procedimentos", rec, "/user/recepcionista/procedimentos"),
+        ("exportar_relatorio_mensal", rec, "/user/recepcionista/relatorios/exportar?escopo=mensal"),
+        ("exportar_relatorio_completo", rec, "/user/recepcionista/relatorios/exportar"),
+        ("horarios_api", rec, f"/user/recepcionista/horarios_disponiveis?medico_id={m}&sala_id={s}&dia={amanha}"),
+        ("api_sugerir_horario", rec, f"/user/api/sugerir_horario?data={amanha}&hora=08:00&medico_id={m}&sala_id={s}&limite=5"),
+        ("api_disponibilidade_periodo", rec, f"/user/api/disponibilidade/periodo?inicio={amanha}&dias=7&medico_id={m}&sala_id={s}"),
+        ("agendar_consulta", rec, "/user/agendar_consulta"),
+        ("api_buscar_usuarios", rec, "/user/api/usuarios/busca?q=pacien&tipo=paciente"),
+        ("lista_ajustes", rec, "/user/recepcionista/ajustes"),
+        ("visao_medico", med, "/user/medico"),
+        ("visao_paciente", pac, "/user/paciente"),
+        ("paciente_horarios_api", pac, f"/user/paciente/horarios_disponiveis?agendamento_id={ag}&dia={amanha}"),
+    ]
+
+
+def medir(app, amostra, repeticoes=20, cache_quente=False, filtro=None):
+    resultados = {}
+    for nome, cliente, url in cenarios(app, amostra):
+        if filtro and not any(f in nome for f in filtro):
+            continue
+        cliente.get(url).get_data()  # aquecimento: templates, pool, statement cache
+        tempos, consultas = [], []
+        for _ in range(repeticoes):
+            if not cache_quente:
+                databaser.limpar_cache_disponibilidade()
+                databaser.invalidar_referencias()
+            with ContadorSQL() as contador:
+                inicio = time.perf_counter()
+                resposta = cliente.get(url)
+                corpo = resposta.get_data()  # inclui o streaming do CSV
+                tempos.append((time.perf_counter() - inicio) * 1000)
+            if resposta.status_code != 200:
+                raise RuntimeError(f"{nome}: HTTP {resposta.status_code} em {url}")
+            consultas.append(contador.total)
+        tempos.sort()
+        resultados[nome] = {
+            **{f"p{p}_ms": round(percentil(tempos, p), 3) for p in PERCENTIS},
+            "max_ms": round(tempos[-1], 3),
+            "consultas": max(consultas),
+            "bytes": len(corpo),
+        }
+    return resultados
+
+
+def comparar(atual, base, tolerancia):
+    """Devolve as linhas do relatório e se houve regressão."""
+    linhas, regrediu = [], False
+    for nome, medida in atual.items():
+        anterior = base.get(nome)
+        if not anterior:
+            linhas.append(f"{nome:32s} (sem linha de base)")
+            continue
+        razao = medida["p50_ms"] / anterior["p50_ms"] if anterior["p50_ms"] else 1.0
+        alertas = []
+        if razao > 1 + tolerancia:
+            alertas.append(f"p50 {razao:.2f}x")
+        if medida["consultas"] > anterior["consultas"]:
+            alertas.append(f"consultas {anterior['consultas']} -> {medida['consultas']}")
+        regrediu = regrediu or bool(alertas)
+        linhas.append(
+            f"{nome:32s} p50 {anterior['p50_ms']:9.2f} -> {medida['p50_ms']:9.2f} ms ({razao:5.2f}x)"
+            + ("  REGRESSÃO: " + "; ".join(alertas) if alertas else "")
+        )
+    return linhas, regrediu
+
+
+def imprimir(resultados):
+    print(f"{'rota':32s} {'p50':>9s} {'p95':>9s} {'p99':>9s} {'máx':>9s} {'sql':>5s} {'bytes':>9s}")
+    for nome, m in resultados.items():
+        print(
+            f"{nome:32s} {m['p50_ms']:9.2f} {m['p95_ms']:9.2f} {m['p99_ms']:9.2f} "
+            f"{m['max_ms']:9.2f} {m['consultas']:5d} {m['bytes']:9d}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark das rotas sobre uma base sintética.")
+    parser.add_argument("--agendamentos", type=int, default=100000)
+    parser.add_argument("--medicos", type=int, default=500)
+    parser.add_argument("--pacientes", type=int, default=20000)
+    parser.add_argument("--semente", type=int, default=42)
+    parser.add_argument("--repeticoes", type=int, default=20)
+    parser.add_argument("--base", help="caminho da base sintética (padrão: diretório temporário)")
+    parser.add_argument("--cache-quente", action="store_true", help="não limpa os caches entre chamadas")
+    parser.add_argument("--rotas", nargs="*", help="mede só as rotas cujo nome contém algum destes trechos")
+    parser.add_argument("--salvar", help="grava os resultados como linha de base (JSON)")
+    parser.add_argument("--comparar", help="compara com uma linha de base gravada com --salvar")
+    parser.add_argument("--tolerancia", type=float, default=0.25, help="piora aceitável do p50 (0.25 = 25%%)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        caminho = args.base or os.path.join(tmp, "benchmark.db")
+        inicio = time.perf_counter()
+        amostra = gerar_clinica(
+            caminho, agendamentos=args.agendamentos, medicos=args.medicos,
+            pacientes=args.pacientes, semente=args.semente,
+        )
+        print(f"base: {amostra['total_agendamentos']} agendamentos em {time.perf_counter() - inicio:.1f}s")
+
+        import main as aplicacao  # importado depois de apontar DB_PATH para a base sintética
+        tarefas = databaser._tarefas_thread
+        if tarefas is not None:  # deixa a primeira rodada terminar e para a thread: nada concorre com a medição
+            tarefas.parar.set()
+            tarefas.join()
+        resultados = medir(
+            aplicacao.main, amostra, repeticoes=args.repeticoes,
+            cache_quente=args.cache_quente, filtro=args.rotas,
+        )
+
+    imprimir(resultados)
+    documento = {
+        "parametros": {
+            "agendamentos": args.agendamentos, "medicos": args.medicos, "pacientes": args.pacientes,
+            "semente": args.semente, "repeticoes": args.repeticoes, "cache_quente": args.cache_quente,
+        },
+        "resultados": resultados,
+    }
+    if args.salvar:
+        with open(args.salvar, "w", encoding="utf-8") as arquivo:
+            json.dump(documento, arquivo, ensure_ascii=False, indent=2)
+        print(f"linha de base gravada em {args.salvar}")
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as arquivo:
+            base = json.load(arquivo)
+        if base.get("parametros") != documento["parametros"]:
+            print("aviso: parâmetros diferentes da linha de base", base.get("parametros"))
+        linhas, regrediu = comparar(resultados, base["resultados"], args.tolerancia)
+        print("\n".join(linhas))
+        return 1 if regrediu else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
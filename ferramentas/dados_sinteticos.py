@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Gera uma base SQLite de clínica sintética e reprodutível (mesma semente, mesmos
+dados) sobre o schema real de databaser.criar_tabelas().
+
+    python -m ferramentas.dados_sinteticos /tmp/clinica.db --agendamentos 100000
+"""
+import argparse
+import math
+import os
+import random
+from datetime import date, timedelta
+
+from werkzeug.security import generate_password_hash
+
+import databaser
+
+SENHA_PADRAO = "12345"
+
+
+def _status_para(dia, hoje, rng):
+    if dia < hoje:
+        return rng.choices(["concluido", "cancelado", "negado"], weights=[80, 15, 5])[0]
+    if dia == hoje:
+        return rng.choices(["agendado", "em atendimento", "concluido", "cancelado"], weights=[50, 10, 30, 10])[0]
+    return rng.choices(["agendado", "cancelado"], weights=[90, 10])[0]
+
+
+def gerar_clinica(caminho, agendamentos=20000, medicos=50, pacientes=2000, salas=None,
+                  dias_passado=365, dias_futuro=60, semente=42, hoje=None):
+    """
+    Cria a base em `caminho` (substituindo a existente) e aponta
+    databaser.DB_PATH para ela. Nenhum médico ou sala fica com dois
+    agendamentos no mesmo horário. Devolve ids úteis para exercitar as rotas.
+    """
+    rng = random.Random(semente)
+    hoje = hoje or date.today()
+    for sufixo in ("", "-wal", "-shm"):
+        if os.path.exists(caminho + sufixo):
+            os.remove(caminho + sufixo)
+    databaser.DB_PATH = caminho
+    databaser.criar_tabelas()
+
+    dias = [hoje + timedelta(days=d) for d in range(-dias_passado, dias_futuro + 1)]
+    grade = databaser.GRADE_HORARIOS
+    por_horario = math.ceil(agendamentos / (len(dias) * len(grade)))
+    salas = max(salas or 0, por_horario + 1, 3)
+    if por_horario > medicos:
+        raise ValueError("médicos insuficientes para o volume de agendamentos sem conflitos")
+
+    senha_hash = generate_password_hash(SENHA_PADRAO)  # uma vez só: o hash é caro
+    conn = databaser._abrir_conexao()
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    cur.executemany(
+        "INSERT OR IGNORE INTO salas (nome, capacidade) VALUES (?, 1)",
+        [(f"Sala {n}",) for n in range(1, salas + 1)],
+    )
+    cur.executemany(
+        "INSERT OR IGNORE INTO procedimentos (nome, descricao) VALUES (?, ?)",
+        [(f"Procedimento {n}", "Gerado para testes") for n in range(1, 6)],
+    )
+    cur.executemany(
+        "INSERT INTO usuarios (nome, email, senha, tipo_usuario) VALUES (?, ?, ?, 'medico')",
+        [(f"Médico {n:04d}", f"medico{n}@sintetico.test", senha_hash) for n in range(1, medicos + 1)],
+    )
+    cur.executemany(
+        "INSERT INTO usuarios (nome, email, senha, tipo_usuario) VALUES (?, ?, ?, 'paciente')",
+        [(f"Paciente {n:05d}", f"paciente{n}@sintetico.test", senha_hash) for n in range(1, pacientes + 1)],
+    )
+    ids_medicos = [row[0] for row in cur.execute("SELECT id FROM usuarios WHERE tipo_usuario='medico' ORDER BY id")]
+    ids_pacientes = [row[0] for row in cur.execute("SELECT id FROM usuarios WHERE tipo_usuario='paciente' ORDER BY id")]
+    ids_salas = [row[0] for row in cur.execute("SELECT id FROM salas ORDER BY id")]
+    ids_procedimentos = [row[0] for row in cur.execute("SELECT id FROM procedimentos ORDER BY id")]
+    convenios = ["Particular", "Unimed", "Amil", "Bradesco Saúde", "SulAmérica", None]
+
+    linhas = []
+    restantes = agendamentos
+    for posicao, dia in enumerate(dias):
+        dia_str = dia.isoformat()
+        # distribui o que falta pelos dias restantes, horário a horário
+        cota_dia = math.ceil(restantes / (len(dias) - posicao)) if restantes else 0
+        for indice, hora in enumerate(grade):
+            cota = math.ceil(cota_dia / (len(grade) - indice)) if cota_dia else 0
+            cota = min(cota, len(ids_salas), len(ids_medicos))
+            if not cota:
+                continue
+            for medico_id, sala_id in zip(rng.sample(ids_medicos, cota), rng.sample(ids_salas, cota)):
+                linhas.append((
+                    rng.choice(ids_pacientes), medico_id, rng.choice(ids_procedimentos), sala_id,
+                    dia_str, hora, _status_para(dia, hoje, rng), rng.choice(convenios),
+                ))
+            cota_dia -= cota
+            restantes -= cota
+    cur.executemany(
+        """INSERT INTO agendamentos
+               (paciente_id, medico_id, procedimento_id, sala_id, data, hora, status, convenio)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+        linhas,
+    )
+
+    # histórico de chamadas (concluídos) e chamadas do dia (em atendimento)
+    cur.execute(
+        "SELECT id, medico_id, paciente_id, data, status FROM agendamentos WHERE status IN ('concluido', 'em atendimento')"
+    )
+    chamadas = []
+    for ag_id, medico_id, paciente_id, dia_str, status in cur.fetchall():
+        if status == "em atendimento":
+            chamadas.append((ag_id, medico_id, paciente_id, "pendente", f"{dia_str}T08:00:00", None))
+        elif rng.random() < 0.3:
+            chamadas.append((ag_id, medico_id, paciente_id, "encaminhado", f"{dia_str}T08:00:00", f"{dia_str}T08:05:00"))
+    cur.executemany(
+        """INSERT INTO chamadas_pacientes
+               (agendamento_id, medico_id, paciente_id, status, criado_em, encaminhado_em)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        chamadas,
+    )
+
+    # pedidos de ajuste pendentes para parte dos agendamentos futuros
+    cur.execute("SELECT id, data, hora FROM agendamentos WHERE data > ? AND status='agendado'", (hoje.isoformat(),))
+    futuros = cur.fetchall()
+    ajustes = [
+        (ag_id, (date.fromisoformat(dia_str) + timedelta(days=1)).isoformat(), hora, "Gerado para testes",
+         f"{hoje.isoformat()}T07:00:00")
+        for ag_id, dia_str, hora in rng.sample(futuros, min(len(futuros), max(1, len(futuros) // 50)))
+    ]
+    cur.executemany(
+        """INSERT INTO agendamento_ajustes (agendamento_id, novo_dia, nova_hora, motivo, status, criado_em)
+           VALUES (?, ?, ?, ?, 'pendente', ?)""",
+        ajustes,
+    )
+    conn.commit()
+
+    amostra = {
+        "recepcionista_id": cur.execute(
+            "SELECT id FROM usuarios WHERE email='recepcionistamaster@gmail.com'"
+        ).fetchone()[0],
+        "medico_id": ids_medicos[0],
+        "sala_id": ids_salas[0],
+        "procedimento_id": ids_procedimentos[0],
+    }
+    row = cur.execute(
+        "SELECT id, paciente_id FROM agendamentos WHERE data > ? AND status='agendado' ORDER BY id LIMIT 1",
+        (hoje.isoformat(),),
+    ).fetchone()
+    amostra["agendamento_id"], amostra["paciente_id"] = row
+    row = cur.execute(
+        "SELECT id, medico_id FROM agendamentos WHERE data=? AND status='agendado' ORDER BY id LIMIT 1",
+        (hoje.isoformat(),),
+    ).fetchone()
+    amostra["agendamento_hoje_id"], amostra["medico_hoje_id"] = row if row else (None, None)
+    amostra["ajuste_id"] = cur.execute("SELECT MIN(id) FROM agendamento_ajustes WHERE status='pendente'").fetchone()[0]
+    amostra["chamada_id"] = cur.execute("SELECT MIN(id) FROM chamadas_pacientes WHERE status='pendente'").fetchone()[0]
+    amostra["total_agendamentos"] = len(linhas)
+    conn.fechar_de_fato()
+    return amostra
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Gera uma base sintética da clínica.")
+    parser.add_argument("caminho")
+    parser.add_argument("--agendamentos", type=int, default=20000)
+    parser.add_argument("--medicos", type=int, default=50)
+    parser.add_argument("--pacientes", type=int, default=2000)
+    parser.add_argument("--semente", type=int, default=42)
+    args = parser.parse_args(argv)
+    amostra = gerar_clinica(
+        args.caminho, agendamentos=args.agendamentos, medicos=args.medicos,
+        pacientes=args.pacientes, semente=args.semente,
+    )
+    print(f"{amostra['total_agendamentos']} agendamentos gerados em {args.caminho}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
+import os
+
 from flask import Flask, render_template
-from databaser import criar_tabelas
+from databaser import criar_tabelas, init_app, iniciar_tarefas_periodicas
+from metricas import init_metricas
 from routes.user import user_bp
 
-# garante estrutura + seeds idempotentes
+# aplica migrações pendentes (PRAGMA user_version); nas requisições não há DDL
 criar_tabelas()
+# normaliza dados legados e conclui consultas vencidas em segundo plano, fora das páginas;
+# só no servidor: importar main (testes, CLI, benchmark) não liga a thread
+if __name__ == '__main__' or os.environ.get('CLINICA_TAREFAS_PERIODICAS') == '1':
+    iniciar_tarefas_periodicas()
 
 main = Flask(__name__)
 main.secret_key = 'minha_chave_super_secreta_123'  # troque em produção
+init_app(main)  # conexão SQLite por requisição, devolvida ao pool no teardown
+init_metricas(main)  # latência/SQL por endpoint em /metrics (formato Prometheus)
 
 @main.route('/')
 def telaInicial():
@@ -0,0 +1,164 @@
+"""
+Métricas por endpoint no formato texto do Prometheus (GET /metrics).
+
+Para cada endpoint (ex.: user.visao_recepcionista) registra um histograma de
+latência, o nº de comandos SQL, o tempo gasto no SQLite e os bytes enviados.
+A coleta é só aritmética em memória sob um lock, então fica sempre ligada.
+Conexões de eventos (text/event-stream) ficam de fora: abertas por horas,
+distorceriam o histograma.
+
+Acesso: cabeçalho `Authorization: Bearer <METRICAS_TOKEN>` (variável de
+ambiente, para o coletor) ou sessão de recepcionista master.
+"""
+import hmac
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+from flask import Response, abort, g, request, session
+
+# limites do histograma de latência, em segundos
+LIMITES_LATENCIA_S = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_series = {}  # endpoint -> _Serie
+
+
+class _Serie:
+    __slots__ = ("baldes", "soma_s", "total", "sql_comandos", "sql_tempo_s", "bytes")
+
+    def __init__(self):
+        self.baldes = [0] * (len(LIMITES_LATENCIA_S) + 1)  # o último é +Inf
+        self.soma_s = 0.0
+        self.total = 0
+        self.sql_comandos = 0
+        self.sql_tempo_s = 0.0
+        self.bytes = 0
+
+
+def registrar(endpoint, duracao_s, sql_comandos, sql_tempo_s, tamanho):
+    with _lock:
+        serie = _series.get(endpoint)
+        if serie is None:
+            serie = _series[endpoint] = _Serie()
+        serie.baldes[bisect_left(LIMITES_LATENCIA_S, duracao_s)] += 1  # primeiro limite >= duração
+        serie.soma_s += duracao_s
+        serie.total += 1
+        serie.sql_comandos += sql_comandos
+        serie.sql_tempo_s += sql_tempo_s
+        serie.bytes += tamanho
+
+
+def limpar():
+    with _lock:
+        _series.clear()
+
+
+def _rotulo(valor):
+    return valor.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def exposicao():
+    """Texto no formato de exposição do Prometheus (versão 0.0.4)."""
+    with _lock:
+        copia = {
+            endpoint: (list(s.baldes), s.soma_s, s.total, s.sql_comandos, s.sql_tempo_s, s.bytes)
+            for endpoint, s in _series.items()
+        }
+    linhas = [
+        "# HELP clinica_requisicao_duracao_segundos Latência das requisições por endpoint.",
+        "# TYPE clinica_requisicao_duracao_segundos histogram",
+    ]
+    for endpoint, (baldes, soma_s, total, *_resto) in sorted(copia.items()):
+        rotulo = _rotulo(endpoint)
+        acumulado = 0
+        for limite, quantidade in zip(LIMITES_LATENCIA_S, baldes):
+            acumulado += quantidade
+            linhas.append(f'clinica_requisicao_duracao_segundos_bucket{{endpoint="{rotulo}",le="{limite}"}} {acumulado}')
+        linhas.append(f'clinica_requisicao_duracao_segundos_bucket{{endpoint="{rotulo}",le="+Inf"}} {total}')
+        linhas.append(f'clinica_requisicao_duracao_segundos_sum{{endpoint="{rotulo}"}} {soma_s:.6f}')
+        linhas.append(f'clinica_requisicao_duracao_segundos_count{{endpoint="{rotulo}"}} {total}')
+
+    contadores = (
+        ("clinica_sql_comandos_total", "Comandos SQL executados pelas requisições.", 3, "{}"),
+        ("clinica_sql_duracao_segundos_total", "Tempo gasto no SQLite (execute e fetch).", 4, "{:.6f}"),
+        ("clinica_resposta_bytes_total", "Bytes de corpo enviados nas respostas.", 5, "{}"),
+    )
+    for nome, ajuda, indice, formato in contadores:
+        linhas.append(f"# HELP {nome} {ajuda}")
+        linhas.append(f"# TYPE {nome} counter")
+        for endpoint, valores in sorted(copia.items()):
+            linhas.append(f'{nome}{{endpoint="{_rotulo(endpoint)}"}} {formato.format(valores[indice])}')
+    return "\n".join(linhas) + "\n"
+
+
+def _medir_streaming(corpo, endpoint, inicio, medicao):
+    enviados = 0
+    try:
+        for parte in corpo:
+            enviados += len(parte)
+            yield parte
+    finally:  # também quando o cliente desiste no meio
+        registrar(
+            endpoint, perf_counter() - inicio,
+            medicao.comandos if medicao else 0, medicao.tempo_s if medicao else 0.0, enviados,
+        )
+
+
+def _antes():
+    # a medição de SQL (g._medicao_sql) é iniciada por databaser.init_app
+    g._metricas_inicio = perf_counter()
+
+
+def _depois(response):
+    if response.mimetype == "text/event-stream":
+        g._metricas_streaming = True  # nada a registrar, nem em _finalizar
+    elif response.is_streamed:
+        # CSV em streaming: o SQL roda enquanto o corpo é enviado, então a
+        # requisição é registrada quando o último pedaço sai
+        response.response = _medir_streaming(
+            response.iter_encoded(), request.endpoint, g._metricas_inicio, g.get("_medicao_sql"),
+        )
+        g._metricas_streaming = True
+    else:
+        g._metricas_bytes = response.content_length or 0
+    return response
+
+
+def _finalizar(_exc=None):
+    if g.get("_metricas_streaming"):
+        return  # registrado por _medir_streaming
+    inicio = g.pop("_metricas_inicio", None)
+    if inicio is None:
+        return
+    medicao = g.pop("_medicao_sql", None)
+    registrar(
+        request.endpoint or "sem_rota",
+        perf_counter() - inicio,
+        medicao.comandos if medicao else 0,
+        medicao.tempo_s if medicao else 0.0,
+        g.pop("_metricas_bytes", 0),
+    )
+
+
+def _autorizado():
+    token = os.environ.get("METRICAS_TOKEN")
+    cabecalho = request.headers.get("Authorization", "")
+    if token and hmac.compare_digest(cabecalho, f"Bearer {token}"):
+        return True
+    return (session.get("usuario_tipo") or "").lower() == "recepcionista master"
+
+
+def metricas():
+    if not _autorizado():
+        abort(401)
+    return Response(exposicao(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+
+def init_metricas(app):
+    """Liga a coleta em todas as requisições (app e blueprints) e expõe /metrics."""
+    app.before_request(_antes)
+    app.after_request(_depois)
+    app.teardown_request(_finalizar)
+    app.add_url_rule("/metrics", "metricas", metricas)
@@ -1,22 +1,33 @@
 # -*- coding: utf-8 -*-
-import re
+import base64
 import csv
 import io
+import json
 import sqlite3
 import calendar
+import re
 
 from flask import (
     Blueprint, redirect, render_template, request, session,
-    url_for, flash, jsonify
+    url_for, flash, jsonify, Response, stream_with_context
 )
 from functools import wraps
 from datetime import datetime, date, timedelta
 from werkzeug.security import check_password_hash, generate_password_hash
 
 from databaser import (
-    conectar, criar_tabelas, horarios_disponiveis, get_busy_slots,
-    is_slot_available, sugerir_proximo_horario, auto_close_past_appointments
+    conectar, horarios_disponiveis, get_busy_slots,
+    sugerir_proximo_horario, sugerir_horarios, invalidar_disponibilidade,
+    transacao_agenda, HorarioIndisponivel, GRADE_HORARIOS,
+    grade_disponibilidade, ocupacao_em_lote, HORIZONTE_SUGESTAO_DIAS,
+    referencias, invalidar_referencias, registrar_convenio, buscar_usuarios,
+    normalizar_status, normalizar_data, normalizar_hora, minutos_do_horario, ja_passou,
+    minutos_de, datas_da_serie, planejar_serie, dia_da_data, data_do_dia,
+    salas_livres_no_dia, SALA_QUALQUER, DURACAO_PADRAO_MIN, MAX_DURACAO_MIN,
+    MINUTOS_POR_DIA, STATUS_ABERTOS, recuar_marca_fechamento, IntervalosDia,
+    cabe_no_expediente
 )
+from eventos import chamadas as canal_chamadas, formatar_sse
 
 STATUS_AGENDAMENTO = [
     ("agendado", "Agendado"),
@@ -25,23 +36,83 @@ STATUS_AGENDAMENTO = [
     ("cancelado", "Cancelado"),
 ]
 STATUS_LABELS = {valor: rotulo for valor, rotulo in STATUS_AGENDAMENTO}
-CONFLICT_TOKENS = ("<<<<<<<", "=======", ">>>>>>>")
-
-
-def _parse_datetime(data_str: str, hora_str: str):
-    return datetime.strptime(f"{data_str} {hora_str}", "%Y-%m-%d %H:%M")
+MAX_HORIZONTE_SUGESTAO_DIAS = 62
+MAX_SUGESTOES = 20
+MAX_DIAS_GRADE = 31
+TAMANHO_LOTE_EXPORTACAO = 500
+TAMANHO_PAGINA = 50
+MAX_TAMANHO_PAGINA = 200
+MAX_LOTE_AGENDAMENTOS = 500
+INTERVALO_RECONEXAO_MS = 3000
+MAX_RESULTADOS_BUSCA = 50
+CONFLITOS_SERIE = ("alternativa", "pular")
+MAX_DESLOCAMENTO_SERIE_DIAS = 366
+_DATA_ISO = re.compile(r"\d{4}-\d{2}-\d{2}")
+MSG_FIM_ATENDIMENTO = "O procedimento terminaria depois das 17:30; escolha um horário mais cedo."
 
 
 def _validar_data_hora_futura(data_str: str, hora_str: str):
     try:
-        dt_alvo = _parse_datetime(_normalizar_data(data_str), _normalizar_hora(hora_str))
-    except Exception:
+        alvo = minutos_do_horario(normalizar_data(data_str), normalizar_hora(hora_str))
+    except (TypeError, ValueError):
         return False, "Data ou hora inválidas."
-    if dt_alvo < datetime.now():
+    if ja_passou(alvo):
         return False, "Data ou horário no passado não são permitidos."
     return True, ""
 
 
+def _termina_no_expediente(data_str, hora_str, duracao_min):
+    """O procedimento marcado em data/hora (já validadas) termina até 17:30?"""
+    return cabe_no_expediente(minutos_do_horario(data_str, hora_str) % MINUTOS_POR_DIA, duracao_min)
+
+
+def _convenio_do_procedimento(procedimento_nome, procedimento_raw, convenio_informado):
+    """Convênio gravado no agendamento: consultas particulares, de convênio e receitas têm valor fixo."""
+    nome_lower = (procedimento_nome or "").lower()
+    if "convênio" in nome_lower or "convenio" in nome_lower or procedimento_raw == "__convenio__":
+        return convenio_informado or "Convênio"
+    if "particular" in nome_lower or procedimento_raw == "__particular__":
+        return "Particular"
+    if "receita" in nome_lower or procedimento_raw == "__receita__":
+        return "Receita"
+    return convenio_informado or None
+
+
+def _reservar_sala(cur, data_str, hora_str, medico_id, sala_id, duracao_min=DURACAO_PADRAO_MIN):
+    """
+    Sala do agendamento: a informada ou, com SALA_QUALQUER, a menos ocupada
+    entre as livres durante todo o procedimento. Sem sala livre (ou com o
+    médico ocupado), HorarioIndisponivel. Chamada dentro de transacao_agenda.
+    """
+    if sala_id != SALA_QUALQUER:
+        return sala_id
+    livres = salas_livres_no_dia(cur, data_str, medico_id, horas=(hora_str,), duracao_min=duracao_min).get(hora_str)
+    if not livres:
+        raise HorarioIndisponivel("nenhuma sala livre no horário")
+    return livres[0]
+
+
+def _duracao_procedimento(procedimento_id):
+    """Duração em minutos do procedimento (a padrão se não for encontrado)."""
+    procedimento_id = str(procedimento_id or "").strip()
+    return next((row["duracao_min"] for row in referencias("procedimentos")
+                 if procedimento_id.isdigit() and row["id"] == int(procedimento_id)), DURACAO_PADRAO_MIN)
+
+
+def _ler_duracao(valor):
+    """Duração informada no formulário de procedimentos -> minutos, ou None se inválida."""
+    valor = (valor or "").strip()
+    if not valor:
+        return DURACAO_PADRAO_MIN
+    if not valor.isdigit() or not 1 <= int(valor) <= MAX_DURACAO_MIN:
+        return None
+    return int(valor)
+
+
+def _nome_sala(sala_id):
+    return next((row["nome"] for row in referencias("salas") if row["id"] == int(sala_id)), "")
+
+
 def _aplicar_intervalo_mes(filtros):
     inicio = filtros.get("inicio") or ""
     fim = filtros.get("fim") or ""
@@ -63,7 +134,7 @@ def _aplicar_intervalo_mes(filtros):
     return filtros
 
 
-def _buscar_agendamentos_filtrados(filtros):
+def _condicoes_agendamentos(filtros):
     filtros = _aplicar_intervalo_mes(dict(filtros))
     condicoes = []
     params = []
@@ -85,144 +156,253 @@ def _buscar_agendamentos_filtrados(filtros):
     if filtros.get("convenio"):
         condicoes.append("COALESCE(a.convenio, '') LIKE ?")
         params.append(f"%{filtros['convenio']}%")
-
-    base_query = """
-        SELECT a.id, a.data, a.hora, a.status, a.convenio,
-               pac.nome AS paciente, med.nome AS medico, pr.nome AS procedimento
-        FROM agendamentos a
-        JOIN usuarios pac ON pac.id = a.paciente_id
-        JOIN usuarios med ON med.id = a.medico_id
-        JOIN procedimentos pr ON pr.id = a.procedimento_id
-    """
+    return condicoes, params, filtros
+
+
+SELECT_AGENDAMENTOS_FILTRADOS = """
+    SELECT a.id, a.data, a.hora, a.status, a.convenio,
+           pac.nome AS paciente, med.nome AS medico, pr.nome AS procedimento
+    FROM agendamentos a
+    JOIN usuarios pac ON pac.id = a.paciente_id
+    JOIN usuarios med ON med.id = a.medico_id
+    JOIN procedimentos pr ON pr.id = a.procedimento_id
+"""
+
+SELECT_AGENDAMENTOS_PROCEDIMENTOS = """
+    SELECT a.id, a.data, a.hora, a.status,
+           a.medico_id, a.sala_id, a.procedimento_id,
+           pac.nome AS paciente, med.nome AS medico,
+           pr.nome AS procedimento, s.nome AS sala
+    FROM agendamentos a
+    JOIN usuarios pac ON pac.id = a.paciente_id
+    JOIN usuarios med ON med.id = a.medico_id
+    JOIN procedimentos pr ON pr.id = a.procedimento_id
+    JOIN salas s ON s.id = a.sala_id
+"""
+
+
+def _consulta_agendamentos_filtrados(filtros):
+    condicoes, params, filtros = _condicoes_agendamentos(filtros)
+    base_query = SELECT_AGENDAMENTOS_FILTRADOS
     if condicoes:
         base_query += " WHERE " + " AND ".join(condicoes)
-    base_query += " ORDER BY a.data, a.hora"
-
-    conn = conectar()
-    cur = conn.cursor()
-    cur.execute(base_query, params)
-    linhas = cur.fetchall()
-    conn.close()
-
-    status_validos = {valor for valor, _rotulo in STATUS_AGENDAMENTO}
-    agendamentos_filtrados = []
-    for row in linhas:
-        registro = dict(row)
-        status_normalizado = _normalizar_status(registro.get("status", ""), status_validos)
-        registro["status"] = status_normalizado
-        if isinstance(status_normalizado, str):
-            registro["status_label"] = STATUS_LABELS.get(status_normalizado, status_normalizado.title())
-        else:
-            registro["status_label"] = status_normalizado
-        registro["data_display"] = _formatar_data_display(registro.get("data"))
-        registro["convenio"] = registro.get("convenio") or "—"
-        agendamentos_filtrados.append(registro)
-
-    totais_filtrados = {
-        "total": len(agendamentos_filtrados),
-        "concluidos": 0,
-        "cancelados": 0,
-        "agendados": 0,
-    }
-    for item in agendamentos_filtrados:
-        status_val = (item.get("status") or "").lower()
-        if status_val == "concluido":
-            totais_filtrados["concluidos"] += 1
-        elif status_val == "cancelado":
-            totais_filtrados["cancelados"] += 1
-        elif status_val:
-            totais_filtrados["agendados"] += 1
-    totais_filtrados["realizados"] = totais_filtrados["concluidos"]
-
-    return agendamentos_filtrados, totais_filtrados, filtros
-
-
-def _remover_marcadores_conflito(valor):
-    if not isinstance(valor, str):
-        return valor
-    texto = valor.strip()
-    if not texto:
-        return texto
-    if not any(token in texto for token in CONFLICT_TOKENS):
-        return texto
-
-    blocos = []
-    trecho_atual = []
-    for linha in texto.splitlines():
-        if linha.startswith("<<<<<<<"):
-            trecho_atual = []
-            continue
-        if linha.startswith("======="):
-            blocos.append("\n".join(trecho_atual).strip())
-            trecho_atual = []
-            continue
-        if linha.startswith(">>>>>>>"):
-            blocos.append("\n".join(trecho_atual).strip())
-            trecho_atual = []
-            continue
-        trecho_atual.append(linha)
-
-    if trecho_atual:
-        blocos.append("\n".join(trecho_atual).strip())
+    base_query += " ORDER BY a.data, a.hora, a.id"
+    return base_query, params, filtros
 
-    for bloco in blocos:
-        if bloco:
-            return bloco
 
-    return texto.replace("<<<<<<<", "").replace("=======", "").replace(">>>>>>>", "").strip()
+# ------------------ Paginação por seek em (data, hora, id) ------------------
+def _codificar_cursor(row):
+    bruto = json.dumps([row["data"], row["hora"], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(bruto.encode()).decode().rstrip("=")
 
 
-def _normalizar_status(valor, validos):
-    texto = (_remover_marcadores_conflito(valor) or "").strip().lower()
-    if not texto:
-        return "agendado" if "agendado" in validos else (next(iter(validos)) if validos else texto)
+def _decodificar_cursor(token):
+    if not token:
+        return None
+    try:
+        bruto = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        data_, hora_, id_ = json.loads(bruto)
+        return str(data_), str(hora_), int(id_)
+    except (ValueError, TypeError):
+        return None  # token adulterado: volta para a primeira página
 
-    if texto in validos:
-        return texto
 
-    for candidato in validos:
-        if candidato in texto:
-            return candidato
+def _parametros_pagina(args):
+    """(tamanho, cursor, direção) a partir de ?por_pagina, ?apos e ?antes."""
+    try:
+        tamanho = int(args.get("por_pagina") or TAMANHO_PAGINA)
+    except ValueError:
+        tamanho = TAMANHO_PAGINA
+    tamanho = max(1, min(tamanho, MAX_TAMANHO_PAGINA))
+    antes = _decodificar_cursor(args.get("antes"))
+    if antes:
+        return tamanho, antes, "antes"
+    return tamanho, _decodificar_cursor(args.get("apos")), "apos"
 
-    return texto
 
+def _paginar_agendamentos(cur, select_sql, condicoes, params, tamanho, cursor, direcao):
+    """
+    Lê uma página a partir do cursor pelo índice (data, hora), sem OFFSET:
+    o custo não cresce com a posição. Busca uma linha a mais para saber se
+    existe página seguinte. Devolve (linhas, pagina) com os tokens
+    'anterior' e 'proxima' (None quando não há).
+    """
+    condicoes = list(condicoes)
+    params = list(params)
+    if cursor:
+        condicoes.append(f"(a.data, a.hora, a.id) {'>' if direcao == 'apos' else '<'} (?, ?, ?)")
+        params.extend(cursor)
+    ordem = "ASC" if direcao == "apos" else "DESC"
+    sql = select_sql
+    if condicoes:
+        sql += " WHERE " + " AND ".join(condicoes)
+    sql += f" ORDER BY a.data {ordem}, a.hora {ordem}, a.id {ordem} LIMIT ?"
+    cur.execute(sql, params + [tamanho + 1])
+    linhas = cur.fetchall()
+    ha_mais = len(linhas) > tamanho
+    linhas = linhas[:tamanho]
+    if direcao == "antes":
+        linhas.reverse()
+
+    pagina = {"tamanho": tamanho, "anterior": None, "proxima": None, "deslocada": cursor is not None}
+    if linhas:
+        tem_anterior = ha_mais if direcao == "antes" else cursor is not None
+        tem_proxima = ha_mais if direcao == "apos" else True
+        if tem_anterior:
+            pagina["anterior"] = _codificar_cursor(linhas[0])
+        if tem_proxima:
+            pagina["proxima"] = _codificar_cursor(linhas[-1])
+    return linhas, pagina
+
+
+def _links_pagina(endpoint, pagina, **args):
+    """Acrescenta à página as URLs de navegação, preservando os filtros."""
+    args = {chave: valor for chave, valor in args.items() if valor}
+    if pagina["tamanho"] != TAMANHO_PAGINA:
+        args["por_pagina"] = pagina["tamanho"]
+    pagina["url_inicio"] = url_for(endpoint, **args) if pagina["deslocada"] else None
+    pagina["url_anterior"] = url_for(endpoint, antes=pagina["anterior"], **args) if pagina["anterior"] else None
+    pagina["url_proxima"] = url_for(endpoint, apos=pagina["proxima"], **args) if pagina["proxima"] else None
+    return pagina
+
+
+def _totais_agendamentos(cur, condicoes, params, filtros):
+    """
+    Totais por status do filtro inteiro, fora da página. Filtros só de período
+    e médico saem das contagens materializadas (contagem_diaria /
+    contagem_medico); os demais contam agendamentos agrupando por status.
+    """
+    if filtros.get("paciente") or filtros.get("procedimento") or filtros.get("convenio"):
+        sql = "SELECT a.status, COUNT(*) AS total FROM agendamentos a"
+        if condicoes:
+            sql += " WHERE " + " AND ".join(condicoes)
+        cur.execute(sql + " GROUP BY a.status", params)
+    elif filtros.get("inicio") or filtros.get("fim"):
+        # mesmas condições, nas colunas homônimas de contagem_diaria
+        cur.execute(
+            "SELECT status, SUM(total) AS total FROM contagem_diaria a WHERE "
+            + " AND ".join(condicoes) + " GROUP BY status",
+            params,
+        )
+    elif filtros.get("medico"):
+        cur.execute(
+            "SELECT status, total FROM contagem_medico WHERE medico_id = ?",
+            (filtros["medico"],),
+        )
+    else:
+        cur.execute("SELECT status, SUM(total) AS total FROM contagem_medico GROUP BY status")
+    por_status = {row["status"]: row["total"] or 0 for row in cur.fetchall()}
+
+    totais = _novos_totais()
+    totais["total"] = sum(por_status.values())
+    totais["concluidos"] = totais["realizados"] = por_status.get("concluido", 0)
+    totais["cancelados"] = por_status.get("cancelado", 0)
+    totais["agendados"] = totais["total"] - totais["concluidos"] - totais["cancelados"]
+    return totais
+
+
+def _formatar_agendamento_filtrado(row, status_validos):
+    registro = dict(row)
+    status_normalizado = normalizar_status(registro.get("status", ""), status_validos)
+    registro["status"] = status_normalizado
+    if isinstance(status_normalizado, str):
+        registro["status_label"] = STATUS_LABELS.get(status_normalizado, status_normalizado.title())
+    else:
+        registro["status_label"] = status_normalizado
+    registro["data_display"] = _formatar_data_display(registro.get("data"))
+    registro["convenio"] = registro.get("convenio") or "—"
+    return registro
+
+
+def _novos_totais():
+    return {"total": 0, "concluidos": 0, "cancelados": 0, "agendados": 0, "realizados": 0}
+
+
+def _contabilizar_status(totais, status):
+    totais["total"] += 1
+    status_val = (status or "").lower()
+    if status_val == "concluido":
+        totais["concluidos"] += 1
+    elif status_val == "cancelado":
+        totais["cancelados"] += 1
+    elif status_val:
+        totais["agendados"] += 1
+    totais["realizados"] = totais["concluidos"]
+
+
+def _buscar_agendamentos_filtrados(filtros, tamanho=TAMANHO_PAGINA, cursor=None, direcao="apos"):
+    condicoes, params, filtros = _condicoes_agendamentos(filtros)
 
-def _normalizar_data(valor):
-    texto = (_remover_marcadores_conflito(valor) or "").strip()
-    if not texto:
-        return texto
+    conn = conectar()
+    cur = conn.cursor()
+    linhas, pagina = _paginar_agendamentos(
+        cur, SELECT_AGENDAMENTOS_FILTRADOS, condicoes, params, tamanho, cursor, direcao
+    )
+    totais_filtrados = _totais_agendamentos(cur, condicoes, params, filtros)
+    conn.close()
 
-    match_iso = re.search(r"\b\d{4}-\d{2}-\d{2}\b", texto)
-    if match_iso:
-        return match_iso.group(0)
+    status_validos = {valor for valor, _rotulo in STATUS_AGENDAMENTO}
+    agendamentos_filtrados = [_formatar_agendamento_filtrado(row, status_validos) for row in linhas]
+    return agendamentos_filtrados, totais_filtrados, filtros, pagina
 
-    match_br = re.search(r"\b\d{2}/\d{2}/\d{4}\b", texto)
-    if match_br:
-        dia, mes, ano = match_br.group(0).split("/")
-        return f"{ano}-{mes}-{dia}"
 
-    return texto
+def _gerar_csv_relatorio(base_query, params):
+    """Escreve o CSV lote a lote (fetchmany); os totais vêm de contadores corridos."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
 
+    def _descarregar():
+        trecho = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return trecho
 
-def _normalizar_hora(valor):
-    texto = (_remover_marcadores_conflito(valor) or "").strip()
-    if not texto:
-        return texto
+    writer.writerow([
+        "Data",
+        "Hora",
+        "Paciente",
+        "Médico",
+        "Procedimento",
+        "Convênio",
+        "Status",
+    ])
+    yield _descarregar()
 
-    match_hora = re.search(r"\b\d{2}:\d{2}\b", texto)
-    if match_hora:
-        return match_hora.group(0)
+    status_validos = {valor for valor, _rotulo in STATUS_AGENDAMENTO}
+    totais = _novos_totais()
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute(base_query, params)
+    while True:
+        lote = cur.fetchmany(TAMANHO_LOTE_EXPORTACAO)
+        if not lote:
+            break
+        for row in lote:
+            linha = _formatar_agendamento_filtrado(row, status_validos)
+            _contabilizar_status(totais, linha.get("status"))
+            writer.writerow([
+                linha.get("data"),
+                linha.get("hora"),
+                linha.get("paciente"),
+                linha.get("medico"),
+                linha.get("procedimento"),
+                linha.get("convenio"),
+                linha.get("status_label"),
+            ])
+        yield _descarregar()
+    cur.close()
+    conn.close()
 
-    return texto
+    writer.writerow([])
+    writer.writerow(["Totais", totais.get("total"), "Realizados", totais.get("realizados"), "Cancelados", totais.get("cancelados"), "Em aberto", totais.get("agendados")])
+    yield _descarregar()
 
 
 def _formatar_data_display(valor):
-    if not valor:
-        return valor
-    try:
-        return datetime.strptime(valor, "%Y-%m-%d").strftime("%d/%m/%Y")
-    except ValueError:
+    # chamada linha a linha em listas e no CSV: só fatia o texto 'AAAA-MM-DD'
+    if not valor or not _DATA_ISO.fullmatch(valor):
         return valor
+    return f"{valor[8:10]}/{valor[5:7]}/{valor[:4]}"
 
 # NOME DO BLUEPRINT *deve* ser "user" para os endpoints ficarem "user.*"
 user_bp = Blueprint('user', __name__, template_folder='templates')
@@ -315,6 +495,7 @@ def register():
         )
         conn.commit()
         conn.close()
+        invalidar_referencias("usuarios")
 
         flash("Cadastro realizado! Faça login para continuar.", "success")
         return redirect(url_for("user.user"))
@@ -326,29 +507,18 @@ def register():
 @user_bp.route("/agendar_consulta", methods=["GET", "POST"], endpoint="agendar_consulta")
 @login_required(role='recepcionista')
 def agendar_consulta():
-    criar_tabelas()  # garante estrutura + seeds (idempotente)
-
-    conn = conectar()
-    cur = conn.cursor()
-
-    # Carrega dados para o GET (render) e também para recarregar após POST clássico
-    cur.execute("SELECT id, nome FROM usuarios WHERE tipo_usuario = 'paciente'")
-    pacientes = cur.fetchall()
-    cur.execute("SELECT id, nome FROM usuarios WHERE tipo_usuario IN ('medico','médico')")
-    medicos = cur.fetchall()
-    cur.execute("SELECT id, nome FROM procedimentos")
-    procedimentos = cur.fetchall()
-    cur.execute("SELECT id, nome FROM salas")
-    salas = cur.fetchall()
-
-    # Se for GET, só renderiza
+    # Se for GET, só renderiza (listas vêm do cache de referências)
     if request.method == "GET":
-        conn.close()
         return render_template(
             "agendamentoConsulta.html",
-            pacientes=pacientes, medicos=medicos, procedimentos=procedimentos, salas=salas
+            medicos=referencias("medicos"),
+            procedimentos=referencias("procedimentos"),
+            salas=referencias("salas"),
         )
 
+    conn = conectar()
+    cur = conn.cursor()
+
     # POST: aceita tanto formulário normal quanto JSON/AJAX
     is_ajax = request.headers.get("X-Requested-With") == "XMLHttpRequest" or request.is_json
     data_in = request.get_json(silent=True) if request.is_json else request.form
@@ -388,18 +558,12 @@ def agendar_consulta():
                 cur.execute("INSERT INTO procedimentos (nome, descricao) VALUES (?, ?)", (nome, ""))
                 conn.commit()
                 procedimento_id = str(cur.lastrowid)
+                invalidar_referencias("procedimentos")
 
         cur.execute("SELECT nome FROM procedimentos WHERE id = ?", (procedimento_id,))
         row_proc = cur.fetchone()
         procedimento_nome = (row_proc["nome"] if row_proc else "")
-        nome_lower = (procedimento_nome or "").lower()
-        convenio_valor = convenio_informado or None
-        if "convênio" in nome_lower or "convenio" in nome_lower or procedimento_raw == "__convenio__":
-            convenio_valor = convenio_informado or "Convênio"
-        elif "particular" in nome_lower or procedimento_raw == "__particular__":
-            convenio_valor = "Particular"
-        elif "receita" in nome_lower or procedimento_raw == "__receita__":
-            convenio_valor = "Receita"
+        convenio_valor = _convenio_do_procedimento(procedimento_nome, procedimento_raw, convenio_informado)
 
         valido, msg = _validar_data_hora_futura(data_, hora_)
         if not valido:
@@ -410,27 +574,40 @@ def agendar_consulta():
             conn.close()
             return redirect(url_for("user.agendar_consulta"))
 
-        if not is_slot_available(data_, hora_, int(medico_id), int(sala_id)):
+        # formato canônico: é nele que os índices únicos comparam os horários
+        data_, hora_ = normalizar_data(data_), normalizar_hora(hora_)
+        duracao = _duracao_procedimento(procedimento_id)
+        if not _termina_no_expediente(data_, hora_, duracao):
+            conn.close()
+            if is_ajax:
+                return jsonify({"ok": False, "msg": MSG_FIM_ATENDIMENTO}), 400
+            flash(MSG_FIM_ATENDIMENTO, "danger")
+            return redirect(url_for("user.agendar_consulta"))
+
+        # insere; choque de horário é barrado pelos índices únicos (sem consulta prévia)
+        try:
+            with transacao_agenda(conn) as cur:
+                sala_id = _reservar_sala(cur, data_, hora_, medico_id, sala_id, duracao)
+                cur.execute(
+                    """INSERT INTO agendamentos
+                       (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio)
+                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                    (paciente_id, medico_id, procedimento_id, sala_id, data_, hora_, convenio_valor)
+                )
+        except HorarioIndisponivel:
+            conn.close()
             if is_ajax:
-                conn.close()
                 return jsonify({"ok": False, "msg": "Horário indisponível para este médico ou sala."}), 409
             flash("Horário indisponível para este médico ou sala.", "danger")
-            conn.close()
             return redirect(url_for("user.agendar_consulta"))
-
-        # insere
-        cur.execute(
-            """INSERT INTO agendamentos
-               (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio)
-               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-            (paciente_id, medico_id, procedimento_id, sala_id, data_, hora_, convenio_valor)
-        )
-        conn.commit()
         conn.close()
+        invalidar_disponibilidade(data_, medico_id, sala_id)
+        registrar_convenio(convenio_valor)
 
+        msg = f"Consulta agendada com sucesso na sala {_nome_sala(sala_id)}!"
         if is_ajax:
-            return jsonify({"ok": True, "msg": "Consulta agendada com sucesso!"})
-        flash("Consulta agendada com sucesso!", "success")
+            return jsonify({"ok": True, "msg": msg, "sala_id": int(sala_id)})
+        flash(msg, "success")
         return redirect(url_for("user.agendar_consulta"))
 
     except Exception as e:
@@ -441,75 +618,411 @@ def agendar_consulta():
         return redirect(url_for("user.agendar_consulta"))
 
 
+def _validar_item_lote(item, ids_validos, procedimentos):
+    """Uma entrada do lote -> (linha pronta para o INSERT, None) ou (None, motivo)."""
+    if not isinstance(item, dict):
+        return None, "Entrada inválida."
+    campos = {}
+    for campo, referencia in (("paciente_id", "pacientes"), ("medico_id", "medicos"),
+                              ("procedimento_id", "procedimentos"), ("sala_id", "salas")):
+        valor = str(item.get(campo) or "").strip()
+        if not valor:
+            return None, "Preencha todos os campos."
+        if campo == "sala_id" and valor == SALA_QUALQUER:
+            return None, "Informe a sala: lotes e séries não escolhem a sala automaticamente."
+        if not valor.isdigit() or int(valor) not in ids_validos[referencia]:
+            return None, f"{campo} não encontrado."
+        campos[campo] = int(valor)
+
+    data_ = str(item.get("data") or "").strip()
+    hora_ = str(item.get("hora") or "").strip()
+    if not (data_ and hora_):
+        return None, "Preencha todos os campos."
+    valido, msg = _validar_data_hora_futura(data_, hora_)
+    if not valido:
+        return None, msg
+    procedimento = procedimentos[campos["procedimento_id"]]
+    if not _termina_no_expediente(normalizar_data(data_), normalizar_hora(hora_), procedimento["duracao_min"]):
+        return None, MSG_FIM_ATENDIMENTO
+
+    convenio_informado = str(item.get("convenio") or "").strip()
+    convenio_valor = _convenio_do_procedimento(procedimento["nome"], "", convenio_informado)
+    return (
+        campos["paciente_id"], campos["medico_id"], campos["procedimento_id"], campos["sala_id"],
+        normalizar_data(data_), normalizar_hora(hora_), convenio_valor,
+    ), None
+
+
+@user_bp.route("/api/agendamentos/lote", methods=["POST"], endpoint="api_agendar_lote")
+@login_required(role='recepcionista')
+def api_agendar_lote():
+    """
+    Agenda vários horários de uma vez (JSON). Cada item é validado contra a
+    ocupação lida uma única vez para os dias, médicos e salas do lote, e
+    contra os itens anteriores do próprio lote, pela duração do procedimento
+    de cada item; os válidos entram na mesma transação, cada um com o id
+    devolvido pelo próprio INSERT. Com "tudo_ou_nada", um item recusado
+    impede todos.
+    """
+    corpo = request.get_json(silent=True)
+    itens = corpo.get("agendamentos") if isinstance(corpo, dict) else corpo
+    if not isinstance(itens, list) or not itens:
+        return jsonify({"ok": False, "msg": "Envie a lista em \"agendamentos\"."}), 400
+    if len(itens) > MAX_LOTE_AGENDAMENTOS:
+        return jsonify({"ok": False, "msg": f"No máximo {MAX_LOTE_AGENDAMENTOS} agendamentos por lote."}), 400
+    tudo_ou_nada = bool(corpo.get("tudo_ou_nada")) if isinstance(corpo, dict) else False
+
+    ids_validos = {nome: {row["id"] for row in referencias(nome)}
+                   for nome in ("pacientes", "medicos", "procedimentos", "salas")}
+    procedimentos = {row["id"]: row for row in referencias("procedimentos")}
+    resultados = []
+    candidatos = []  # (índice, linha)
+    for indice, item in enumerate(itens):
+        linha, msg = _validar_item_lote(item, ids_validos, procedimentos)
+        if msg:
+            resultados.append({"indice": indice, "ok": False, "msg": msg})
+        else:
+            candidatos.append((indice, linha))
+
+    conn = conectar()
+    aceitos = []
+    ids = []
+    try:
+        with transacao_agenda(conn) as cur:
+            # com a trava de escrita já tomada, a ocupação lida aqui não muda até o COMMIT
+            ocupados = ocupacao_em_lote(
+                cur,
+                {linha[4] for _i, linha in candidatos},
+                {linha[1] for _i, linha in candidatos},
+                {linha[3] for _i, linha in candidatos},
+            )
+            for indice, linha in candidatos:
+                _paciente, medico_id, procedimento_id, sala_id, data_, hora_, _conv = linha
+                inicio = minutos_do_horario(data_, hora_) % MINUTOS_POR_DIA
+                fim = inicio + procedimentos[procedimento_id]["duracao_min"]
+                do_medico = ocupados.setdefault(("medico", medico_id, data_), IntervalosDia())
+                da_sala = ocupados.setdefault(("sala", sala_id, data_), IntervalosDia())
+                if do_medico.ocupado(inicio, fim):
+                    resultados.append({"indice": indice, "ok": False, "msg": "Horário indisponível para este médico."})
+                elif da_sala.ocupado(inicio, fim):
+                    resultados.append({"indice": indice, "ok": False, "msg": "Horário indisponível para esta sala."})
+                else:
+                    # o procedimento inteiro vale para os próximos itens do lote
+                    do_medico.inserir(inicio, fim)
+                    da_sala.inserir(inicio, fim)
+                    aceitos.append((indice, linha))
+
+            if aceitos and not (tudo_ou_nada and resultados):
+                for _indice, linha in aceitos:
+                    cur.execute(
+                        """INSERT INTO agendamentos
+                           (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio)
+                           VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id""",
+                        linha,
+                    )
+                    ids.append(cur.fetchone()["id"])
+            else:
+                resultados.extend(
+                    {"indice": indice, "ok": False, "msg": "Lote recusado: há itens inválidos."}
+                    for indice, _linha in aceitos
+                )
+                aceitos = []
+    except HorarioIndisponivel:
+        conn.close()
+        return jsonify({"ok": False, "msg": "Horário indisponível para este médico ou sala."}), 409
+    conn.close()
+
+    for novo_id, (indice, linha) in zip(ids, aceitos):
+        resultados.append({"indice": indice, "ok": True, "id": novo_id,
+                           "data": linha[4], "hora": linha[5]})
+        invalidar_disponibilidade(linha[4], linha[1], linha[3])
+        registrar_convenio(linha[6])
+    resultados.sort(key=lambda r: r["indice"])
+    return jsonify({
+        "ok": len(aceitos) == len(itens),
+        "criados": len(aceitos),
+        "recusados": len(itens) - len(aceitos),
+        "resultados": resultados,
+    })
+
+
+# ------------------ Séries recorrentes ------------------
+def _ocorrencias_da_serie(corpo, linha):
+    """Datas da regra de recorrência do corpo JSON, a partir da data da linha base."""
+    frequencia = str(corpo.get("frequencia") or "").strip().lower()
+    intervalo = str(corpo.get("intervalo") or "1").strip()
+    ocorrencias = str(corpo.get("ocorrencias") or "").strip()
+    ate = str(corpo.get("ate") or "").strip() or None
+    if not intervalo.isdigit() or (ocorrencias and not ocorrencias.isdigit()):
+        raise ValueError("regra de recorrência inválida")
+    return datas_da_serie(linha[4], frequencia, int(intervalo), int(ocorrencias or 0) or None, ate)
+
+
+@user_bp.route("/api/series", methods=["POST"], endpoint="api_agendar_serie")
+@login_required(role='recepcionista')
+def api_agendar_serie():
+    """
+    Agenda uma série recorrente (JSON): os campos de um agendamento mais
+    "frequencia" (diaria, semanal, quinzenal, mensal), "intervalo" e
+    "ocorrencias" ou "ate". A ocupação da série inteira é lida de uma vez; as
+    datas em conflito recebem o horário livre mais próximo ("conflitos":
+    "alternativa", padrão) ou ficam de fora ("pular"). Com "simular", só
+    devolve o plano, sem gravar.
+    """
+    corpo = request.get_json(silent=True)
+    if not isinstance(corpo, dict):
+        return jsonify({"ok": False, "msg": "Envie a série em JSON."}), 400
+    ids_validos = {nome: {row["id"] for row in referencias(nome)}
+                   for nome in ("pacientes", "medicos", "procedimentos", "salas")}
+    procedimentos = {row["id"]: row for row in referencias("procedimentos")}
+    linha, msg = _validar_item_lote(corpo, ids_validos, procedimentos)
+    if msg:
+        return jsonify({"ok": False, "msg": msg}), 400
+    conflitos = str(corpo.get("conflitos") or "alternativa").strip().lower()
+    if conflitos not in CONFLITOS_SERIE:
+        return jsonify({"ok": False, "msg": "Use \"alternativa\" ou \"pular\" em conflitos."}), 400
+    try:
+        datas = _ocorrencias_da_serie(corpo, linha)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Regra de recorrência inválida."}), 400
+    if not datas:  # "ate" anterior à data inicial
+        return jsonify({"ok": False, "msg": "Regra de recorrência inválida."}), 400
+
+    paciente_id, medico_id, procedimento_id, sala_id, _data, hora_, convenio_valor = linha
+    plano = planejar_serie(datas, hora_, medico_id, sala_id, duracao_min=_duracao_procedimento(procedimento_id))
+    ocorrencias = []
+    for item in plano:
+        if item["livre"]:
+            ocorrencias.append({"data": item["data"], "hora": item["hora"], "situacao": "livre"})
+        elif conflitos == "alternativa" and item["alternativa"]:
+            data_alt, hora_alt = item["alternativa"]
+            ocorrencias.append({"data": data_alt, "hora": hora_alt, "situacao": "alternativa",
+                                "data_pedida": item["data"], "hora_pedida": item["hora"]})
+        else:
+            ocorrencias.append({"data": item["data"], "hora": item["hora"], "situacao": "pulada"})
+    agendar = [o for o in ocorrencias if o["situacao"] != "pulada"]
+    resumo = {
+        "ok": True,
+        "ocorrencias": ocorrencias,
+        "conflitos": sum(1 for item in plano if not item["livre"]),
+        "puladas": len(ocorrencias) - len(agendar),
+    }
+    if corpo.get("simular") or not agendar:
+        resumo["serie_id"] = None
+        resumo["criados"] = 0
+        return jsonify(resumo)
+
+    conn = conectar()
+    try:
+        with transacao_agenda(conn) as cur:
+            cur.execute(
+                "INSERT INTO agendamento_series (frequencia, intervalo, criado_em) VALUES (?, ?, ?)",
+                (str(corpo.get("frequencia")).strip().lower(), int(str(corpo.get("intervalo") or "1")),
+                 datetime.now().isoformat(timespec="seconds")),
+            )
+            serie_id = cur.lastrowid
+            cur.executemany(
+                """INSERT INTO agendamentos
+                   (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio, serie_id)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                [(paciente_id, medico_id, procedimento_id, sala_id, o["data"], o["hora"], convenio_valor, serie_id)
+                 for o in agendar],
+            )
+    except HorarioIndisponivel:
+        conn.close()
+        return jsonify({"ok": False, "msg": "Um dos horários da série acabou de ser ocupado. Simule de novo."}), 409
+    conn.close()
+
+    for dia in {o["data"] for o in agendar}:
+        invalidar_disponibilidade(dia, medico_id, sala_id)
+    registrar_convenio(convenio_valor)
+    resumo["serie_id"] = serie_id
+    resumo["criados"] = len(agendar)
+    return jsonify(resumo)
+
+
+@user_bp.route("/api/series/<int:serie_id>/cancelar", methods=["POST"], endpoint="api_cancelar_serie")
+@login_required(role='recepcionista')
+def api_cancelar_serie(serie_id):
+    """Cancela, de uma vez, as ocorrências futuras ainda agendadas da série."""
+    conn = conectar()
+    with transacao_agenda(conn) as cur:
+        cur.execute(
+            """UPDATE agendamentos SET status='cancelado'
+               WHERE serie_id=? AND status='agendado' AND inicio_min > ?
+               RETURNING data, medico_id, sala_id""",
+            (serie_id, minutos_de(datetime.now())),
+        )
+        cancelados = cur.fetchall()
+    conn.close()
+    for row in cancelados:
+        invalidar_disponibilidade(row["data"], row["medico_id"], row["sala_id"])
+    return jsonify({"ok": True, "serie_id": serie_id, "cancelados": len(cancelados)})
+
+
+@user_bp.route("/api/series/<int:serie_id>/mover", methods=["POST"], endpoint="api_mover_serie")
+@login_required(role='recepcionista')
+def api_mover_serie(serie_id):
+    """
+    Move as ocorrências futuras agendadas da série: "dias" desloca as datas
+    (até MAX_DESLOCAMENTO_SERIE_DIAS para cada lado) e "hora" troca o
+    horário. Tudo ou nada: se algum novo horário estiver ocupado ou um
+    procedimento passar do fim do atendimento, nenhuma ocorrência muda.
+    """
+    corpo = request.get_json(silent=True)
+    if not isinstance(corpo, dict):
+        return jsonify({"ok": False, "msg": "Envie o deslocamento em JSON."}), 400
+    dias = str(corpo.get("dias") or "0").strip()
+    nova_hora = normalizar_hora(str(corpo.get("hora") or "").strip()) or None
+    if not dias.lstrip("-").isdigit() or abs(int(dias)) > MAX_DESLOCAMENTO_SERIE_DIAS:
+        return jsonify({"ok": False, "msg": f"Deslocamento inválido (no máximo {MAX_DESLOCAMENTO_SERIE_DIAS} dias)."}), 400
+    if nova_hora and nova_hora not in GRADE_HORARIOS:
+        return jsonify({"ok": False, "msg": "Escolha um horário da grade (08:00 a 17:00, de 30 em 30 minutos)."}), 400
+    dias = int(dias)
+
+    conn = conectar()
+    agora = datetime.now()
+    try:
+        with transacao_agenda(conn) as cur:
+            cur.execute(
+                """SELECT id, data, hora, medico_id, sala_id, duracao_min FROM agendamentos
+                   WHERE serie_id=? AND status='agendado' AND inicio_min > ?""",
+                (serie_id, minutos_de(agora)),
+            )
+            atuais = cur.fetchall()
+            novos = [(data_do_dia(dia_da_data(row["data"]) + dias), nova_hora or row["hora"], row["id"])
+                     for row in atuais]
+            no_passado = any(ja_passou(minutos_do_horario(data_, hora_), agora) for data_, hora_, _id in novos)
+            fora_do_expediente = any(
+                not cabe_no_expediente(minutos_do_horario(data_, hora_) % MINUTOS_POR_DIA, row["duracao_min"])
+                for row, (data_, hora_, _id) in zip(atuais, novos)
+            )
+            if not (no_passado or fora_do_expediente):
+                # primeiro libera os horários atuais, para a série não colidir consigo mesma
+                cur.executemany("UPDATE agendamentos SET status='cancelado' WHERE id=?",
+                                [(row["id"],) for row in atuais])
+                cur.executemany("UPDATE agendamentos SET data=?, hora=?, status='agendado' WHERE id=?", novos)
+    except HorarioIndisponivel:
+        conn.close()
+        return jsonify({"ok": False, "msg": "Algum dos novos horários está ocupado; a série não foi movida."}), 409
+    conn.close()
+    if no_passado:
+        return jsonify({"ok": False, "msg": "A série não pode ir para o passado."}), 400
+    if fora_do_expediente:
+        return jsonify({"ok": False, "msg": "Algum procedimento da série terminaria depois das 17:30; a série não foi movida."}), 400
+
+    for row, (data_, _hora, _id) in zip(atuais, novos):
+        invalidar_disponibilidade(row["data"], row["medico_id"], row["sala_id"])
+        invalidar_disponibilidade(data_, row["medico_id"], row["sala_id"])
+    return jsonify({"ok": True, "serie_id": serie_id, "movidos": len(novos)})
+
+
+# ------------------ Chamadas de pacientes ------------------
+SELECT_CHAMADAS = """
+    SELECT c.id, a.data, a.hora, pac.nome AS paciente, med.nome AS medico,
+           pr.nome AS procedimento
+    FROM chamadas_pacientes c
+    JOIN agendamentos a ON a.id = c.agendamento_id
+    JOIN usuarios pac ON pac.id = c.paciente_id
+    JOIN usuarios med ON med.id = c.medico_id
+    JOIN procedimentos pr ON pr.id = a.procedimento_id
+"""
+
+
+def _buscar_chamadas(cur, condicao, params=()):
+    """Chamadas prontas para exibir (painel da recepção e eventos SSE)."""
+    cur.execute(f"{SELECT_CHAMADAS} WHERE {condicao} ORDER BY a.data, a.hora, c.id", params)
+    chamadas = []
+    for row in cur.fetchall():
+        registro = dict(row)
+        registro["data_display"] = _formatar_data_display(registro.get("data"))
+        registro["hora_display"] = normalizar_hora(registro.get("hora"))
+        registro["url_encaminhar"] = url_for("user.encaminhar_chamada", chamada_id=registro["id"])
+        chamadas.append(registro)
+    return chamadas
+
+
+@user_bp.route("/recepcionista/chamadas/eventos", endpoint="eventos_chamadas")
+@login_required(role='recepcionista')
+def eventos_chamadas():
+    """
+    Server-Sent Events das chamadas: "chamada" (nova pendente, com id) e
+    "encaminhada". Na reconexão (Last-Event-ID, ou ?ultimo_id na primeira
+    conexão) reenvia as pendentes posteriores e, em "pendentes", quais das
+    anteriores ainda aguardam. Parado, o fluxo só manda um ping de tempos em
+    tempos; não há consulta ao banco depois da abertura.
+    """
+    posicao = canal_chamadas.posicao()  # antes do replay: o que for publicado depois não se perde
+    ultimo_id = (request.headers.get("Last-Event-ID") or request.args.get("ultimo_id") or "").strip()
+    iniciais = [f"retry: {INTERVALO_RECONEXAO_MS}\n\n"]
+    if ultimo_id.isdigit():
+        ultimo_id = int(ultimo_id)
+        conn = conectar()
+        cur = conn.cursor()
+        for chamada in _buscar_chamadas(cur, "c.status = 'pendente' AND c.id > ?", (ultimo_id,)):
+            iniciais.append(formatar_sse("chamada", chamada, chamada["id"]))
+        cur.execute("SELECT id FROM chamadas_pacientes WHERE status='pendente' AND id <= ?", (ultimo_id,))
+        iniciais.append(formatar_sse("pendentes", {"ate": ultimo_id, "ids": [row["id"] for row in cur.fetchall()]}))
+        conn.close()
+
+    def fluxo(seq):
+        yield from iniciais
+        while True:
+            eventos, seq, perdeu = canal_chamadas.esperar(seq)
+            if perdeu:  # ficou para trás além do buffer: a tela recarrega
+                yield formatar_sse("recarregar", {})
+                return
+            if not eventos:
+                yield ": ping\n\n"
+            for _seq, tipo, dados in eventos:
+                yield formatar_sse(tipo, dados, dados["id"] if tipo == "chamada" else None)
+
+    return Response(
+        fluxo(posicao),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 
 # ------------------ Painéis ------------------
 @user_bp.route("/recepcionista", endpoint="visao_recepcionista")
 @login_required(role='recepcionista')
 def visao_recepcionista():
-    criar_tabelas()
-    auto_close_past_appointments()
     conn = conectar()
     cur = conn.cursor()
     cur.execute("SELECT COUNT(1) AS q FROM agendamento_ajustes WHERE status='pendente'")
     pend = cur.fetchone()["q"]
     hoje = date.today().isoformat()
 
-    cur.execute("SELECT COUNT(1) AS total FROM agendamentos WHERE data=?", (hoje,))
-    total_hoje = cur.fetchone()["total"]
-    cur.execute("SELECT COUNT(1) AS total FROM agendamentos WHERE data=? AND LOWER(status)='cancelado'", (hoje,))
-    cancelados_hoje = cur.fetchone()["total"]
-    cur.execute("SELECT COUNT(1) AS total FROM agendamentos WHERE data=? AND LOWER(status)='concluido'", (hoje,))
-    concluidos_hoje = cur.fetchone()["total"]
+    # contadores materializados (contagem_diaria/contagem_medico), mantidos por triggers
+    cur.execute(
+        "SELECT status, SUM(total) AS total FROM contagem_diaria WHERE data=? GROUP BY status",
+        (hoje,),
+    )
+    por_status = {row["status"]: row["total"] for row in cur.fetchall()}
 
     dashboard_totais = {
-        "agendados_hoje": total_hoje,
-        "cancelados_hoje": cancelados_hoje,
-        "realizados_hoje": concluidos_hoje,
+        "agendados_hoje": sum(por_status.values()),
+        "cancelados_hoje": por_status.get("cancelado", 0),
+        "realizados_hoje": por_status.get("concluido", 0),
     }
 
     cur.execute(
         """
-        SELECT med.nome AS medico, COUNT(*) AS total
-        FROM agendamentos a
-        JOIN usuarios med ON med.id = a.medico_id
-        WHERE LOWER(a.status) = 'concluido'
-        GROUP BY med.id
-        ORDER BY total DESC, med.nome ASC
+        SELECT med.nome AS medico, c.total
+        FROM contagem_medico c
+        JOIN usuarios med ON med.id = c.medico_id
+        WHERE c.status = 'concluido' AND c.total > 0
+        ORDER BY c.total DESC, med.nome ASC
         """
     )
     consultas_medico = [dict(row) for row in cur.fetchall()]
 
-    cur.execute("SELECT id, nome FROM usuarios WHERE tipo_usuario IN ('medico','médico') ORDER BY nome")
-    medicos = cur.fetchall()
-    cur.execute("SELECT id, nome FROM usuarios WHERE tipo_usuario = 'paciente' ORDER BY nome")
-    pacientes = cur.fetchall()
-    cur.execute("SELECT id, nome FROM procedimentos ORDER BY nome")
-    procedimentos = cur.fetchall()
-    cur.execute(
-        "SELECT DISTINCT convenio FROM agendamentos WHERE convenio IS NOT NULL AND TRIM(convenio)<>'' ORDER BY convenio"
-    )
-    convenios = [row["convenio"] for row in cur.fetchall()]
+    medicos = referencias("medicos")
+    procedimentos = referencias("procedimentos")
+    convenios = referencias("convenios")
 
-    cur.execute(
-        """
-        SELECT c.id, a.data, a.hora, pac.nome AS paciente, med.nome AS medico,
-               pr.nome AS procedimento
-        FROM chamadas_pacientes c
-        JOIN agendamentos a ON a.id = c.agendamento_id
-        JOIN usuarios pac ON pac.id = c.paciente_id
-        JOIN usuarios med ON med.id = c.medico_id
-        JOIN procedimentos pr ON pr.id = a.procedimento_id
-        WHERE c.status = 'pendente'
-        ORDER BY a.data, a.hora, c.id
-        """
-    )
-    chamadas_rows = cur.fetchall()
-    chamadas_pendentes = []
-    for row in chamadas_rows:
-        registro = dict(row)
-        registro["data_display"] = _formatar_data_display(registro.get("data"))
-        registro["hora_display"] = _normalizar_hora(registro.get("hora"))
-        chamadas_pendentes.append(registro)
+    chamadas_pendentes = _buscar_chamadas(cur, "c.status = 'pendente'")
 
     filtros = {
         "inicio": (request.args.get("inicio") or "").strip(),
@@ -521,7 +1034,18 @@ def visao_recepcionista():
         "convenio": (request.args.get("convenio") or "").strip(),
     }
 
-    agendamentos_filtrados, totais_filtrados, filtros = _buscar_agendamentos_filtrados(filtros)
+    tamanho, cursor, direcao = _parametros_pagina(request.args)
+    agendamentos_filtrados, totais_filtrados, filtros, pagina = _buscar_agendamentos_filtrados(
+        filtros, tamanho, cursor, direcao
+    )
+    _links_pagina("user.visao_recepcionista", pagina, _anchor="relatorios", **filtros)
+
+    # o filtro de paciente é uma busca (typeahead); só o nome do escolhido é lido
+    paciente_filtro_nome = ""
+    if filtros.get("paciente"):
+        cur.execute("SELECT nome FROM usuarios WHERE id=?", (filtros["paciente"],))
+        row = cur.fetchone()
+        paciente_filtro_nome = row["nome"] if row else ""
 
     conn.close()
     return render_template(
@@ -532,11 +1056,13 @@ def visao_recepcionista():
         filtros=filtros,
         agendamentos_filtrados=agendamentos_filtrados,
         totais_filtrados=totais_filtrados,
+        pagina=pagina,
         medicos=medicos,
-        pacientes=pacientes,
+        paciente_filtro_nome=paciente_filtro_nome,
         procedimentos=procedimentos,
         convenios=convenios,
         chamadas_pendentes=chamadas_pendentes,
+        ultima_chamada_id=max((c["id"] for c in chamadas_pendentes), default=0),
     )
 
 
@@ -567,44 +1093,17 @@ def exportar_relatorio():
     elif escopo == "mensal" and not filtros.get("mes"):
         filtros["mes"] = hoje.strftime("%Y-%m")
 
-    agendamentos, totais, filtros_norm = _buscar_agendamentos_filtrados(filtros)
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow([
-        "Data",
-        "Hora",
-        "Paciente",
-        "Médico",
-        "Procedimento",
-        "Convênio",
-        "Status",
-    ])
-    for linha in agendamentos:
-        writer.writerow([
-            linha.get("data"),
-            linha.get("hora"),
-            linha.get("paciente"),
-            linha.get("medico"),
-            linha.get("procedimento"),
-            linha.get("convenio"),
-            linha.get("status_label"),
-        ])
-    writer.writerow([])
-    writer.writerow(["Totais", totais.get("total"), "Realizados", totais.get("realizados"), "Cancelados", totais.get("cancelados"), "Em aberto", totais.get("agendados")])
-
-    conteudo = output.getvalue()
-    output.close()
+    base_query, params, filtros_norm = _consulta_agendamentos_filtrados(filtros)
 
     inicio_disp = filtros_norm.get("inicio") or ""
     fim_disp = filtros_norm.get("fim") or ""
     label_escopo = escopo or "personalizado"
     filename = f"relatorio_{label_escopo}_{inicio_disp.replace('-', '')}_{fim_disp.replace('-', '') or hoje.strftime('%Y%m%d')}".strip("_") + ".csv"
 
-    return (
-        conteudo,
-        200,
-        {
+    return Response(
+        stream_with_context(_gerar_csv_relatorio(base_query, params)),
+        status=200,
+        headers={
             "Content-Type": "text/csv; charset=utf-8",
             "Content-Disposition": f"attachment; filename={filename}",
         },
@@ -614,7 +1113,6 @@ def exportar_relatorio():
 @user_bp.route("/recepcionista/chamadas/<int:chamada_id>/encaminhar", methods=["POST"], endpoint="encaminhar_chamada")
 @login_required(role='recepcionista')
 def encaminhar_chamada(chamada_id):
-    criar_tabelas()
     conn = conectar()
     cur = conn.cursor()
     cur.execute(
@@ -640,6 +1138,7 @@ def encaminhar_chamada(chamada_id):
     )
     conn.commit()
     conn.close()
+    canal_chamadas.publicar("encaminhada", {"id": chamada_id})
 
     flash("Paciente liberado para atendimento.", "success")
     return redirect(url_for("user.visao_recepcionista"))
@@ -648,86 +1147,38 @@ def encaminhar_chamada(chamada_id):
 @user_bp.route("/recepcionista/procedimentos", methods=["GET"], endpoint="procedimentos")
 @login_required(role='recepcionista')
 def procedimentos():
-    criar_tabelas()
-
     conn = conectar()
     cur = conn.cursor()
 
-    cur.execute("SELECT id, nome, descricao FROM procedimentos ORDER BY nome")
-    procedimentos = cur.fetchall()
+    procedimentos = referencias("procedimentos")
 
-    cur.execute(
-        """
-        SELECT a.id, a.data, a.hora, a.status,
-               a.medico_id, a.sala_id, a.procedimento_id,
-               pac.nome AS paciente, med.nome AS medico,
-               pr.nome AS procedimento, s.nome AS sala
-        FROM agendamentos a
-        JOIN usuarios pac ON pac.id = a.paciente_id
-        JOIN usuarios med ON med.id = a.medico_id
-        JOIN procedimentos pr ON pr.id = a.procedimento_id
-        JOIN salas s ON s.id = a.sala_id
-        ORDER BY a.data, a.hora
-        """
+    tamanho, cursor, direcao = _parametros_pagina(request.args)
+    agendamentos_brutos, pagina = _paginar_agendamentos(
+        cur, SELECT_AGENDAMENTOS_PROCEDIMENTOS, [], [], tamanho, cursor, direcao
     )
-    agendamentos_brutos = cur.fetchall()
-
-    colunas_agendamento = agendamentos_brutos[0].keys() if agendamentos_brutos else []
-    possui_coluna_status = "status" in colunas_agendamento
-    status_validos = {valor for valor, _ in STATUS_AGENDAMENTO}
+    cur.execute("SELECT COALESCE(SUM(total), 0) FROM contagem_medico")
+    total_agendamentos = cur.fetchone()[0]
+    conn.close()
+    _links_pagina("user.procedimentos", pagina)
 
+    # leitura apenas: dados legados são corrigidos pelo normalizador em lote
+    # (databaser.normalizar_agendamentos_legados)
     agendamentos = []
-    atualizacoes = []
-
     for row in agendamentos_brutos:
         linha = dict(row)
-
-        status_original = linha.get("status", "")
-        data_original = linha.get("data", "")
-        hora_original = linha.get("hora", "")
-
-        status_normalizado = _normalizar_status(status_original, status_validos)
-        data_normalizada = _normalizar_data(data_original)
-        hora_normalizada = _normalizar_hora(hora_original)
-
-        linha["status"] = status_normalizado
-        linha["status_label"] = STATUS_LABELS.get(status_normalizado, status_normalizado.title() if isinstance(status_normalizado, str) else status_normalizado)
-        linha["data"] = data_normalizada
-        linha["data_display"] = _formatar_data_display(data_normalizada) if data_normalizada else data_original
-        linha["hora"] = hora_normalizada
-
+        status = linha.get("status") or ""
+        linha["status_label"] = STATUS_LABELS.get(status, status.title())
+        linha["data_display"] = _formatar_data_display(linha.get("data"))
         agendamentos.append(linha)
 
-        if linha.get("id") is not None and (
-            status_normalizado != status_original
-            or data_normalizada != data_original
-            or hora_normalizada != hora_original
-        ):
-            if possui_coluna_status:
-                atualizacoes.append((status_normalizado, data_normalizada, hora_normalizada, linha["id"]))
-            else:
-                atualizacoes.append((data_normalizada, hora_normalizada, linha["id"]))
-
-    if atualizacoes:
-        if possui_coluna_status:
-            cur.executemany(
-                "UPDATE agendamentos SET status=?, data=?, hora=? WHERE id=?",
-                atualizacoes,
-            )
-        else:
-            cur.executemany(
-                "UPDATE agendamentos SET data=?, hora=? WHERE id=?",
-                atualizacoes,
-            )
-        conn.commit()
-
-    conn.close()
-
     return render_template(
         "recep_procedimentos.html",
         procedimentos=procedimentos,
         agendamentos=agendamentos,
+        total_agendamentos=total_agendamentos,
+        pagina=pagina,
         status_opcoes=STATUS_AGENDAMENTO,
+        max_duracao=MAX_DURACAO_MIN,
     )
 
 
@@ -736,17 +1187,21 @@ def procedimentos():
 def criar_procedimento():
     nome = (request.form.get("nome") or "").strip()
     descricao = (request.form.get("descricao") or "").strip()
+    duracao = _ler_duracao(request.form.get("duracao_min"))
 
     if not nome:
         flash("Informe o nome do procedimento.", "danger")
         return redirect(url_for("user.procedimentos"))
+    if duracao is None:
+        flash(f"Informe a duração em minutos (de 1 a {MAX_DURACAO_MIN}).", "danger")
+        return redirect(url_for("user.procedimentos"))
 
     conn = conectar()
     cur = conn.cursor()
     try:
         cur.execute(
-            "INSERT INTO procedimentos (nome, descricao) VALUES (?, ?)",
-            (nome, descricao)
+            "INSERT INTO procedimentos (nome, descricao, duracao_min) VALUES (?, ?, ?)",
+            (nome, descricao, duracao)
         )
         conn.commit()
     except sqlite3.IntegrityError:
@@ -756,6 +1211,7 @@ def criar_procedimento():
         return redirect(url_for("user.procedimentos"))
 
     conn.close()
+    invalidar_referencias("procedimentos")
     flash("Procedimento cadastrado com sucesso!", "success")
     return redirect(url_for("user.procedimentos"))
 
@@ -769,17 +1225,22 @@ def criar_procedimento():
 def editar_procedimento(procedimento_id):
     nome = (request.form.get("nome") or "").strip()
     descricao = (request.form.get("descricao") or "").strip()
+    duracao = _ler_duracao(request.form.get("duracao_min"))
 
     if not nome:
         flash("Informe o nome do procedimento.", "danger")
         return redirect(url_for("user.procedimentos"))
+    if duracao is None:
+        flash(f"Informe a duração em minutos (de 1 a {MAX_DURACAO_MIN}).", "danger")
+        return redirect(url_for("user.procedimentos"))
 
     conn = conectar()
     cur = conn.cursor()
     try:
+        # vale para os próximos agendamentos; os já marcados guardam a duração antiga
         cur.execute(
-            "UPDATE procedimentos SET nome=?, descricao=? WHERE id=?",
-            (nome, descricao, procedimento_id)
+            "UPDATE procedimentos SET nome=?, descricao=?, duracao_min=? WHERE id=?",
+            (nome, descricao, duracao, procedimento_id)
         )
         if cur.rowcount == 0:
             conn.close()
@@ -793,10 +1254,19 @@ def editar_procedimento(procedimento_id):
         return redirect(url_for("user.procedimentos"))
 
     conn.close()
+    invalidar_referencias("procedimentos")
     flash("Procedimento atualizado com sucesso!", "success")
     return redirect(url_for("user.procedimentos"))
 
 
+def _voltar_para_procedimentos():
+    """Volta para a página da lista de onde o formulário foi enviado."""
+    destino = request.form.get("voltar") or ""
+    if destino.startswith(url_for("user.procedimentos")):  # nunca para fora da tela
+        return redirect(destino)
+    return redirect(url_for("user.procedimentos"))
+
+
 @user_bp.route(
     "/recepcionista/procedimentos/agendamentos/<int:agendamento_id>",
     methods=["POST"],
@@ -811,16 +1281,16 @@ def atualizar_agendamento(agendamento_id):
     status_validos = {valor for valor, _ in STATUS_AGENDAMENTO}
     if status and status not in status_validos:
         flash("Status inválido.", "danger")
-        return redirect(url_for("user.procedimentos"))
+        return _voltar_para_procedimentos()
 
     if (nova_data and not nova_hora) or (nova_hora and not nova_data):
         flash("Informe data e horário para alterar o agendamento.", "warning")
-        return redirect(url_for("user.procedimentos"))
+        return _voltar_para_procedimentos()
 
     conn = conectar()
     cur = conn.cursor()
     cur.execute(
-        "SELECT medico_id, sala_id, data, hora, status FROM agendamentos WHERE id=?",
+        "SELECT medico_id, sala_id, data, hora, status, duracao_min FROM agendamentos WHERE id=?",
         (agendamento_id,)
     )
     atual = cur.fetchone()
@@ -828,7 +1298,7 @@ def atualizar_agendamento(agendamento_id):
     if not atual:
         conn.close()
         flash("Agendamento não encontrado.", "danger")
-        return redirect(url_for("user.procedimentos"))
+        return _voltar_para_procedimentos()
 
     campos = []
     valores = []
@@ -846,19 +1316,22 @@ def atualizar_agendamento(agendamento_id):
         except ValueError:
             conn.close()
             flash("Formato de data ou hora inválido.", "danger")
-            return redirect(url_for("user.procedimentos"))
+            return _voltar_para_procedimentos()
 
         if nova_data != atual["data"] or nova_hora != atual["hora"]:
-            livres = horarios_disponiveis(
-                atual["medico_id"],
-                atual["sala_id"],
-                nova_data,
-                ignorar_agendamento_id=agendamento_id,
-            )
-            if nova_hora not in livres:
+            if nova_hora not in GRADE_HORARIOS:
                 conn.close()
                 flash("Horário indisponível para este médico ou sala.", "danger")
-                return redirect(url_for("user.procedimentos"))
+                return _voltar_para_procedimentos()
+            valido, msg = _validar_data_hora_futura(nova_data, nova_hora)
+            if not valido:
+                conn.close()
+                flash(msg, "danger")
+                return _voltar_para_procedimentos()
+            if not _termina_no_expediente(nova_data, nova_hora, atual["duracao_min"]):
+                conn.close()
+                flash(MSG_FIM_ATENDIMENTO, "danger")
+                return _voltar_para_procedimentos()
             alterar_horario = True
         else:
             alterar_horario = False
@@ -870,51 +1343,52 @@ def atualizar_agendamento(agendamento_id):
     if not campos:
         conn.close()
         flash("Nenhuma alteração informada.", "info")
-        return redirect(url_for("user.procedimentos"))
+        return _voltar_para_procedimentos()
 
     valores.append(agendamento_id)
-    cur.execute(f"UPDATE agendamentos SET {', '.join(campos)} WHERE id=?", valores)
-    conn.commit()
+    # reativar ou remarcar pode colidir com outro agendamento: os índices únicos decidem
+    try:
+        with transacao_agenda(conn) as cur:
+            cur.execute(f"UPDATE agendamentos SET {', '.join(campos)} WHERE id=? RETURNING status, inicio_min", valores)
+            gravado = cur.fetchone()
+            # reaberto num horário já vencido: o fechamento automático precisa revê-lo
+            if gravado["status"] in STATUS_ABERTOS:
+                recuar_marca_fechamento(cur, gravado["inicio_min"])
+    except HorarioIndisponivel:
+        conn.close()
+        flash("Horário indisponível para este médico ou sala.", "danger")
+        return _voltar_para_procedimentos()
     conn.close()
+    invalidar_disponibilidade(atual["data"], atual["medico_id"], atual["sala_id"])
+    if alterar_horario:
+        invalidar_disponibilidade(nova_data, atual["medico_id"], atual["sala_id"])
 
     flash("Agendamento atualizado com sucesso!", "success")
-    return redirect(url_for("user.procedimentos"))
+    return _voltar_para_procedimentos()
 
 @user_bp.route("/medico", endpoint="visao_medico")
 @login_required(role='medico')
 def visao_medico():
-    criar_tabelas()
     medico_id = session["usuario_id"]
     hoje = date.today().isoformat()
 
     conn = conectar()
     cur = conn.cursor()
 
+    # todos os indicadores numa consulta, sobre os contadores mantidos por triggers
     cur.execute(
-        "SELECT COUNT(1) AS total FROM agendamentos WHERE medico_id=? AND data=?",
-        (medico_id, hoje),
-    )
-    total_hoje = cur.fetchone()["total"]
-
-    cur.execute(
-        """SELECT COUNT(1) AS total FROM agendamentos
-            WHERE medico_id=? AND data=? AND LOWER(status)='concluido'""",
-        (medico_id, hoje),
-    )
-    concluidos_hoje = cur.fetchone()["total"]
-
-    cur.execute(
-        """SELECT COUNT(1) AS total FROM agendamentos
-            WHERE medico_id=? AND data=? AND LOWER(status)='cancelado'""",
-        (medico_id, hoje),
-    )
-    cancelados_hoje = cur.fetchone()["total"]
-
-    cur.execute(
-        "SELECT COUNT(1) AS total FROM agendamentos WHERE medico_id=? AND LOWER(status)='concluido'",
-        (medico_id,),
+        """
+        SELECT COALESCE(SUM(total), 0) AS total_hoje,
+               COALESCE(SUM(CASE WHEN status='concluido' THEN total END), 0) AS concluidos_hoje,
+               COALESCE(SUM(CASE WHEN status='cancelado' THEN total END), 0) AS cancelados_hoje,
+               (SELECT COALESCE(SUM(total), 0) FROM contagem_medico
+                 WHERE medico_id=? AND status='concluido') AS concluidos_totais
+        FROM contagem_diaria
+        WHERE data=? AND medico_id=?
+        """,
+        (medico_id, hoje, medico_id),
     )
-    concluidos_totais = cur.fetchone()["total"]
+    dashboard = dict(cur.fetchone())
 
     cur.execute(
         """
@@ -931,14 +1405,18 @@ def visao_medico():
     )
     consultas_brutas = cur.fetchall()
 
-    cur.execute(
-        """SELECT agendamento_id, status, criado_em, encaminhado_em
-            FROM chamadas_pacientes
-            WHERE medico_id=?
-            ORDER BY id DESC""",
-        (medico_id,),
-    )
-    chamadas = cur.fetchall()
+    # só as chamadas dos agendamentos de hoje (idx_chamadas_medico_agendamento)
+    chamadas = []
+    if consultas_brutas:
+        ids_hoje = [row["id"] for row in consultas_brutas]
+        cur.execute(
+            f"""SELECT agendamento_id, status, criado_em, encaminhado_em
+                FROM chamadas_pacientes
+                WHERE medico_id=? AND agendamento_id IN ({','.join('?' for _ in ids_hoje)})
+                ORDER BY id DESC""",
+            (medico_id, *ids_hoje),
+        )
+        chamadas = cur.fetchall()
     chamadas_por_agendamento = {}
     for row in chamadas:
         agendamento_id = row["agendamento_id"]
@@ -949,14 +1427,14 @@ def visao_medico():
     consultas = []
     for row in consultas_brutas:
         registro = dict(row)
-        status_normalizado = _normalizar_status(registro.get("status", ""), status_validos)
+        status_normalizado = normalizar_status(registro.get("status", ""), status_validos)
         registro["status"] = status_normalizado
         registro["status_label"] = STATUS_LABELS.get(
             status_normalizado,
             status_normalizado.title() if isinstance(status_normalizado, str) and status_normalizado else status_normalizado,
         )
         registro["data_display"] = _formatar_data_display(registro.get("data"))
-        registro["hora_display"] = _normalizar_hora(registro.get("hora"))
+        registro["hora_display"] = normalizar_hora(registro.get("hora"))
         registro["notas"] = registro.get("notas") or ""
         registro["convenio"] = registro.get("convenio") or "—"
         chamada_info = chamadas_por_agendamento.get(registro["id"])
@@ -972,13 +1450,6 @@ def visao_medico():
 
     conn.close()
 
-    dashboard = {
-        "total_hoje": total_hoje,
-        "cancelados_hoje": cancelados_hoje,
-        "concluidos_hoje": concluidos_hoje,
-        "concluidos_totais": concluidos_totais,
-    }
-
     return render_template(
         "medico.html",
         dashboard=dashboard,
@@ -990,7 +1461,6 @@ def visao_medico():
 @user_bp.route("/medico/agendamentos/<int:agendamento_id>/nota", methods=["POST"], endpoint="salvar_nota_medico")
 @login_required(role='medico')
 def salvar_nota_medico(agendamento_id):
-    criar_tabelas()
     nota = request.form.get("nota", "")
     if nota is None:
         nota = ""
@@ -1022,12 +1492,11 @@ def salvar_nota_medico(agendamento_id):
 @user_bp.route("/medico/agendamentos/<int:agendamento_id>/chamar", methods=["POST"], endpoint="chamar_paciente")
 @login_required(role='medico')
 def chamar_paciente(agendamento_id):
-    criar_tabelas()
     medico_id = session["usuario_id"]
     conn = conectar()
     cur = conn.cursor()
     cur.execute(
-        "SELECT id, paciente_id, data, status FROM agendamentos WHERE id=? AND medico_id=?",
+        "SELECT id, paciente_id, sala_id, data, status FROM agendamentos WHERE id=? AND medico_id=?",
         (agendamento_id, medico_id),
     )
     agendamento = cur.fetchone()
@@ -1060,12 +1529,16 @@ def chamar_paciente(agendamento_id):
                VALUES (?, ?, ?, 'pendente', ?)""",
         (agendamento_id, medico_id, agendamento["paciente_id"], agora),
     )
+    chamada_id = cur.lastrowid
     cur.execute(
         "UPDATE agendamentos SET status='em atendimento' WHERE id=?",
         (agendamento_id,),
     )
     conn.commit()
+    for chamada in _buscar_chamadas(cur, "c.id = ?", (chamada_id,)):
+        canal_chamadas.publicar("chamada", chamada)
     conn.close()
+    invalidar_disponibilidade(agendamento["data"], medico_id, agendamento["sala_id"])
 
     flash("Chamada enviada à recepção.", "success")
     return redirect(url_for("user.visao_medico"))
@@ -1074,7 +1547,6 @@ def chamar_paciente(agendamento_id):
 @login_required(role='paciente')
 def visao_paciente():
     pid = session["usuario_id"]
-    auto_close_past_appointments()
     conn = conectar()
     cur = conn.cursor()
 
@@ -1103,27 +1575,16 @@ def visao_paciente():
     perfil_row = cur.fetchone()
     perfil = {"nome": perfil_row["nome"], "email": perfil_row["email"]} if perfil_row else {"nome": "", "email": ""}
 
-    cur.execute("SELECT id, nome FROM usuarios WHERE tipo_usuario IN ('medico','médico') ORDER BY nome")
-    medicos = cur.fetchall()
-    cur.execute("SELECT id, nome FROM procedimentos ORDER BY nome")
-    procedimentos = cur.fetchall()
-    cur.execute("SELECT id, nome FROM salas ORDER BY nome")
-    salas = cur.fetchall()
-    cur.execute(
-        "SELECT DISTINCT convenio FROM agendamentos WHERE convenio IS NOT NULL AND TRIM(convenio)<>'' ORDER BY convenio"
-    )
-    convenios = [row["convenio"] for row in cur.fetchall()]
-
     conn.close()
     return render_template(
         "paciente.html",
         agendamentos=ags,
         ajustes=ajustes,
         perfil=perfil,
-        medicos=medicos,
-        procedimentos=procedimentos,
-        salas=salas,
-        convenios=convenios,
+        medicos=referencias("medicos"),
+        procedimentos=referencias("procedimentos"),
+        salas=referencias("salas"),
+        convenios=referencias("convenios"),
     )
 
 
@@ -1167,6 +1628,7 @@ def atualizar_perfil_paciente():
         return redirect(url_for("user.visao_paciente"))
 
     conn.close()
+    invalidar_referencias("usuarios")
     session["usuario_nome"] = nome
     flash("Perfil atualizado com sucesso!", "success")
     return redirect(url_for("user.visao_paciente"))
@@ -1175,7 +1637,6 @@ def atualizar_perfil_paciente():
 @user_bp.route("/paciente/agendar", methods=["POST"], endpoint="agendar_consulta_paciente")
 @login_required(role='paciente')
 def agendar_consulta_paciente():
-    criar_tabelas()
     paciente_id = session["usuario_id"]
     medico_id = (request.form.get("medico_id") or "").strip()
     procedimento_id = (request.form.get("procedimento_id") or "").strip()
@@ -1193,15 +1654,18 @@ def agendar_consulta_paciente():
         flash(msg, "danger")
         return redirect(url_for("user.visao_paciente"))
 
-    try:
-        disponiveis = horarios_disponiveis(int(medico_id), int(sala_id), data_)
-    except ValueError:
+    if not (medico_id.isdigit() and (sala_id.isdigit() or sala_id == SALA_QUALQUER)):
         flash("Dados inválidos para médico ou sala.", "danger")
         return redirect(url_for("user.visao_paciente"))
 
-    if hora_ not in disponiveis or not is_slot_available(data_, hora_, int(medico_id), int(sala_id)):
+    data_, hora_ = normalizar_data(data_), normalizar_hora(hora_)
+    if hora_ not in GRADE_HORARIOS:  # pacientes só marcam nos horários da grade
         flash("Horário indisponível para o médico ou sala escolhidos.", "danger")
         return redirect(url_for("user.visao_paciente"))
+    duracao = _duracao_procedimento(procedimento_id)
+    if not _termina_no_expediente(data_, hora_, duracao):
+        flash(MSG_FIM_ATENDIMENTO, "danger")
+        return redirect(url_for("user.visao_paciente"))
 
     conn = conectar()
     cur = conn.cursor()
@@ -1214,15 +1678,23 @@ def agendar_consulta_paciente():
         flash("Você já possui uma consulta nesse horário.", "warning")
         return redirect(url_for("user.visao_paciente"))
 
-    cur.execute(
-        """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio)
-            VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (paciente_id, medico_id, procedimento_id, sala_id, data_, hora_, convenio),
-    )
-    conn.commit()
+    try:
+        with transacao_agenda(conn) as cur:
+            sala_id = _reservar_sala(cur, data_, hora_, medico_id, sala_id, duracao)
+            cur.execute(
+                """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora, convenio)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (paciente_id, medico_id, procedimento_id, sala_id, data_, hora_, convenio),
+            )
+    except HorarioIndisponivel:
+        conn.close()
+        flash("Horário indisponível para o médico ou sala escolhidos.", "danger")
+        return redirect(url_for("user.visao_paciente"))
     conn.close()
+    invalidar_disponibilidade(data_, medico_id, sala_id)
+    registrar_convenio(convenio)
 
-    flash("Consulta agendada com sucesso!", "success")
+    flash(f"Consulta agendada com sucesso na sala {_nome_sala(sala_id)}!", "success")
     return redirect(url_for("user.visao_paciente"))
 
 
@@ -1240,7 +1712,7 @@ def solicitar_ajuste(agendamento_id):
 
     # valida: agendamento pertence ao paciente autenticado
     cur.execute(
-        "SELECT id, medico_id, sala_id, data, hora FROM agendamentos WHERE id=? AND paciente_id=?",
+        "SELECT id, medico_id, sala_id, data, hora, duracao_min FROM agendamentos WHERE id=? AND paciente_id=?",
         (agendamento_id, session["usuario_id"])
     )
     agendamento = cur.fetchone()
@@ -1261,9 +1733,10 @@ def solicitar_ajuste(agendamento_id):
         flash(msg, "danger")
         return redirect(url_for("user.visao_paciente"))
 
-    livres = horarios_disponiveis(agendamento["medico_id"], agendamento["sala_id"], novo_dia)
+    livres = horarios_disponiveis(agendamento["medico_id"], agendamento["sala_id"], novo_dia,
+                                  ignorar_agendamento_id=agendamento_id, duracao_min=agendamento["duracao_min"])
     if not (novo_dia == agendamento["data"] and nova_hora == agendamento["hora"]):
-        if nova_hora not in livres or not is_slot_available(novo_dia, nova_hora, agendamento["medico_id"], agendamento["sala_id"], agendamento_id):
+        if nova_hora not in livres:
             conn.close()
             flash("Horário indisponível. Escolha outra opção.", "danger")
             return redirect(url_for("user.visao_paciente"))
@@ -1283,11 +1756,10 @@ def solicitar_ajuste(agendamento_id):
 @user_bp.route("/recepcionista/ajustes", endpoint="lista_ajustes")
 @login_required(role='recepcionista')
 def lista_ajustes():
-    auto_close_past_appointments()
     conn = conectar()
     cur = conn.cursor()
     cur.execute("""
-        SELECT j.*, a.paciente_id, a.medico_id, a.sala_id, a.data AS data_atual, a.hora AS hora_atual,
+        SELECT j.*, a.paciente_id, a.medico_id, a.sala_id, a.procedimento_id, a.data AS data_atual, a.hora AS hora_atual,
                p.nome AS paciente, m.nome AS medico, s.nome AS sala
         FROM agendamento_ajustes j
         JOIN agendamentos a ON a.id=j.agendamento_id
@@ -1298,8 +1770,37 @@ def lista_ajustes():
         ORDER BY j.id ASC
     """)
     pendentes = cur.fetchall()
+    # agendamentos que a migração de horário único tirou da agenda, até alguém revisá-los
+    cur.execute("""
+        SELECT c.id, c.status_anterior, c.conflita_com, a.data, a.hora,
+               p.nome AS paciente, m.nome AS medico, s.nome AS sala
+        FROM conflitos_horario c
+        JOIN agendamentos a ON a.id=c.agendamento_id
+        JOIN usuarios p ON p.id=a.paciente_id
+        JOIN usuarios m ON m.id=a.medico_id
+        JOIN salas s ON s.id=a.sala_id
+        WHERE c.revisado_em IS NULL
+        ORDER BY a.data, a.hora, c.id
+    """)
+    conflitos = cur.fetchall()
     conn.close()
-    return render_template("recep_ajustes.html", pendentes=pendentes)
+    return render_template("recep_ajustes.html", pendentes=pendentes, conflitos=conflitos)
+
+
+@user_bp.route("/recepcionista/conflitos/<int:conflito_id>/revisado", methods=["POST"], endpoint="revisar_conflito")
+@login_required(role='recepcionista')
+def revisar_conflito(conflito_id):
+    conn = conectar()
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE conflitos_horario SET revisado_em=? WHERE id=? AND revisado_em IS NULL",
+        (datetime.now().isoformat(timespec="seconds"), conflito_id),
+    )
+    conn.commit()
+    conn.close()
+    flash("Conflito marcado como revisado." if cur.rowcount else "Conflito não encontrado.",
+          "success" if cur.rowcount else "warning")
+    return redirect(url_for("user.lista_ajustes"))
 
 @user_bp.route("/recepcionista/ajustes/<int:ajuste_id>/decidir", methods=["POST"], endpoint="decidir_ajuste")
 @login_required(role='recepcionista')
@@ -1309,7 +1810,7 @@ def decidir_ajuste(ajuste_id):
     conn = conectar()
     cur = conn.cursor()
     cur.execute("""
-        SELECT j.*, a.medico_id, a.sala_id
+        SELECT j.*, a.medico_id, a.sala_id, a.duracao_min, a.data AS data_atual
         FROM agendamento_ajustes j
         JOIN agendamentos a ON a.id=j.agendamento_id
         WHERE j.id=? AND j.status='pendente'
@@ -1326,7 +1827,9 @@ def decidir_ajuste(ajuste_id):
         hora_sugerida = (request.form.get("hora_sugerida") or "").strip()
         now_iso = datetime.utcnow().isoformat()
         if not (data_sugerida and hora_sugerida):
-            data_sugerida, hora_sugerida = sugerir_proximo_horario(row["novo_dia"], row["nova_hora"], row["medico_id"], row["sala_id"]) or (None, None)
+            data_sugerida, hora_sugerida = sugerir_proximo_horario(
+                row["novo_dia"], row["nova_hora"], row["medico_id"], row["sala_id"], duracao_min=row["duracao_min"]
+            ) or (None, None)
         if data_sugerida and hora_sugerida:
             valido, msg_val = _validar_data_hora_futura(data_sugerida, hora_sugerida)
             if not valido:
@@ -1351,6 +1854,7 @@ def decidir_ajuste(ajuste_id):
         )
         conn.commit()
         conn.close()
+        invalidar_disponibilidade(row["data_atual"], row["medico_id"], row["sala_id"])
         flash("Solicitação negada e paciente receberá um novo horário sugerido.", "warning")
         return redirect(url_for("user.lista_ajustes"))
 
@@ -1360,35 +1864,63 @@ def decidir_ajuste(ajuste_id):
         flash(msg_val, "danger")
         return redirect(url_for("user.lista_ajustes"))
 
-    livres = horarios_disponiveis(row["medico_id"], row["sala_id"], row["novo_dia"])
-    if row["nova_hora"] not in livres or not is_slot_available(row["novo_dia"], row["nova_hora"], row["medico_id"], row["sala_id"], row["agendamento_id"]):
+    if row["nova_hora"] not in GRADE_HORARIOS:
         conn.close()
         flash("Horário indisponível. Escolha outro horário.", "danger")
         return redirect(url_for("user.lista_ajustes"))
+    if not _termina_no_expediente(row["novo_dia"], row["nova_hora"], row["duracao_min"]):
+        conn.close()
+        flash(MSG_FIM_ATENDIMENTO, "danger")
+        return redirect(url_for("user.lista_ajustes"))
 
-    # aplica ajuste
+    # aplica ajuste; se o horário já foi tomado, os índices únicos desfazem as duas alterações
     now_iso = datetime.utcnow().isoformat()
-    cur.execute("UPDATE agendamentos SET data=?, hora=?, updated_at=? WHERE id=?", (row["novo_dia"], row["nova_hora"], now_iso, row["agendamento_id"]))
-    cur.execute("UPDATE agendamento_ajustes SET status='aceito', updated_at=? WHERE id=?", (now_iso, ajuste_id))
-    conn.commit()
+    try:
+        with transacao_agenda(conn) as cur:
+            cur.execute("UPDATE agendamentos SET data=?, hora=?, updated_at=? WHERE id=?", (row["novo_dia"], row["nova_hora"], now_iso, row["agendamento_id"]))
+            cur.execute("UPDATE agendamento_ajustes SET status='aceito', updated_at=? WHERE id=?", (now_iso, ajuste_id))
+    except HorarioIndisponivel:
+        conn.close()
+        flash("Horário indisponível. Escolha outro horário.", "danger")
+        return redirect(url_for("user.lista_ajustes"))
     conn.close()
+    invalidar_disponibilidade(row["data_atual"], row["medico_id"], row["sala_id"])
+    invalidar_disponibilidade(row["novo_dia"], row["medico_id"], row["sala_id"])
     flash("Solicitação aceita e agendamento atualizado.", "success")
     return redirect(url_for("user.lista_ajustes"))
 
 
 # ------------------ Auxiliar: horários disponíveis (AJAX) ------------------
+def _sala_do_filtro(valor):
+    """sala_id da query string: um id ou SALA_QUALQUER (ValueError se nenhum dos dois)."""
+    valor = (valor or "").strip()
+    return SALA_QUALQUER if valor == SALA_QUALQUER else int(valor or "0")
+
+
+def _horarios_com_sala_livre(medico_id, dia, duracao_min=DURACAO_PADRAO_MIN):
+    """Horários da grade em que o procedimento cabe com o médico e ao menos uma sala livres."""
+    dia_da_data(dia)  # data inválida vira ValueError, como em horarios_disponiveis
+    conn = conectar()
+    livres = salas_livres_no_dia(conn.cursor(), dia, medico_id, duracao_min=duracao_min)
+    conn.close()
+    return [hhmm for hhmm in livres if _termina_no_expediente(dia, hhmm, duracao_min)]
+
+
 @user_bp.route("/recepcionista/horarios_disponiveis", endpoint="horarios_api")
 @login_required(role='recepcionista')
 def horarios_api():
     try:
         medico_id = int(request.args.get("medico_id", "0"))
-        sala_id = int(request.args.get("sala_id", "0"))
+        sala_id = _sala_do_filtro(request.args.get("sala_id", "0"))
     except (TypeError, ValueError):
         return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
 
     dia = (request.args.get("dia") or "").strip()  # YYYY-MM-DD
     if not dia:
         return jsonify([])
+    duracao = _duracao_procedimento(request.args.get("procedimento_id"))
+    if sala_id == SALA_QUALQUER:
+        return jsonify(_horarios_com_sala_livre(medico_id, dia, duracao))
 
     ignorar_id = request.args.get("ignorar_id")
     try:
@@ -1402,6 +1934,7 @@ def horarios_api():
             sala_id,
             dia,
             ignorar_agendamento_id=ignorar_id_int,
+            duracao_min=duracao,
         )
     )
 
@@ -1421,7 +1954,8 @@ def api_disponibilidade():
         return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
 
     ocupados = get_busy_slots(data, medico_id, sala_id)
-    disponiveis = horarios_disponiveis(medico_id or 0, sala_id or 0, data)
+    disponiveis = horarios_disponiveis(medico_id or 0, sala_id or 0, data,
+                                       duracao_min=_duracao_procedimento(request.args.get("procedimento_id")))
     return jsonify({
         "data": data,
         "ocupados": ocupados,
@@ -1429,6 +1963,41 @@ def api_disponibilidade():
     })
 
 
+@user_bp.route("/api/disponibilidade/periodo", methods=["GET"], endpoint="api_disponibilidade_periodo")
+@login_required()
+def api_disponibilidade_periodo():
+    inicio = (request.args.get("inicio") or "").strip()
+    fim = (request.args.get("fim") or "").strip()
+    medico_raw = request.args.get("medico_id")
+    sala_raw = request.args.get("sala_id")
+    if not inicio:
+        return jsonify({"ok": False, "msg": "Informe a data inicial."}), 400
+    try:
+        medico_id = int(medico_raw) if medico_raw else None
+        sala_id = int(sala_raw) if sala_raw else None
+        inicio_dt = datetime.strptime(inicio, "%Y-%m-%d").date()
+        if fim:
+            fim_dt = datetime.strptime(fim, "%Y-%m-%d").date()
+        else:
+            fim_dt = inicio_dt + timedelta(days=int(request.args.get("dias") or 7) - 1)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
+
+    total_dias = (fim_dt - inicio_dt).days + 1
+    if total_dias < 1 or total_dias > MAX_DIAS_GRADE:
+        return jsonify({"ok": False, "msg": f"O período deve ter entre 1 e {MAX_DIAS_GRADE} dias."}), 400
+
+    duracao = _duracao_procedimento(request.args.get("procedimento_id"))
+    dias = grade_disponibilidade(inicio_dt.isoformat(), fim_dt.isoformat(), medico_id, sala_id, duracao)
+    return jsonify({
+        "inicio": inicio_dt.isoformat(),
+        "fim": fim_dt.isoformat(),
+        "medico_id": medico_id,
+        "sala_id": sala_id,
+        "dias": dias,
+    })
+
+
 @user_bp.route("/api/sugerir_horario", methods=["GET"], endpoint="api_sugerir_horario")
 @login_required()
 def api_sugerir_horario():
@@ -1445,10 +2014,24 @@ def api_sugerir_horario():
     if not (data and hora):
         return jsonify({"ok": False, "msg": "Informe data e hora."}), 400
 
-    proxima_data, proxima_hora = sugerir_proximo_horario(data, hora, medico_id, sala_id)
-    if not proxima_data:
+    try:
+        horizonte = int(request.args.get("horizonte") or HORIZONTE_SUGESTAO_DIAS)
+        limite = int(request.args.get("limite") or 1)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
+    horizonte = max(1, min(horizonte, MAX_HORIZONTE_SUGESTAO_DIAS))
+    limite = max(1, min(limite, MAX_SUGESTOES))
+
+    sugestoes = sugerir_horarios(data, hora, medico_id, sala_id, horizonte_dias=horizonte, limite=limite,
+                                 duracao_min=_duracao_procedimento(request.args.get("procedimento_id")))
+    if not sugestoes:
         return jsonify({"ok": False, "msg": "Nenhum horário encontrado."}), 404
-    return jsonify({"data": proxima_data, "hora": proxima_hora})
+    proxima_data, proxima_hora = sugestoes[0]
+    return jsonify({
+        "data": proxima_data,
+        "hora": proxima_hora,
+        "sugestoes": [{"data": dia, "hora": hh} for dia, hh in sugestoes],
+    })
 
 
 @user_bp.route("/paciente/horarios_disponiveis", endpoint="paciente_horarios_api")
@@ -1466,7 +2049,7 @@ def paciente_horarios_api():
     conn = conectar()
     cur = conn.cursor()
     cur.execute(
-        "SELECT medico_id, sala_id, data, hora FROM agendamentos WHERE id=? AND paciente_id=?",
+        "SELECT medico_id, sala_id, data, hora, duracao_min FROM agendamentos WHERE id=? AND paciente_id=?",
         (agendamento_id, session["usuario_id"])
     )
     agendamento = cur.fetchone()
@@ -1475,7 +2058,9 @@ def paciente_horarios_api():
     if not agendamento:
         return jsonify({"ok": False, "msg": "Agendamento não encontrado."}), 404
 
-    livres = horarios_disponiveis(agendamento["medico_id"], agendamento["sala_id"], dia)
+    # o próprio agendamento não ocupa o horário para onde ele vai ser remarcado
+    livres = horarios_disponiveis(agendamento["medico_id"], agendamento["sala_id"], dia,
+                                  ignorar_agendamento_id=agendamento_id, duracao_min=agendamento["duracao_min"])
     return jsonify(livres)
 
 
@@ -1484,15 +2069,18 @@ def paciente_horarios_api():
 def paciente_horarios_novo():
     try:
         medico_id = int(request.args.get("medico_id", "0"))
-        sala_id = int(request.args.get("sala_id", "0"))
+        sala_id = _sala_do_filtro(request.args.get("sala_id", "0"))
     except ValueError:
         return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
 
     dia = (request.args.get("dia") or "").strip()
     if not (medico_id and sala_id and dia):
         return jsonify([])
+    duracao = _duracao_procedimento(request.args.get("procedimento_id"))
+    if sala_id == SALA_QUALQUER:
+        return jsonify(_horarios_com_sala_livre(medico_id, dia, duracao))
 
-    return jsonify(horarios_disponiveis(medico_id, sala_id, dia))
+    return jsonify(horarios_disponiveis(medico_id, sala_id, dia, duracao_min=duracao))
 
 
 # ------------------ Recepção: criar usuários ------------------
@@ -1515,6 +2103,7 @@ def cadastrar_usuarios():
         )
         conn.commit()
         conn.close()
+        invalidar_referencias("usuarios")
 
         flash(f"Usuário cadastrado: {nome} ({tipo_usuario})", "success")
         return redirect(url_for("user.visao_recepcionista"))
@@ -1525,16 +2114,34 @@ def cadastrar_usuarios():
 @user_bp.route("/recepcionista/usuarios", endpoint="gerenciar_usuarios")
 @login_required(role='recepcionista')
 def gerenciar_usuarios():
-    conn = conectar()
-    cur = conn.cursor()
-    cur.execute("SELECT id, nome, email FROM usuarios WHERE LOWER(tipo_usuario)='paciente' ORDER BY nome")
-    pacientes = cur.fetchall()
-    cur.execute(
-        "SELECT id, nome, email FROM usuarios WHERE LOWER(REPLACE(tipo_usuario, 'é', 'e'))='medico' ORDER BY nome"
+    # pacientes: só os encontrados pela busca; a lista completa não vai à página
+    busca = (request.args.get("q") or "").strip()
+    pacientes = buscar_usuarios(busca, "paciente", MAX_RESULTADOS_BUSCA) if busca else []
+    return render_template(
+        "gerenciar_usuarios.html",
+        busca=busca,
+        pacientes=pacientes,
+        max_resultados=MAX_RESULTADOS_BUSCA,
+        medicos=referencias("medicos"),
     )
-    medicos = cur.fetchall()
-    conn.close()
-    return render_template("gerenciar_usuarios.html", pacientes=pacientes, medicos=medicos)
+
+
+@user_bp.route("/api/usuarios/busca", methods=["GET"], endpoint="api_buscar_usuarios")
+@login_required(role='recepcionista')
+def api_buscar_usuarios():
+    """Typeahead: ?q=<início de nome ou e-mail>&tipo=paciente|medico&limite=<n>."""
+    termo = (request.args.get("q") or "").strip()
+    tipo = (request.args.get("tipo") or "").strip().lower() or None
+    try:
+        limite = int(request.args.get("limite") or 10)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Parâmetros inválidos."}), 400
+    limite = max(1, min(limite, MAX_RESULTADOS_BUSCA))
+    usuarios = buscar_usuarios(termo, tipo, limite)
+    return jsonify({
+        "ok": True,
+        "usuarios": [{"id": u["id"], "nome": u["nome"], "email": u["email"]} for u in usuarios],
+    })
 
 
 @user_bp.route("/recepcionista/usuarios/<int:usuario_id>/editar", methods=["GET", "POST"], endpoint="editar_usuario")
@@ -1596,6 +2203,7 @@ def editar_usuario(usuario_id):
             return redirect(url_for("user.editar_usuario", usuario_id=usuario_id))
 
         conn.close()
+        invalidar_referencias("usuarios")
         flash("Cadastro atualizado com sucesso!", "success")
         return redirect(url_for("user.gerenciar_usuarios"))
 
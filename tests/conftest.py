@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures dos testes de comportamento: uma base sintética pequena e nova a
+cada teste, e um cliente logado como recepcionista master.
+
+Os testes marcam em DIA e nos dias seguintes, fora da janela de dados gerados,
+então começam sempre com a agenda vazia.
+"""
+import os
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import databaser  # noqa: E402
+from ferramentas.dados_sinteticos import gerar_clinica  # noqa: E402
+
+DIA = (date.today() + timedelta(days=30)).isoformat()
+
+
+def dia_mais(dias):
+    return (date.fromisoformat(DIA) + timedelta(days=dias)).isoformat()
+
+
+@pytest.fixture
+def clinica_pequena(tmp_path):
+    amostra = gerar_clinica(str(tmp_path / "clinica.db"), agendamentos=40, medicos=4, pacientes=10,
+                            dias_passado=2, dias_futuro=2)
+    databaser.limpar_cache_disponibilidade()
+    databaser.invalidar_referencias()
+    import main  # importado depois de apontar DB_PATH para a base sintética
+    main.main.testing = True
+
+    conn = databaser._abrir_conexao()
+    amostra["medicos"] = [row[0] for row in conn.execute(
+        "SELECT id FROM usuarios WHERE tipo_usuario='medico' ORDER BY id")]
+    amostra["salas"] = [row[0] for row in conn.execute("SELECT id FROM salas ORDER BY id")]
+    amostra["procedimentos"] = [row[0] for row in conn.execute("SELECT id FROM procedimentos ORDER BY id")]
+    conn.fechar_de_fato()
+    return main.main, amostra
+
+
+@pytest.fixture
+def recepcao(clinica_pequena):
+    app, amostra = clinica_pequena
+    cliente = app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao["usuario_id"] = amostra["recepcionista_id"]
+        sessao["usuario_nome"] = "Recepção"
+        sessao["usuario_tipo"] = "recepcionista master"
+    return cliente
+
+
+@pytest.fixture
+def banco(clinica_pequena):
+    """Conexão direta à base do teste, fora das requisições."""
+    conn = databaser._abrir_conexao()
+    yield conn
+    conn.fechar_de_fato()
+
+
+@pytest.fixture
+def definir_duracao(banco):
+    def _definir(procedimento_id, minutos):
+        banco.execute("UPDATE procedimentos SET duracao_min=? WHERE id=?", (minutos, procedimento_id))
+        banco.commit()
+        databaser.invalidar_referencias("procedimentos")
+    return _definir
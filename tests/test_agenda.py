@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+Comportamento da agenda: choque de horário barrado pelo banco, lotes,
+séries recorrentes, escolha automática de sala e duração dos procedimentos.
+"""
+import sqlite3
+import threading
+
+import pytest
+
+import databaser
+from conftest import DIA, dia_mais
+
+
+def _item(amostra, hora, data=DIA, medico=0, sala=0, procedimento=0, **extra):
+    return {
+        "paciente_id": amostra["paciente_id"],
+        "medico_id": amostra["medicos"][medico],
+        "procedimento_id": amostra["procedimentos"][procedimento],
+        "sala_id": amostra["salas"][sala],
+        "data": data,
+        "hora": hora,
+        **extra,
+    }
+
+
+def _agendar(cliente, item):
+    """Agendamento avulso como o formulário envia: todos os campos em texto."""
+    return cliente.post("/user/agendar_consulta", json={campo: str(valor) for campo, valor in item.items()})
+
+
+def _agendamentos(banco, **filtros):
+    condicoes = " AND ".join(f"{campo}=?" for campo in filtros) or "1"
+    return [dict(row) for row in banco.execute(
+        f"SELECT id, data, hora, medico_id, sala_id, status FROM agendamentos WHERE {condicoes} ORDER BY data, hora",
+        tuple(filtros.values()),
+    )]
+
+
+# ---------- choque de horário ----------
+def test_horario_repetido_devolve_409(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    primeira = _agendar(recepcao, _item(a, "09:00"))
+    assert primeira.status_code == 200 and primeira.get_json()["ok"]
+
+    mesmo_medico = _agendar(recepcao, _item(a, "09:00", sala=1))
+    mesma_sala = _agendar(recepcao, _item(a, "09:00", medico=1))
+    assert mesmo_medico.status_code == 409
+    assert mesma_sala.status_code == 409
+    assert _agendar(recepcao, _item(a, "09:00", medico=1, sala=1)).status_code == 200
+
+
+def test_transacao_agenda_converte_so_choques_de_horario(clinica_pequena, banco):
+    _app, a = clinica_pequena
+    linha = (a["paciente_id"], a["medicos"][0], a["procedimentos"][0], a["salas"][0], DIA, "10:00")
+    sql = "INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora) VALUES (?, ?, ?, ?, ?, ?)"
+    with databaser.transacao_agenda(banco) as cur:
+        cur.execute(sql, linha)
+    with pytest.raises(databaser.HorarioIndisponivel):
+        with databaser.transacao_agenda(banco) as cur:
+            cur.execute(sql, linha)
+    # outras violações continuam IntegrityError
+    with pytest.raises(sqlite3.IntegrityError):
+        with databaser.transacao_agenda(banco) as cur:
+            cur.execute(
+                """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora, status)
+                   VALUES (?, ?, ?, ?, ?, '11:00', 'pendente')""",
+                linha[:5],
+            )
+    assert not banco.in_transaction
+
+
+def test_reservas_concorrentes_do_mesmo_horario_so_uma_grava(clinica_pequena):
+    _app, a = clinica_pequena
+    barreira = threading.Barrier(4)
+    resultados = []
+
+    def reservar(paciente_offset):
+        conn = databaser._abrir_conexao()
+        barreira.wait()
+        try:
+            with databaser.transacao_agenda(conn) as cur:
+                cur.execute(
+                    """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora)
+                       VALUES (?, ?, ?, ?, ?, '11:00')""",
+                    (a["paciente_id"] + paciente_offset, a["medicos"][0], a["procedimentos"][0], a["salas"][0], DIA),
+                )
+            resultados.append("gravou")
+        except databaser.HorarioIndisponivel:
+            resultados.append("recusado")
+        finally:
+            conn.fechar_de_fato()
+
+    threads = [threading.Thread(target=reservar, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(resultados) == ["gravou", "recusado", "recusado", "recusado"]
+
+
+# ---------- lote ----------
+def test_lote_recusa_conflito_interno_item_a_item(clinica_pequena, recepcao, banco):
+    _app, a = clinica_pequena
+    resposta = recepcao.post("/user/api/agendamentos/lote", json={"agendamentos": [
+        _item(a, "09:00"), _item(a, "09:00", sala=1), _item(a, "14:00"),
+    ]})
+    corpo = resposta.get_json()
+    assert resposta.status_code == 200
+    assert (corpo["criados"], corpo["recusados"]) == (2, 1)
+    assert [r["ok"] for r in corpo["resultados"]] == [True, False, True]
+    assert corpo["resultados"][1]["msg"] == "Horário indisponível para este médico."
+    gravados = {row["id"]: row["hora"] for row in _agendamentos(banco, data=DIA)}
+    assert {r["id"]: r["hora"] for r in corpo["resultados"] if r["ok"]} == gravados
+
+
+def test_lote_tudo_ou_nada_nao_grava_nada_com_conflito(clinica_pequena, recepcao, banco):
+    _app, a = clinica_pequena
+    resposta = recepcao.post("/user/api/agendamentos/lote", json={"tudo_ou_nada": True, "agendamentos": [
+        _item(a, "09:00"), _item(a, "09:00", medico=1), _item(a, "14:00"),
+    ]})
+    corpo = resposta.get_json()
+    assert (corpo["ok"], corpo["criados"], corpo["recusados"]) == (False, 0, 3)
+    assert corpo["resultados"][1]["msg"] == "Horário indisponível para esta sala."
+    assert _agendamentos(banco, data=DIA) == []
+
+
+def test_lote_nao_aceita_qualquer_sala(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    corpo = recepcao.post("/user/api/agendamentos/lote",
+                          json=[dict(_item(a, "09:00"), sala_id=databaser.SALA_QUALQUER)]).get_json()
+    assert corpo["criados"] == 0
+    assert "sala" in corpo["resultados"][0]["msg"]
+
+
+# ---------- séries ----------
+def _serie(a, hora="09:00", **extra):
+    return _item(a, hora, frequencia="semanal", ocorrencias=3, **extra)
+
+
+def test_serie_oferece_alternativa_ou_pula_data_ocupada(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    assert _agendar(recepcao, _item(a, "09:00", data=dia_mais(7), sala=1)).status_code == 200
+
+    plano = recepcao.post("/user/api/series", json=_serie(a, simular=True)).get_json()
+    assert [o["situacao"] for o in plano["ocorrencias"]] == ["livre", "alternativa", "livre"]
+    alternativa = plano["ocorrencias"][1]
+    assert (alternativa["data_pedida"], alternativa["hora_pedida"]) == (dia_mais(7), "09:00")
+    assert alternativa["data"] == dia_mais(7) and alternativa["hora"] in ("08:30", "09:30")
+    assert plano["serie_id"] is None
+
+    pulando = recepcao.post("/user/api/series", json=_serie(a, conflitos="pular")).get_json()
+    assert [o["situacao"] for o in pulando["ocorrencias"]] == ["livre", "pulada", "livre"]
+    assert (pulando["criados"], pulando["puladas"]) == (2, 1)
+
+
+def test_serie_com_ate_anterior_a_data_inicial_e_recusada(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    corpo = _item(a, "09:00", frequencia="semanal", ate=dia_mais(-1))
+    resposta = recepcao.post("/user/api/series", json=corpo)
+    assert resposta.status_code == 400
+    assert resposta.get_json()["msg"] == "Regra de recorrência inválida."
+
+
+def test_serie_move_e_cancela_ocorrencias(clinica_pequena, recepcao, banco):
+    _app, a = clinica_pequena
+    serie_id = recepcao.post("/user/api/series", json=_serie(a)).get_json()["serie_id"]
+
+    movida = recepcao.post(f"/user/api/series/{serie_id}/mover", json={"dias": 1, "hora": "10:00"})
+    assert movida.get_json() == {"ok": True, "serie_id": serie_id, "movidos": 3}
+    assert [(r["data"], r["hora"]) for r in _agendamentos(banco, serie_id=serie_id)] == [
+        (dia_mais(1), "10:00"), (dia_mais(8), "10:00"), (dia_mais(15), "10:00"),
+    ]
+
+    # tudo ou nada: um destino ocupado impede a série inteira
+    assert _agendar(recepcao, _item(a, "10:00", data=dia_mais(9), sala=1)).status_code == 200
+    assert recepcao.post(f"/user/api/series/{serie_id}/mover", json={"dias": 1}).status_code == 409
+    assert [r["data"] for r in _agendamentos(banco, serie_id=serie_id)] == [dia_mais(1), dia_mais(8), dia_mais(15)]
+
+    for corpo in ({"dias": 10 ** 9}, {"dias": -10 ** 9}, {"dias": 0, "hora": "10:15"}):
+        assert recepcao.post(f"/user/api/series/{serie_id}/mover", json=corpo).status_code == 400
+
+    cancelada = recepcao.post(f"/user/api/series/{serie_id}/cancelar", json={}).get_json()
+    assert cancelada["cancelados"] == 3
+    assert {r["status"] for r in _agendamentos(banco, serie_id=serie_id)} == {"cancelado"}
+
+
+def test_mover_serie_respeita_fim_do_atendimento(clinica_pequena, recepcao, definir_duracao):
+    _app, a = clinica_pequena
+    definir_duracao(a["procedimentos"][0], 90)
+    serie_id = recepcao.post("/user/api/series", json=_serie(a, "15:00")).get_json()["serie_id"]
+    assert recepcao.post(f"/user/api/series/{serie_id}/mover", json={"hora": "17:00"}).status_code == 400
+    assert recepcao.post(f"/user/api/series/{serie_id}/mover", json={"hora": "16:00"}).status_code == 200
+
+
+# ---------- escolha automática de sala ----------
+def test_qualquer_sala_escolhe_uma_sala_livre(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    assert _agendar(recepcao, _item(a, "09:00", medico=1, sala=0)).status_code == 200
+
+    resposta = _agendar(recepcao, dict(_item(a, "09:00"), sala_id=databaser.SALA_QUALQUER))
+    assert resposta.status_code == 200
+    assert resposta.get_json()["sala_id"] in a["salas"][1:]
+
+
+def test_qualquer_sala_sem_sala_livre_devolve_409(clinica_pequena, recepcao):
+    _app, a = clinica_pequena
+    for indice, _sala in enumerate(a["salas"]):
+        assert _agendar(recepcao, _item(a, "09:00", medico=indice + 1, sala=indice)).status_code == 200
+    resposta = _agendar(recepcao, dict(_item(a, "09:00"), sala_id=databaser.SALA_QUALQUER))
+    assert resposta.status_code == 409
+
+
+# ---------- duração dos procedimentos ----------
+def test_procedimento_de_90_minutos_bloqueia_os_dois_horarios_seguintes(clinica_pequena, recepcao, banco,
+                                                                       definir_duracao):
+    _app, a = clinica_pequena
+    longo, curto = a["procedimentos"][0], a["procedimentos"][1]
+    definir_duracao(longo, 90)
+    assert _agendar(recepcao, _item(a, "09:00")).status_code == 200
+
+    medico, sala = a["medicos"][0], a["salas"][0]
+    livres = {hora: databaser.is_slot_available(DIA, hora, medico, sala) for hora in ("09:30", "10:00", "10:30")}
+    assert livres == {"09:30": False, "10:00": False, "10:30": True}
+    assert databaser.is_slot_available(DIA, "08:30", medico, sala)
+    assert not databaser.is_slot_available(DIA, "08:30", medico, sala, duracao_min=60)
+
+    # o trigger barra a sobreposição mesmo sem passar pelas rotas
+    inserir = """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora)
+                 VALUES (?, ?, ?, ?, ?, ?)"""
+    for hora in ("09:30", "10:00"):
+        with pytest.raises(sqlite3.IntegrityError, match=databaser.ERRO_SOBREPOSICAO):
+            banco.execute(inserir, (a["paciente_id"], medico, curto, a["salas"][1], DIA, hora))
+        with pytest.raises(sqlite3.IntegrityError, match=databaser.ERRO_SOBREPOSICAO):
+            banco.execute(inserir, (a["paciente_id"], a["medicos"][1], curto, sala, DIA, hora))
+    banco.execute(inserir, (a["paciente_id"], medico, curto, sala, DIA, "10:30"))
+    banco.commit()
+
+
+def test_lote_considera_a_duracao_de_cada_item(clinica_pequena, recepcao, definir_duracao):
+    _app, a = clinica_pequena
+    definir_duracao(a["procedimentos"][0], 90)
+    corpo = recepcao.post("/user/api/agendamentos/lote", json=[
+        _item(a, "09:00", procedimento=0), _item(a, "09:30", procedimento=1, sala=1), _item(a, "10:30", procedimento=1),
+    ]).get_json()
+    assert [r["ok"] for r in corpo["resultados"]] == [True, False, True]
+
+
+def test_agendamento_que_passaria_das_17h30_e_recusado(clinica_pequena, recepcao, definir_duracao):
+    _app, a = clinica_pequena
+    definir_duracao(a["procedimentos"][0], 90)
+    resposta = _agendar(recepcao, _item(a, "17:00"))
+    assert resposta.status_code == 400
+    assert resposta.get_json()["msg"] == "O procedimento terminaria depois das 17:30; escolha um horário mais cedo."
+    assert _agendar(recepcao, _item(a, "16:00")).status_code == 200
+
+
+def test_sugestoes_e_grade_do_periodo_usam_a_mesma_regra(clinica_pequena, recepcao, definir_duracao):
+    _app, a = clinica_pequena
+    definir_duracao(a["procedimentos"][1], 60)
+    assert _agendar(recepcao, _item(a, "09:00")).status_code == 200
+    medico, sala = a["medicos"][0], a["salas"][0]
+
+    livres = databaser.horarios_disponiveis(medico, sala, DIA, duracao_min=60)
+    grade = databaser.grade_disponibilidade(DIA, DIA, medico, sala, duracao_min=60)[0]
+    assert grade["disponiveis"] == livres
+    assert "08:30" not in livres and "16:30" in livres and "17:00" not in livres
+    assert databaser.sugerir_horarios(DIA, "08:30", medico, sala, limite=1, duracao_min=60) == [(DIA, "09:30")]
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Regressão de planos de consulta.
+
+Carrega uma base sintética grande, percorre todas as rotas do blueprint `user`
+(e as tarefas periódicas) registrando cada SQL emitido, e compara o
+EXPLAIN QUERY PLAN de cada consulta com o registrado em
+fixtures/planos_consulta.json. Consultas marcadas como "quente" não podem usar
+SCAN em nenhuma tabela.
+
+Para regravar a fixture depois de mudar consultas ou índices (revise o diff):
+
+    ATUALIZAR_PLANOS=1 python -m pytest tests/test_planos_consulta.py
+"""
+import json
+import os
+import re
+import sys
+from datetime import date, timedelta
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+import databaser  # noqa: E402
+from ferramentas.dados_sinteticos import SENHA_PADRAO, gerar_clinica  # noqa: E402
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "planos_consulta.json")
+ATUALIZAR = os.environ.get("ATUALIZAR_PLANOS") == "1"
+
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def assinatura(sql):
+    """SQL sem literais e com espaços colapsados: identifica a consulta no código."""
+    return " ".join(_LITERAL.sub("?", sql).split())
+
+
+def _relevante(sql):
+    texto = sql.lstrip().upper()
+    return texto.startswith(("SELECT", "UPDATE", "DELETE", "WITH", "INSERT INTO CONTAGEM", "INSERT INTO AGENDAMENTOS_NOVO"))
+
+
+@pytest.fixture(scope="module")
+def clinica(tmp_path_factory):
+    caminho = str(tmp_path_factory.mktemp("planos") / "clinica.db")
+    amostra = gerar_clinica(caminho, agendamentos=20000, medicos=60, pacientes=3000)
+    import main  # importado depois de apontar DB_PATH para a base sintética
+    main.main.testing = True
+    return main.main, amostra
+
+
+def _cliente(app, usuario_id, tipo):
+    cliente = app.test_client()
+    with cliente.session_transaction() as sessao:
+        sessao["usuario_id"] = usuario_id
+        sessao["usuario_nome"] = "Teste"
+        sessao["usuario_tipo"] = tipo
+    return cliente
+
+
+def _exercitar(app, a):
+    """Uma chamada (ou mais) para cada endpoint do blueprint."""
+    hoje = date.today().isoformat()
+    amanha = (date.today() + timedelta(days=1)).isoformat()
+    mes = date.today().strftime("%Y-%m")
+    rec = _cliente(app, a["recepcionista_id"], "recepcionista master")
+    med = _cliente(app, a["medico_hoje_id"] or a["medico_id"], "medico")
+    pac = _cliente(app, a["paciente_id"], "paciente")
+    anonimo = app.test_client()
+    ag, m, s, p = a["agendamento_id"], a["medico_id"], a["sala_id"], a["procedimento_id"]
+    from routes.user import _codificar_cursor
+    cursor = _codificar_cursor({"data": hoje, "hora": "12:00", "id": ag})
+
+    chamadas = [
+        (anonimo, "get", "/user/", None),
+        (anonimo, "post", "/user/", {"email": "medico1@sintetico.test", "senha": SENHA_PADRAO}),
+        (anonimo, "get", "/user/register", None),
+        (anonimo, "post", "/user/register", {"nome": "Novo Paciente", "email": "novo@sintetico.test", "senha": "x"}),
+        (rec, "get", "/user/agendar_consulta", None),
+        (rec, "post", "/user/agendar_consulta", {"paciente_id": str(a["paciente_id"]), "medico_id": str(m),
+                                                 "procedimento_id": "__receita__", "sala_id": str(s),
+                                                 "data": amanha, "hora": "17:00"}),
+        (rec, "post", "/user/api/agendamentos/lote", [
+            {"paciente_id": a["paciente_id"], "medico_id": m, "procedimento_id": p, "sala_id": s,
+             "data": amanha, "hora": "07:00"},
+            {"paciente_id": a["paciente_id"], "medico_id": m, "procedimento_id": p, "sala_id": s,
+             "data": amanha, "hora": "07:00"},
+        ]),
+        (rec, "post", "/user/api/series", {"paciente_id": a["paciente_id"], "medico_id": m, "procedimento_id": p,
+                                           "sala_id": s, "data": amanha, "hora": "07:30", "frequencia": "semanal",
+                                           "ocorrencias": 3, "conflitos": "pular"}),
+        (rec, "post", "/user/api/series/1/mover", {"dias": 1, "hora": "17:00"}),
+        (rec, "post", "/user/api/series/1/cancelar", {}),
+        (rec, "get", "/user/recepcionista", None),
+        (rec, "get", f"/user/recepcionista?mes={mes}&medico={m}&convenio=Uni", None),
+        (rec, "get", f"/user/recepcionista?mes={mes}&apos={cursor}", None),
+        (rec, "get", f"/user/recepcionista?medico={m}&antes={cursor}", None),
+        (rec, "get", "/user/recepcionista/relatorios/exportar?escopo=mensal", None),
+        (rec, "get", "/user/recepcionista/procedimentos", None),
+        (rec, "get", f"/user/recepcionista/procedimentos?apos={cursor}", None),
+        (rec, "get", f"/user/recepcionista/procedimentos?antes={cursor}", None),
+        (rec, "post", "/user/recepcionista/procedimentos/novo", {"nome": "Procedimento Novo", "duracao_min": "60"}),
+        (rec, "post", f"/user/recepcionista/procedimentos/{p}/editar", {"nome": "Procedimento 1", "descricao": "x",
+                                                                               "duracao_min": "30"}),
+        (rec, "post", f"/user/recepcionista/procedimentos/agendamentos/{ag}",
+         {"status": "agendado", "data": amanha, "hora": "08:00"}),
+        (rec, "get", "/user/recepcionista/ajustes", None),
+        (rec, "post", "/user/recepcionista/conflitos/1/revisado", None),
+        (rec, "post", f"/user/recepcionista/ajustes/{a['ajuste_id']}/decidir", {"acao": "negar"}),
+        (rec, "post", f"/user/recepcionista/ajustes/{a['ajuste_id'] + 1}/decidir", {"acao": "aceitar"}),
+        (rec, "get", f"/user/recepcionista/horarios_disponiveis?medico_id={m}&sala_id={s}&dia={amanha}", None),
+        (rec, "get", f"/user/recepcionista/horarios_disponiveis?medico_id={m}&sala_id={s}&dia={amanha}&ignorar_id={ag}", None),
+        (rec, "get", f"/user/api/disponibilidade?data={amanha}&medico_id={m}&sala_id={s}", None),
+        (rec, "get", f"/user/api/disponibilidade/periodo?inicio={amanha}&dias=31&medico_id={m}&sala_id={s}", None),
+        (rec, "get", f"/user/api/disponibilidade/periodo?inicio={amanha}&medico_id={m}&sala_id={s}&procedimento_id={p}", None),
+        (rec, "get", f"/user/api/sugerir_horario?data={amanha}&hora=08:00&medico_id={m}&sala_id={s}&limite=5", None),
+        (rec, "post", f"/user/recepcionista/chamadas/{a['chamada_id']}/encaminhar", {}),
+        (rec, "get", "/user/cadastrar_usuarios", None),
+        (rec, "post", "/user/cadastrar_usuarios", {"nome": "Médico Novo", "email": "mnovo@sintetico.test",
+                                                   "senha": "x", "tipo_usuario": "medico"}),
+        (rec, "get", "/user/recepcionista/usuarios", None),
+        (rec, "get", "/user/recepcionista/usuarios?q=pacie", None),
+        (rec, "get", "/user/api/usuarios/busca?q=medico 1&tipo=medico", None),
+        (rec, "get", f"/user/recepcionista?paciente={a['paciente_id']}", None),
+        (rec, "get", f"/user/recepcionista/usuarios/{a['paciente_id']}/editar", None),
+        (rec, "post", f"/user/recepcionista/usuarios/{a['paciente_id']}/editar",
+         {"nome": "Paciente Editado", "email": "editado@sintetico.test"}),
+        (med, "get", "/user/medico", None),
+        (med, "post", f"/user/medico/agendamentos/{a['agendamento_hoje_id']}/nota", {"nota": "ok"}),
+        (med, "post", f"/user/medico/agendamentos/{a['agendamento_hoje_id']}/chamar", {}),
+        (pac, "get", "/user/paciente", None),
+        (pac, "post", "/user/paciente/perfil", {"nome": "Paciente", "email": "pac@sintetico.test"}),
+        (pac, "post", "/user/paciente/agendar", {"medico_id": m, "procedimento_id": p, "sala_id": s,
+                                                 "data": amanha, "hora": "16:30"}),
+        (pac, "post", f"/user/paciente/solicitar_ajuste/{ag}", {"novo_dia": amanha, "nova_hora": "16:00"}),
+        (pac, "get", f"/user/paciente/horarios_disponiveis?agendamento_id={ag}&dia={amanha}", None),
+        (pac, "get", f"/user/paciente/horarios_novo?medico_id={m}&sala_id={s}&dia={amanha}", None),
+        (pac, "get", f"/user/paciente/horarios_novo?medico_id={m}&sala_id=qualquer&dia={amanha}", None),
+        (pac, "post", "/user/paciente/agendar", {"medico_id": m, "procedimento_id": p, "sala_id": "qualquer",
+                                                 "data": amanha, "hora": "15:30"}),
+        (rec, "post", f"/user/recepcionista/procedimentos/agendamentos/{ag}", {"status": "cancelado"}),
+    ]
+    endpoints = set()
+    for cliente, metodo, url, dados in chamadas:
+        if isinstance(dados, list) or "/api/" in url and dados is not None:
+            resposta = getattr(cliente, metodo)(url, json=dados)
+        else:
+            resposta = getattr(cliente, metodo)(url, data=dados)
+        assert resposta.status_code < 500, (url, resposta.status_code)
+        resposta.get_data()  # consome respostas em streaming
+        adaptador = app.url_map.bind("localhost")
+        endpoints.add(adaptador.match(url.split("?")[0], method=metodo.upper())[0])
+
+    # fluxo SSE das chamadas: lê só o replay a partir do Last-Event-ID e fecha
+    url = "/user/recepcionista/chamadas/eventos"
+    resposta = rec.get(url, headers={"Last-Event-ID": str(a["chamada_id"] - 1)}, buffered=False)
+    assert resposta.status_code == 200 and resposta.mimetype == "text/event-stream"
+    partes = iter(resposta.response)
+    next(partes)  # retry
+    assert b"event: chamada" in next(partes)
+    resposta.close()
+    endpoints.add(adaptador.match(url)[0])
+
+    # tarefas periódicas fazem parte do caminho quente do banco
+    databaser.normalizar_agendamentos_legados(recomecar=True)
+    databaser.auto_close_past_appointments()
+    return endpoints, hoje
+
+
+@pytest.fixture(scope="module")
+def planos(clinica):
+    app, amostra = clinica
+    capturadas = {}
+    abrir_original = databaser._abrir_conexao
+
+    def abrir_com_rastro():
+        conn = abrir_original()
+        conn.set_trace_callback(lambda sql: _relevante(sql) and capturadas.setdefault(assinatura(sql), sql))
+        return conn
+
+    databaser._abrir_conexao = abrir_com_rastro
+    with databaser._pool_lock:
+        databaser._pool.clear()
+    databaser.limpar_cache_disponibilidade()
+    databaser.invalidar_referencias()
+    try:
+        endpoints, _hoje = _exercitar(app, amostra)
+    finally:
+        databaser._abrir_conexao = abrir_original
+        with databaser._pool_lock:
+            databaser._pool.clear()
+
+    conn = abrir_original()
+    resultado = {}
+    for chave, sql in capturadas.items():
+        plano = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql)]
+        if plano:
+            resultado[chave] = plano
+    conn.fechar_de_fato()
+    return app, endpoints, resultado
+
+
+def _ler_fixture():
+    if not os.path.exists(FIXTURE):
+        return {}
+    with open(FIXTURE, encoding="utf-8") as arquivo:
+        return {item["consulta"]: item for item in json.load(arquivo)}
+
+
+_MATCH_FTS = re.compile(r"VIRTUAL TABLE INDEX \d+:M")  # MATCH resolvido pelo índice do FTS5
+
+
+def _usa_scan(plano):
+    return [
+        linha for linha in plano
+        if linha.startswith("SCAN ") and not linha.startswith("SCAN CONSTANT ROW") and not _MATCH_FTS.search(linha)
+    ]
+
+
+def test_todas_as_rotas_sao_exercitadas(planos):
+    app, endpoints, _resultado = planos
+    registrados = {regra.endpoint for regra in app.url_map.iter_rules() if regra.endpoint.startswith("user.")}
+    assert registrados - endpoints == set(), "inclua as novas rotas em _exercitar()"
+
+
+def test_planos_conferem_com_a_fixture(planos):
+    _app, _endpoints, resultado = planos
+    esperado = _ler_fixture()
+    if ATUALIZAR:
+        itens = [
+            {"consulta": chave, "quente": esperado.get(chave, {}).get("quente", False), "plano": plano}
+            for chave, plano in sorted(resultado.items())
+        ]
+        os.makedirs(os.path.dirname(FIXTURE), exist_ok=True)
+        with open(FIXTURE, "w", encoding="utf-8") as arquivo:
+            json.dump(itens, arquivo, ensure_ascii=False, indent=2)
+            arquivo.write("\n")
+        esperado = {item["consulta"]: item for item in itens}
+
+    novas = sorted(set(resultado) - set(esperado))
+    assert not novas, "consultas sem plano registrado (rode com ATUALIZAR_PLANOS=1):\n" + "\n".join(novas)
+    divergentes = {
+        chave: {"esperado": esperado[chave]["plano"], "atual": plano}
+        for chave, plano in resultado.items()
+        if esperado[chave]["plano"] != plano
+    }
+    assert not divergentes, json.dumps(divergentes, ensure_ascii=False, indent=2)
+
+
+def test_consultas_quentes_usam_indice(planos):
+    _app, _endpoints, resultado = planos
+    quentes = {chave for chave, item in _ler_fixture().items() if item["quente"]}
+    assert quentes, "nenhuma consulta marcada como quente na fixture"
+    com_scan = {chave: _usa_scan(plano) for chave, plano in resultado.items() if chave in quentes and _usa_scan(plano)}
+    assert not com_scan, json.dumps(com_scan, ensure_ascii=False, indent=2)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Tarefas de manutenção: marca do fechamento automático (e sua conversão na
+migração 13), normalização de agendamentos legados, cache de
+disponibilidade e o registro de conflitos da migração 6.
+"""
+import logging
+from datetime import datetime, timedelta
+
+import databaser
+from conftest import DIA, dia_mais
+
+
+def _inserir(banco, amostra, data, hora, medico=0, sala=0, status="agendado"):
+    """Grava direto na tabela, como fariam dados legados ou outro processo."""
+    cur = banco.execute(
+        """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora, status)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (amostra["paciente_id"], amostra["medicos"][medico], amostra["procedimentos"][0],
+         amostra["salas"][sala], data, hora, status),
+    )
+    banco.commit()
+    return cur.lastrowid
+
+
+def _status(banco, agendamento_id):
+    return banco.execute("SELECT status FROM agendamentos WHERE id=?", (agendamento_id,)).fetchone()[0]
+
+
+def _marca(banco, chave):
+    return databaser.ler_estado_tarefa(banco.cursor(), chave)
+
+
+def _data_br(data_iso):
+    ano, mes, dia = data_iso.split("-")
+    return f"{dia}/{mes}/{ano}"
+
+
+# ---------- fechamento automático ----------
+
+def test_fechamento_conclui_so_o_que_venceu_e_avanca_a_marca(clinica_pequena, banco):
+    _app, a = clinica_pequena
+    manha = _inserir(banco, a, DIA, "09:00")
+    tarde = _inserir(banco, a, DIA, "14:00")
+
+    databaser.auto_close_past_appointments(now=datetime.fromisoformat(f"{DIA} 12:00"))
+
+    assert _status(banco, manha) == "concluido"
+    assert _status(banco, tarde) == "agendado"
+    # o dia corrente continua na janela da próxima execução
+    assert _marca(banco, databaser._CHAVE_FECHAMENTO) == str(databaser.minutos_do_horario(DIA, "00:00"))
+
+    databaser.auto_close_past_appointments(now=datetime.fromisoformat(f"{DIA} 15:00"))
+    assert _status(banco, tarde) == "concluido"
+
+
+def test_reaberto_atras_da_marca_e_fechado_de_novo(clinica_pequena, recepcao, banco):
+    _app, a = clinica_pequena
+    agendamento = _inserir(banco, a, DIA, "09:00")
+    dia_seguinte = datetime.fromisoformat(f"{dia_mais(1)} 12:00")
+    databaser.auto_close_past_appointments(now=dia_seguinte)
+    assert _status(banco, agendamento) == "concluido"
+    assert int(_marca(banco, databaser._CHAVE_FECHAMENTO)) > databaser.minutos_do_horario(DIA, "09:00")
+
+    recepcao.post(f"/user/recepcionista/procedimentos/agendamentos/{agendamento}", data={"status": "agendado"})
+    assert _status(banco, agendamento) == "agendado"
+    assert _marca(banco, databaser._CHAVE_FECHAMENTO) == str(databaser.minutos_do_horario(DIA, "09:00"))
+
+    databaser.auto_close_past_appointments(now=dia_seguinte)
+    assert _status(banco, agendamento) == "concluido"
+
+
+def test_migracao_13_converte_marca_em_data(clinica_pequena, banco):
+    cur = banco.cursor()
+    databaser.gravar_estado_tarefa(cur, databaser._CHAVE_FECHAMENTO, DIA)
+
+    databaser._migracao_013_marca_fechamento_em_minutos(cur)
+    esperado = str(databaser.minutos_do_horario(DIA, "00:00"))
+    assert _marca(banco, databaser._CHAVE_FECHAMENTO) == esperado
+
+    # já em minutos: rodar de novo não muda nada
+    databaser._migracao_013_marca_fechamento_em_minutos(cur)
+    assert _marca(banco, databaser._CHAVE_FECHAMENTO) == esperado
+    banco.rollback()
+
+
+# ---------- normalização de legados ----------
+
+def test_normalizacao_corrige_formatos_e_pula_colisoes(clinica_pequena, banco, caplog):
+    _app, a = clinica_pequena
+    data_br = _inserir(banco, a, _data_br(DIA), "9:00")
+    ocupado = _inserir(banco, a, DIA, "10:00")
+    # corrigido, cairia no horário do médico já ocupado às 10:00
+    colide = _inserir(banco, a, _data_br(DIA), "10:00", sala=1)
+    depois = _inserir(banco, a, _data_br(dia_mais(1)), "9:00")
+
+    with caplog.at_level(logging.WARNING, logger=databaser.log.name):
+        assert databaser.normalizar_agendamentos_legados(tamanho_lote=2, recomecar=True) >= 2
+
+    linhas = {row["id"]: (row["data"], row["hora"]) for row in banco.execute(
+        "SELECT id, data, hora FROM agendamentos WHERE id IN (?, ?, ?, ?)", (data_br, ocupado, colide, depois))}
+    assert linhas[data_br] == (DIA, "09:00")
+    assert linhas[ocupado] == (DIA, "10:00")
+    assert linhas[colide] == (_data_br(DIA), "10:00")
+    assert linhas[depois] == (dia_mais(1), "09:00")
+    assert f"agendamento {colide} mantido" in caplog.text
+
+    ultimo = banco.execute("SELECT MAX(id) FROM agendamentos").fetchone()[0]
+    assert _marca(banco, databaser._CHAVE_NORMALIZACAO) == str(ultimo)
+
+
+def test_normalizacao_retoma_da_marca(clinica_pequena, banco):
+    _app, a = clinica_pequena
+    databaser.normalizar_agendamentos_legados(recomecar=True)
+    legado = _inserir(banco, a, _data_br(DIA), "9:00")
+
+    assert databaser.normalizar_agendamentos_legados() == 1
+    assert banco.execute("SELECT data FROM agendamentos WHERE id=?", (legado,)).fetchone()[0] == DIA
+    assert databaser.normalizar_agendamentos_legados() == 0
+
+
+# ---------- cache de disponibilidade ----------
+
+def test_cache_de_disponibilidade_e_invalidacao(clinica_pequena, recepcao, banco):
+    _app, a = clinica_pequena
+    medico, sala = a["medicos"][0], a["salas"][0]
+    assert "09:00" in databaser.horarios_disponiveis(medico, sala, DIA)
+
+    # escrita fora das rotas: o cache só vê depois de invalidado
+    _inserir(banco, a, DIA, "09:00")
+    assert "09:00" in databaser.horarios_disponiveis(medico, sala, DIA)
+    databaser.invalidar_disponibilidade(DIA, medico)
+    assert "09:00" not in databaser.horarios_disponiveis(medico, sala, DIA)
+
+    # a rota de agendamento invalida sozinha
+    assert "10:00" in databaser.horarios_disponiveis(medico, sala, DIA)
+    resposta = recepcao.post("/user/agendar_consulta", json={
+        "paciente_id": str(a["paciente_id"]), "medico_id": str(medico), "sala_id": str(sala),
+        "procedimento_id": str(a["procedimentos"][0]), "data": DIA, "hora": "10:00",
+    })
+    assert resposta.status_code == 200
+    assert "10:00" not in databaser.horarios_disponiveis(medico, sala, DIA)
+
+
+# ---------- migração 6 ----------
+
+def test_migracao_6_registra_conflitos_para_revisao(tmp_path, monkeypatch):
+    monkeypatch.setattr(databaser, "DB_PATH", str(tmp_path / "v5.db"))
+    monkeypatch.setattr(databaser, "MIGRACOES", databaser.MIGRACOES[:5])
+    monkeypatch.setattr(databaser, "VERSAO_SCHEMA", 5)
+    databaser.aplicar_migracoes()
+
+    conn = databaser._abrir_conexao()
+    try:
+        sala = conn.execute("SELECT MIN(id) FROM salas").fetchone()[0]
+        procedimento = conn.execute("SELECT MIN(id) FROM procedimentos").fetchone()[0]
+        amanha = (datetime.now() + timedelta(days=1)).date().isoformat()
+        ids = [conn.execute(
+            """INSERT INTO agendamentos (paciente_id, medico_id, procedimento_id, sala_id, data, hora, status)
+               VALUES (1, 2, ?, ?, ?, '09:00', 'agendado')""", (procedimento, sala, amanha)).lastrowid
+               for _ in range(2)]
+        conn.commit()
+    finally:
+        conn.fechar_de_fato()
+
+    monkeypatch.undo()
+    monkeypatch.setattr(databaser, "DB_PATH", str(tmp_path / "v5.db"))
+    assert databaser.aplicar_migracoes() == list(range(6, databaser.VERSAO_SCHEMA + 1))
+
+    conn = databaser._abrir_conexao()
+    try:
+        assert [row[0] for row in conn.execute(
+            "SELECT status FROM agendamentos ORDER BY id")] == ["agendado", "negado"]
+        conflito = conn.execute(
+            "SELECT agendamento_id, conflita_com, status_anterior, revisado_em FROM conflitos_horario").fetchall()
+        assert [tuple(row) for row in conflito] == [(ids[1], ids[0], "agendado", None)]
+    finally:
+        conn.fechar_de_fato()